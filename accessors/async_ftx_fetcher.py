@@ -0,0 +1,99 @@
+import asyncio
+import time
+import typing
+
+import aiohttp
+
+from constants import FTX_CANDLES_PAGE_LIMIT, FTX_FUNDING_RATES_PAGE_LIMIT
+from utils.utils import split_time_windows
+
+FTX_REST_ENDPOINT = 'https://ftx.com'
+
+"""
+asyncio fetcher for FTX historical data (public endpoints only).
+Because we know both the resolution of a series and the max rows returned per request, a missing time range can be
+split up front into independent page-sized windows. Those are fetched concurrently over a single pooled HTTP
+session and stitched back together in order, rather than paging backwards one request at a time.
+"""
+
+
+class AsyncFtxHistoricalFetcher:
+    def __init__(self, concurrency: int = 16, rate_limiter=None, timeout: float = 30):
+        """
+        :param concurrency: the max number of requests in flight at once
+        :param rate_limiter: an optional (process-shared) RateLimiter every request is passed through
+        :param timeout: total timeout in seconds for each request
+        """
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+    def run(self, coroutine: typing.Awaitable) -> typing.Any:
+        """
+        Simple synchronous entrypoint, e.g. fetcher.run(fetcher.fetch_candles('BTC-PERP', 3600, since=...))
+        """
+        return asyncio.run(self.__with_session(coroutine))
+
+    async def __with_session(self, coroutine: typing.Awaitable) -> typing.Any:
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(base_url=FTX_REST_ENDPOINT, connector=connector,
+                                         timeout=self.timeout) as session:
+            self._session = session
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            return await coroutine
+
+    async def _get(self, path: str, params: dict) -> typing.List[dict]:
+        async with self._semaphore:
+            if self.rate_limiter:
+                # The shared limiter blocks, so keep it off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.rate_limiter.acquire)
+            async with self._session.get(path, params=params) as response:
+                payload = await response.json()
+        if not payload.get('success'):
+            raise Exception(f"FTX request to {path} failed: {payload.get('error')}")
+        return payload['result']
+
+    async def fetch_windows(self, path: str, params: dict, windows: typing.List[typing.Tuple[float, float]],
+                            time_key: str) -> typing.List[dict]:
+        """
+        Fetches every window concurrently and stitches the pages back together, ordered by time_key and
+        de-duplicated on it (FTX's start_time/end_time are both inclusive, so adjacent windows can overlap).
+        :param path: the REST path to request
+        :param params: request params shared by every window
+        :param windows: a list of (start, end) unix timestamps, each small enough to fit into a single page
+        :param time_key: the field each row is keyed by in time
+        :return: the stitched rows
+        """
+        pages = await asyncio.gather(*[
+            self._get(path, {**params, 'start_time': int(start), 'end_time': int(end) - 1})
+            for (start, end) in windows
+        ])
+        stitched = {}
+        for page in pages:
+            for row in page:
+                stitched[row[time_key]] = row
+        return [stitched[key] for key in sorted(stitched.keys())]
+
+    async def fetch_candles(self, symbol: str, resolution_seconds: int, since: float,
+                            until: float = None) -> typing.List[dict]:
+        """
+        :param symbol: an FTX market name
+        :param resolution_seconds: the candle resolution (see RESOLUTIONS_MAP)
+        :param since: unix timestamp of the first candle wanted
+        :param until: unix timestamp to fetch until (defaults to now)
+        :return: a list of candles, in the same format as the REST API (ordered by startTime)
+        """
+        windows = split_time_windows(since, until or time.time(), resolution_seconds * FTX_CANDLES_PAGE_LIMIT)
+        return await self.fetch_windows(f'/api/markets/{symbol}/candles',
+                                        {'resolution': resolution_seconds, 'limit': FTX_CANDLES_PAGE_LIMIT},
+                                        windows, 'startTime')
+
+    async def fetch_funding_rates(self, future: str, since: float, until: float = None) -> typing.List[dict]:
+        """
+        :param future: an FTX perpetual future name (e.g. BTC-PERP)
+        :param since: unix timestamp of the first funding payment wanted
+        :param until: unix timestamp to fetch until (defaults to now)
+        :return: a list of funding rates, in the same format as the REST API (ordered by time)
+        """
+        windows = split_time_windows(since, until or time.time(), 60 * 60 * FTX_FUNDING_RATES_PAGE_LIMIT)
+        return await self.fetch_windows('/api/funding_rates', {'future': future}, windows, 'time')
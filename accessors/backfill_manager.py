@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import sqlalchemy as db
+
+import accessors.db_accessor as db_accessor
+from config import Config
+from constants import RESOLUTIONS_MAP, FTX_HISTORY_START, FTX_CANDLES_PAGE_LIMIT, FTX_FUNDING_RATES_PAGE_LIMIT
+from utils.utils import split_time_windows, retry
+
+
+class BackfillCheckpoint:
+    """
+    Local (JSON file) record of a backfill's progress, so an interrupted backfill can resume where it stopped.
+    Per symbol, this stores the start of the range being backfilled, which windows have been written, the rows
+    written so far and any failures. Every update is flushed to disk atomically.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.state: typing.Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def symbol_state(self, symbol: str, since: float) -> dict:
+        """
+        Returns the progress for a symbol, starting it at `since` if this is the first time it's been seen
+        (a resumed symbol keeps its original start, as rows written out of order mean max(timestamp) can't be
+        trusted as a resume point).
+        """
+        with self._lock:
+            if symbol not in self.state:
+                self.state[symbol] = {'since': since, 'completed_windows': [], 'rows': 0, 'seconds': 0.0,
+                                      'failures': {}}
+            return self.state[symbol]
+
+    def mark_window_done(self, symbol: str, window_start: float, rows: int, seconds: float):
+        with self._lock:
+            symbol_state = self.state[symbol]
+            symbol_state['completed_windows'].append(window_start)
+            symbol_state['rows'] += rows
+            symbol_state['seconds'] += seconds
+            symbol_state['failures'].pop(str(window_start), None)
+            self.__save()
+
+    def clear_window_failure(self, symbol: str, window_start: float):
+        with self._lock:
+            if self.state[symbol]['failures'].pop(str(window_start), None) is not None:
+                self.__save()
+
+    def mark_window_failed(self, symbol: str, window_start: float, error: str):
+        with self._lock:
+            self.state[symbol]['failures'][str(window_start)] = error
+            self.__save()
+
+    def __save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+class BackfillJobManager:
+    """
+    Runs resumable backfills of price_data or funding_data.
+    Each symbol's missing range is split into epoch-aligned, single-request windows (see #split_time_windows).
+    Windows are fetched by a pool of threads, retried with exponential backoff on failure, upserted into the DB
+    and checkpointed as they complete - rerunning the same job (same checkpoint file) only fetches the windows
+    that haven't been written yet.
+    """
+    def __init__(self, rest_client, table: str, checkpoint_path: str, resolution: str = '1h',
+                 num_workers: int = 8, max_retries: int = 5, backoff: float = 1.0):
+        """
+        :param rest_client: a WrappedFtxClient (give it a rate_limiter to cap the request rate across workers)
+        :param table: either price_data or funding_data
+        :param checkpoint_path: the local file to persist progress to
+        :param resolution: the price resolution to backfill (a key of RESOLUTIONS_MAP, ignored for funding)
+        :param num_workers: the number of windows fetched & written concurrently
+        :param max_retries: the max number of retries for each window before it's recorded as failed
+        :param backoff: seconds to wait before the first retry of a window, doubling on each further retry
+        """
+        if table not in ('price_data', 'funding_data'):
+            raise Exception(f'Unable to backfill {table}')
+        self.rest_client = rest_client
+        self.table = table
+        self.checkpoint = BackfillCheckpoint(checkpoint_path)
+        self.resolution = resolution
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.engine = db.create_engine(Config.get_property("SQL_URI").unwrap())
+        if table == 'price_data':
+            self.period = RESOLUTIONS_MAP[resolution]
+            self.window_seconds = self.period * FTX_CANDLES_PAGE_LIMIT
+        else:
+            self.period = 60 * 60
+            self.window_seconds = self.period * FTX_FUNDING_RATES_PAGE_LIMIT
+
+    def run(self, symbols: typing.List[str], until_ts: typing.Dict[str, pd.Timestamp] = None) -> typing.Dict[str, dict]:
+        """
+        Backfills every symbol, resuming from the checkpoint where one exists.
+        :param symbols: the market names to backfill
+        :param until_ts: a dict of symbol -> last recorded timestamp, used as the start of a symbol's range the first
+        time it's backfilled (symbols without one start at FTX_HISTORY_START)
+        :return: a summary of symbol -> {rows, seconds, windows, remaining, failures}
+        """
+        until_ts = until_ts or {}
+        now = time.time()
+        tasks = []
+        for symbol in symbols:
+            last_ts = until_ts.get(symbol)
+            since = last_ts.value / 1e9 + self.period if last_ts is not None else FTX_HISTORY_START
+            symbol_state = self.checkpoint.symbol_state(symbol, since)
+            completed = set(symbol_state['completed_windows'])
+            for (start, end) in split_time_windows(symbol_state['since'], now, self.window_seconds):
+                if start not in completed:
+                    tasks.append((symbol, start, end, now))
+        print(f'Backfilling {self.table}: {len(tasks)} windows pending across {len(symbols)} symbols')
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            list(pool.map(lambda task: self.__run_window(*task), tasks))
+        db_accessor.DbAccessor.bump_table_versions(self.table)
+        return self.summary(symbols, now)
+
+    def __run_window(self, symbol: str, start: float, end: float, now: float):
+        window_start_time = time.time()
+        try:
+            df = retry(self.__fetch_and_write_window, retries=self.max_retries, backoff=self.backoff,
+                       symbol=symbol, start=start, end=end)
+        except Exception as e:
+            print(f'Failed backfilling {symbol} [{start}, {end}): {repr(e.__cause__ or e)}')
+            self.checkpoint.mark_window_failed(symbol, start, repr(e.__cause__ or e))
+            return
+        # The most recent window is still filling up, so it's only checkpointed once it's fully in the past
+        if end < now - self.period:
+            self.checkpoint.mark_window_done(symbol, start, len(df), time.time() - window_start_time)
+        else:
+            self.checkpoint.clear_window_failure(symbol, start)
+
+    def __fetch_and_write_window(self, symbol: str, start: float, end: float) -> pd.DataFrame:
+        if self.table == 'price_data':
+            df = self.rest_client.fetch_price_window(symbol, self.resolution, start, end)
+        else:
+            df = self.rest_client.fetch_funding_window(symbol, start, end)
+        if len(df):
+            df.to_sql(self.table, con=self.engine, if_exists='append', index=False, chunksize=5000,
+                      method=db_accessor.upsert_method(db_accessor.UPSERT_KEYS[self.table]))
+        return df
+
+    def summary(self, symbols: typing.List[str], now: float = None) -> typing.Dict[str, dict]:
+        """
+        Prints & returns the progress of each symbol in this backfill.
+        """
+        now = now or time.time()
+        report = {}
+        for symbol in symbols:
+            symbol_state = self.checkpoint.state.get(symbol)
+            if symbol_state is None:
+                continue
+            windows = split_time_windows(symbol_state['since'], now, self.window_seconds)
+            report[symbol] = {
+                'rows': symbol_state['rows'],
+                'seconds': symbol_state['seconds'],
+                'windows': len(windows),
+                'remaining': len([w for w in windows if w[0] not in set(symbol_state['completed_windows'])]),
+                'failures': dict(symbol_state['failures']),
+            }
+            print(f"{symbol}: {report[symbol]['rows']} rows in {report[symbol]['seconds']:.1f}s, "
+                  f"{report[symbol]['windows'] - report[symbol]['remaining']}/{report[symbol]['windows']} windows "
+                  f"done, {len(report[symbol]['failures'])} failed")
+        return report
@@ -1,19 +1,93 @@
 from datetime import datetime
 
 import sqlalchemy as db
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.sql import text
+from sqlalchemy.sql.elements import TextClause
 import sys, os
+import threading
 
 sys.path.insert(0, os.path.abspath('..'))
 from models.position import Position
 from models.order_data import OrderData
+from models.fill_event import FillEvent
+from models.input_series import InputSeries
+from accessors.query_cache import QueryCache, cached_query, bump_table_versions
 from config import Config
 import pandas as pd
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 class DbWriteException(BaseException):
     pass
 
+
+def multi_row_insert(table: str, columns: List[str], rows: List[dict], suffix: str = '') -> Tuple[TextClause, dict]:
+    """
+    Builds a single multi-row INSERT statement for a list of rows. Every value is passed as a bind parameter
+    (named {column}_{row index}) rather than being interpolated into the SQL string.
+    :param table: the table to insert into
+    :param columns: the columns to insert, in order - every row must provide a value for each
+    :param rows: a list of dicts keyed by column name
+    :param suffix: optional trailing SQL (e.g. RETURNING id)
+    :return: a tuple of (query, bind parameters)
+    """
+    params = {}
+    values = []
+    for idx, row in enumerate(rows):
+        placeholders = []
+        for column in columns:
+            key = f"{column}_{idx}"
+            params[key] = row[column]
+            placeholders.append(f":{key}")
+        values.append(f"({', '.join(placeholders)})")
+    column_names = ", ".join([f'"{column}"' for column in columns])
+    return text(f"INSERT INTO {table} ({column_names}) VALUES {', '.join(values)} {suffix}"), params
+
+# The natural key of each ingested series table (see the uq_*_series_timestamp constraints)
+UPSERT_KEYS = {
+    'price_data': ['exchange', 'base', 'quote', 'product_type', 'expiry_date', 'resolution', 'timestamp'],
+    'funding_data': ['exchange', 'future', 'timestamp'],
+}
+
+
+def upsert_method(conflict_columns: List[str], update: bool = True):
+    """
+    Creates a `method` for DataFrame#to_sql that writes rows with INSERT ... ON CONFLICT, so re-ingesting rows that
+    already exist (e.g. rerunning an interrupted backfill) doesn't create duplicates.
+    :param conflict_columns: the columns of the table's unique constraint
+    :param update: if true, existing rows are overwritten with the new values (DO UPDATE), otherwise left as-is
+    (DO NOTHING)
+    :return: a callable suitable for DataFrame#to_sql(method=...)
+    """
+    def method(pd_table, conn, keys, data_iter):
+        rows = [dict(zip(keys, row)) for row in data_iter]
+        # A statement can't upsert the same key twice, so only the last row for each key is kept
+        rows = list({tuple(row[column] for column in conflict_columns): row for row in rows}.values())
+        if not rows:
+            return 0
+        stmt = postgresql.insert(pd_table.table).values(rows)
+        update_columns = {k: stmt.excluded[k] for k in keys if k not in conflict_columns}
+        if update and update_columns:
+            stmt = stmt.on_conflict_do_update(index_elements=conflict_columns, set_=update_columns)
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+        return conn.execute(stmt).rowcount
+    return method
+
+
+STRATEGY_QUEUE_COLUMNS = 'id, timestamp, strategy, quote, base, exchange, product_type, "group", relative_size, trace_id'
+STRATEGY_QUEUE_INSERT_COLUMNS = ['timestamp', 'strategy', 'group', 'quote', 'base', 'exchange', 'product_type',
+                                 'relative_size', 'trace_id']
+
+
+def row_to_position(x) -> Position:
+    """
+    Maps a strategy_queue row (selected as STRATEGY_QUEUE_COLUMNS) onto a Position.
+    """
+    return Position(id=x[0], timestamp=pd.to_datetime(x[1]), strategy=x[2], quote=x[3], base=x[4], exchange=x[5],
+                    product_type=x[6], group=x[7], relative_size=x[8], trace_id=x[9])
+
+
 """
 Simple wrapper class for supporting DB queries via SQL Alchemy
 (this actually just mostly ignores SQL alchemy and runs raw SQL)
@@ -21,18 +95,49 @@ Simple wrapper class for supporting DB queries via SQL Alchemy
 class DbAccessor:
     metadata = db.MetaData()
     engine = db.create_engine(Config.get_property("SQL_URI").unwrap())
-    connection = engine.connect()
+    _local = threading.local()
+
+    def __init__(self, query_cache: QueryCache = None):
+        """
+        :param query_cache: an optional QueryCache - if provided, read methods are served from it until one of the
+        tables they read is written to (the same cache can be shared between accessors)
+        """
+        self.query_cache = query_cache
+
+    @property
+    def connection(self) -> db.engine.Connection:
+        """
+        The calling thread's connection. Connections aren't thread safe, and executors may share a process (see
+        executors/pipeline.py) or handle messages on a thread pool, so each thread checks out its own from the engine's
+        pool.
+        """
+        connection = getattr(DbAccessor._local, 'connection', None)
+        if connection is None or connection.closed:
+            connection = DbAccessor._local.connection = self.engine.connect()
+        return connection
 
-    def get_symbol_last_prices(self) -> List[Tuple]:
+    @staticmethod
+    def bump_table_versions(*tables: str):
+        """
+        Invalidates cached reads of the given tables, for writes that don't go through this accessor
+        (e.g. bulk ingestion via DataFrame#to_sql).
+        """
+        bump_table_versions(*tables)
+
+    @cached_query('price_data')
+    def get_symbol_last_prices(self, resolution: int = None) -> List[Tuple]:
         """
         Returns the last timestamp for all symbol-product_type-exchange pairs, largely to determine what the last recorded data was for update jobs for prices.
+        :param resolution: only consider price data of this resolution (in seconds, see RESOLUTIONS_MAP), or all if None
         :return: returns a list of (base, quote, product_type, exchange, max_timestamp) for all symbols
         """
+        resolution_clause = "where resolution = :resolution" if resolution is not None else ""
         query = text(
-            """select base, quote, product_type, exchange, max(timestamp) from price_data group by base, quote, product_type, exchange;""")
-        rs = self.connection.execute(query).fetchall()
+            f"""select base, quote, product_type, exchange, max(timestamp) from price_data {resolution_clause} group by base, quote, product_type, exchange;""")
+        rs = self.connection.execute(query, resolution=resolution).fetchall()
         return rs
 
+    @cached_query('funding_data')
     def get_symbol_last_funding(self) -> List[Tuple]:
         """
         Returns the last timestamp for all future-exchange pairs, largely to determine what the last recorded data was for update jobs for funding.
@@ -42,6 +147,29 @@ class DbAccessor:
         rs = self.connection.execute(query).fetchall()
         return rs
 
+    def get_series_watermarks(self, series: List[InputSeries]) -> Dict[InputSeries, Optional[pd.Timestamp]]:
+        """
+        Returns the watermark of each series - the latest fetch_time ingested into it - in a single query. These are
+        never cached, as ingestion usually happens in another process (funding & per-resolution price watermarks are
+        index lookups, see the ix_*_fetch_time indexes).
+        :param series: the series to look up
+        :return: series -> watermark (None for a series without any rows)
+        """
+        series = list(dict.fromkeys(series))
+        if not series:
+            return {}
+        selects = []
+        params = {}
+        for idx, input_series in enumerate(series):
+            resolution_clause = f"where resolution = :resolution_{idx}" if input_series.resolution is not None else ""
+            selects.append(f"(select max(fetch_time) from {input_series.table} {resolution_clause}) AS watermark_{idx}")
+            params[f"resolution_{idx}"] = input_series.resolution
+        query = text(f"SELECT {', '.join(selects)}")
+        row = self.connection.execute(query, **params).fetchone()
+        return {input_series: (pd.to_datetime(watermark) if watermark is not None else None)
+                for (input_series, watermark) in zip(series, row)}
+
+    @cached_query('price_data')
     def get_full_history_price_data_for_symbol_and_exchange(self, exchange: str, quote: str, base: str, product_type: str = 'SPOT') -> List[Tuple]:
         """
         Retrieves the full available price data for a specific (base, quote, product_type, exchange) - e.g.
@@ -59,6 +187,7 @@ class DbAccessor:
                                     product_type=product_type).fetchall()
         return result
 
+    @cached_query('price_data')
     def get_price_data_since(self, date_cutoff: pd.Timestamp) -> List[Tuple]:
         """
         Get all price data of all assets since a specific datetime.
@@ -71,6 +200,7 @@ class DbAccessor:
         result = self.connection.execute(query, date_cutoff=str(date_cutoff)).fetchall()
         return result
 
+    @cached_query('funding_data')
     def get_funding_data_since(self, date_cutoff: pd.Timestamp) -> List[Tuple]:
         """
         Get all price data of all asset funding data since a specific datetime.
@@ -84,38 +214,132 @@ class DbAccessor:
         return result
 
     def write_successful_fill(self, order_data: OrderData) -> pd.Timestamp:
+        """
+        Writes a single fill to the `fills` table.
+        :param order_data: the OrderData for a completed order
+        :return: the timestamp for insertion of the fill
+        """
+        return self.write_batch(order_datas=[order_data], position_ids=[])
+
+    def write_batch(self, order_datas: List[OrderData], position_ids: List,
+                    trace_ids: List[Optional[str]] = None) -> pd.Timestamp:
+        """
+        Writes a batch of fills and marks a batch of strategy positions as filled inside a single transaction -
+        either everything in the batch is committed, or nothing is.
+        Fills are written as one parameterized multi-row insert (plus one for all of their child fill_events), so the
+        cost is a fixed number of round-trips per batch rather than one per fill.
+        :param order_datas: a list of OrderData objects to insert into `fills`
+        :param position_ids: a list of strategy_queue ids to mark as processed
+        :param trace_ids: the trace_id to record on each fill, in order_datas order (see utils/tracing.py)
+        :return: the timestamp for insertion of the batch
+        """
         insert_ts = datetime.now()
-        query = text(
-            OrderData.to_insert(order_data, "fills")
-        )
-        rs = self.connection.execute(query)
+        try:
+            with self.connection.begin():
+                if order_datas:
+                    self.__insert_fills(order_datas, trace_ids)
+                if position_ids:
+                    self.__mark_strategy_filled(position_ids, processed_ts=insert_ts)
+        except Exception as e:
+            raise DbWriteException(e)
+        # A rolled back batch changed nothing, so cached reads are only invalidated once it has committed
+        if order_datas:
+            bump_table_versions('fills', 'fill_events')
+        if position_ids:
+            bump_table_versions('strategy_queue')
         return insert_ts
 
-    def write_new_strategy_positions(self, positions: List[Position]) -> pd.Timestamp:
+    def write_new_strategy_positions(self, positions: List[Position], trace_id: str = None) -> pd.Timestamp:
         """
-        Writes a list of positions returned from a strategy run to the strategy_queue table.
+        Writes a list of positions returned from strategy runs to the strategy_queue table.
         This is read for strategy execution, and essentially takes the output of a strategy and preps it to be executed
         in a given exchange.
+        Every position is written in a single parameterized multi-row insert, so a cycle's positions across all
+        strategies cost one round-trip.
         :param positions: a list of Position objects representing our strategy output
+        :param trace_id: the trace of the strategy run (see utils/tracing.py), for positions without their own
         :return: the timestamp for insertion of our strategy Positions
         """
         insert_ts = datetime.now()
-        def convert_to_tuples(x: Position) -> str:
-            """
-            Simple helper method to convert the position object into an SQL string. This is slightly more performant and infinitely
-            more buggy than properly using the ORM.
-            :param x: the Position object
-            :return: an SQL-compliant string for inserts
+        if not positions:
+            return insert_ts
+        rows = [{'timestamp': insert_ts, 'strategy': position.strategy, 'group': position.group,
+                 'quote': position.quote, 'base': position.base, 'exchange': position.exchange,
+                 'product_type': position.product_type, 'relative_size': float(position.relative_size),
+                 'trace_id': position.trace_id if position.trace_id is not None else trace_id}
+                for position in positions]
+        query, params = multi_row_insert("strategy_queue", STRATEGY_QUEUE_INSERT_COLUMNS, rows)
+        self.connection.execute(query, **params)
+        bump_table_versions('strategy_queue')
+        return insert_ts
+
+    def __insert_fills(self, order_datas: List[OrderData], trace_ids: List[Optional[str]] = None):
+        # Reserve the parent ids up front so each order's fill_events can reference its row without
+        # relying on the ordering of INSERT ... RETURNING
+        fill_ids = [row[0] for row in self.connection.execute(
+            text("SELECT nextval(pg_get_serial_sequence('fills', 'id')) FROM generate_series(1, :n)"),
+            n=len(order_datas)
+        ).fetchall()]
+        fill_rows = []
+        event_rows = []
+        trace_ids = trace_ids if trace_ids is not None else [None] * len(order_datas)
+        for fill_id, order_data, trace_id in zip(fill_ids, order_datas, trace_ids):
+            fill_rows.append({'id': fill_id, **OrderData.to_insert_params(order_data), 'trace_id': trace_id})
+            event_rows += [FillEvent.to_insert_params(event, fill_id) for event in OrderData.to_fill_events(order_data)]
+        query, params = multi_row_insert("fills", ['id'] + OrderData.columns() + ['trace_id'], fill_rows)
+        self.connection.execute(query, **params)
+        if event_rows:
+            query, params = multi_row_insert("fill_events", ['fill_id'] + FillEvent.columns(), event_rows)
+            self.connection.execute(query, **params)
+
+    @cached_query('fill_events', 'fills')
+    def get_execution_quality_by_market(self, since: pd.Timestamp = None) -> List[Tuple]:
+        """
+        Aggregates execution quality per market from fill_events, relative to the best price seen when each order
+        was placed. Slippage is signed so that a positive value is always a cost (bought above / sold below best).
+        :param since: only include fills at or after this time (None for all fills)
+        :return: a list of (market, orders, fills, notional, slippage_ratio, fees, fee_ratio, maker_ratio), where
+        slippage_ratio is notional-weighted, ordered by notional traded
+        """
+        since_clause = "WHERE e.time >= :since" if since is not None else ""
+        query = text(
+            f"""
+                SELECT e.market,
+                       count(DISTINCT e.fill_id) AS orders,
+                       count(*) AS fills,
+                       sum(e.price * e.size) AS notional,
+                       sum(e.price * e.size * (e.price / f.best_price - 1) * CASE WHEN e.side = 'sell' THEN -1 ELSE 1 END)
+                           / nullif(sum(e.price * e.size), 0) AS slippage_ratio,
+                       sum(e.fee) AS fees,
+                       sum(e.fee) / nullif(sum(e.price * e.size), 0) AS fee_ratio,
+                       avg(CASE WHEN e.liquidity = 'maker' THEN 1.0 ELSE 0.0 END) AS maker_ratio
+                FROM fill_events e JOIN fills f ON f.id = e.fill_id
+                {since_clause}
+                GROUP BY e.market
+                ORDER BY notional DESC
             """
-            to_str = lambda x: f"'{x}'"
-            pos = ",".join(list(map(to_str, [str(insert_ts), x.strategy, x.group, x.quote, x.base, x.exchange, x.product_type, str(x.relative_size)])))
-            return f'({pos})'
+        )
+        return self.connection.execute(query, since=since).fetchall()
 
+    @cached_query('fill_events')
+    def get_fees_by_market(self, since: pd.Timestamp = None) -> List[Tuple]:
+        """
+        Aggregates fees paid per market & liquidity type (maker/taker) from fill_events.
+        :param since: only include fills at or after this time (None for all fills)
+        :return: a list of (market, liquidity, fills, notional, fees, effective_fee_rate)
+        """
+        since_clause = "WHERE time >= :since" if since is not None else ""
         query = text(
-            f'INSERT INTO strategy_queue(timestamp, strategy, "group", quote, base, exchange, product_type, relative_size) VALUES {",".join([convert_to_tuples(position) for position in positions])}'
+            f"""
+                SELECT market, liquidity, count(*) AS fills, sum(price * size) AS notional, sum(fee) AS fees,
+                       sum(fee) / nullif(sum(price * size), 0) AS effective_fee_rate
+                FROM fill_events
+                {since_clause}
+                GROUP BY market, liquidity
+                ORDER BY market, liquidity
+            """
         )
-        rs = self.connection.execute(query)
-        return insert_ts
+        return self.connection.execute(query, since=since).fetchall()
 
     def mark_strategy_filled(self, position_ids: List) -> List[Tuple]:
         """
@@ -125,32 +349,87 @@ class DbAccessor:
         """
         if not position_ids:
             raise Exception('Positions must be provided')
-        print(position_ids)
-        ids = ", ".join([str(i) for i in position_ids])
-        processed_ts = datetime.now()
-        query = text(
-            f"UPDATE strategy_queue SET processed_timestamp=:processed_ts where id in ({ids})"
-        )
         try:
-            rs = self.connection.execute(query, processed_ts=processed_ts, ids=ids)
-            return rs
+            return self.__mark_strategy_filled(position_ids, processed_ts=datetime.now())
         except Exception as e:
             raise DbWriteException(e)
+        finally:
+            bump_table_versions('strategy_queue')
+
+    def __mark_strategy_filled(self, position_ids: List, processed_ts: datetime):
+        query = text(
+            "UPDATE strategy_queue SET processed_timestamp=:processed_ts where id = ANY(:ids)"
+        )
+        return self.connection.execute(query, processed_ts=processed_ts, ids=[int(i) for i in position_ids])
 
+    @cached_query('strategy_queue')
     def fetch_unfilled_strategies(self) -> List[Position]:
         """
         Returns all strategy positions in queue that have not been processed (waiting to execute).
+        Note this does not claim anything - use #claim_batch when more than one executor may be reading the queue.
         :return: A list of positions to execute
         """
-        to_pos = lambda x: Position(id=x[0], timestamp=pd.to_datetime(x[1]), strategy=x[2], quote=x[3], base=x[4], exchange=x[5], product_type=x[6], group=x[7], relative_size=x[8])
         query = text(
-            """
-                SELECT * from strategy_queue
+            f"""
+                SELECT {STRATEGY_QUEUE_COLUMNS} from strategy_queue
                     where processed_timestamp is NULL
             """
         )
         rs = self.connection.execute(query).fetchall()
-        return list(map(to_pos, rs))
+        return list(map(row_to_position, rs))
+
+    def claim_batch(self, strategy: str = None, limit: int = None, worker_id: str = None,
+                    lease_seconds: int = 300) -> List[Position]:
+        """
+        Claims unprocessed strategy positions for a single executor, so that several position executors can poll
+        strategy_queue concurrently without double-executing positions.
+        Rows locked by another claimer are skipped (FOR UPDATE SKIP LOCKED) rather than waited on, and a claim is a
+        lease - if the claimer dies before the rows are marked filled, they become claimable again once
+        lease_expires_at has passed.
+        :param strategy: only claim positions for this strategy (None claims across all strategies)
+        :param limit: the max number of positions to claim (None claims everything available)
+        :param worker_id: an identifier for the claimer, recorded in claimed_by
+        :param lease_seconds: how long the claim is held before other executors may take the positions over
+        :return: A list of claimed positions to execute
+        """
+        strategy_clause = "and strategy = :strategy" if strategy is not None else ""
+        limit_clause = "LIMIT :limit" if limit is not None else ""
+        query = text(
+            f"""
+                UPDATE strategy_queue
+                    SET claimed_by = :worker_id,
+                        lease_expires_at = LOCALTIMESTAMP + make_interval(secs => :lease_seconds)
+                    WHERE id IN (
+                        SELECT id from strategy_queue
+                            where processed_timestamp is NULL
+                            and (lease_expires_at is NULL or lease_expires_at < LOCALTIMESTAMP)
+                            {strategy_clause}
+                            ORDER BY id
+                            {limit_clause}
+                            FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING {STRATEGY_QUEUE_COLUMNS}
+            """
+        )
+        with self.connection.begin():
+            rs = self.connection.execute(query, strategy=strategy, limit=limit, worker_id=worker_id,
+                                         lease_seconds=lease_seconds).fetchall()
+        bump_table_versions('strategy_queue')
+        return sorted(map(row_to_position, rs), key=lambda p: p.id)
+
+    def release_claim(self, position_ids: List):
+        """
+        Releases the lease on claimed (but unprocessed) positions so they can be claimed again immediately.
+        :param position_ids: the ids of previously claimed positions
+        """
+        query = text(
+            """
+                UPDATE strategy_queue SET claimed_by = NULL, lease_expires_at = NULL
+                    where id = ANY(:ids) and processed_timestamp is NULL
+            """
+        )
+        self.connection.execute(query, ids=[int(i) for i in position_ids])
+        bump_table_versions('strategy_queue')
 
 if __name__ == '__main__':
     position = Position(
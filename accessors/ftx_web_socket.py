@@ -256,13 +256,6 @@ class FtxWebsocketClient(WebsocketManager):
             self._subscribe(subscription)
         return self._tickers[market]
 
-    def on_ticker_update(self, tickers):
-        c = []
-        for t in tickers.keys():
-            if not len(tickers[t]):
-                c.append(t)
-        print(c)
-
     def _handle_orderbook_message(self, message: Dict) -> None:
         market = message['market']
         subscription = {'channel': 'orderbook', 'market': market}
@@ -302,7 +295,6 @@ class FtxWebsocketClient(WebsocketManager):
 
     def _handle_ticker_message(self, message: Dict) -> None:
         self._tickers[message['market']] = message['data']
-        self.on_ticker_update(self._tickers)
         self.channel_event_handlers['ticker'](message)
 
     def _handle_fills_message(self, message: Dict) -> None:
@@ -0,0 +1,190 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import typing
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from accessors.db_accessor import DbAccessor
+from models.input_series import InputSeries
+from utils.utils import convert_to_log_returns, reorg_to_market_returns
+
+"""
+A per-cycle snapshot of the market data strategies read, shared between processes through memory-mapped files.
+MarketDataSnapshotService loads price & funding history from the DB once, builds the wide returns, close & funding
+matrices, and writes them as .npy files; strategies (in any process) attach to the latest snapshot with
+MarketDataSnapshot#attach, getting read-only, zero-copy views of the matrices rather than each querying the DB.
+Every refresh is written to a new version directory, and the `CURRENT` file pointing at it is swapped atomically -
+so readers always see a complete snapshot, and one attached before a refresh stays valid (mapped files outlive
+their deletion) until it's reattached. The default directory lives on /dev/shm where available, so the files are
+backed by memory.
+"""
+
+DEFAULT_SNAPSHOT_DIRECTORY: typing.Final = os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'market_data_snapshot')
+CURRENT_FILE: typing.Final = 'CURRENT'
+# Column order of the price_data & funding_data tables (see alembic/versions/b94b3b80997e_create_ftx_prices.py)
+PRICE_DATA_COLUMNS: typing.Final = ['timestamp', 'exchange', 'fetch_time', 'resolution', 'open', 'high', 'low',
+                                    'close', 'quote_volume', 'quote', 'base', 'product_type', 'expiry_date']
+FUNDING_DATA_COLUMNS: typing.Final = ['timestamp', 'future', 'exchange', 'fetch_time', 'funding_rate', 'symbol']
+MATRICES: typing.Final = ('returns', 'close', 'funding')
+
+
+class MarketDataSnapshot:
+    """
+    A read-only view of a snapshot's matrices:
+    - returns: log returns of each base's open price, (time x base) with the market base in the first column (see
+    utils.utils#convert_to_log_returns & #reorg_to_market_returns)
+    - close: close prices, aligned with returns
+    - funding: funding rates, (funding time x future)
+    """
+    def __init__(self, directory: str, version: str):
+        self.directory = directory
+        self.version = version
+        path = os.path.join(directory, version)
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        for name in MATRICES:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        self.index = pd.to_datetime(np.load(os.path.join(path, 'index.npy')))
+        self.funding_index = pd.to_datetime(np.load(os.path.join(path, 'funding_index.npy')))
+        self.columns: typing.List[str] = self.meta['columns']
+        self.funding_columns: typing.List[str] = self.meta['funding_columns']
+
+    @staticmethod
+    def attach(directory: str = DEFAULT_SNAPSHOT_DIRECTORY) -> 'MarketDataSnapshot':
+        """
+        Attaches to the latest snapshot written to a directory.
+        """
+        return MarketDataSnapshot(directory, _current_version(directory))
+
+    def is_current(self) -> bool:
+        """
+        :return: whether this is still the latest snapshot (otherwise #attach again for fresh data)
+        """
+        return _current_version(self.directory) == self.version
+
+    def returns_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.returns, index=self.index, columns=self.columns, copy=False)
+
+    def close_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.close, index=self.index, columns=self.columns, copy=False)
+
+    def funding_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.funding, index=self.funding_index, columns=self.funding_columns, copy=False)
+
+
+class MarketDataSnapshotService:
+    """
+    Builds snapshots from the DB. #refresh is meant to be called once per cycle (e.g. by MultiStrategyExecutor
+    before running strategies): it only rebuilds the snapshot when the price or funding watermarks have moved since
+    the last one (see DbAccessor#get_series_watermarks).
+    """
+    def __init__(self, directory: str = DEFAULT_SNAPSHOT_DIRECTORY, db_accessor: DbAccessor = None,
+                 market: str = 'BTC', resolution: int = 3600, product_type: str = 'SPOT', exchange: str = 'FTX',
+                 lookback: pd.Timedelta = pd.Timedelta(days=30), keep_versions: int = 2):
+        """
+        :param directory: where snapshots are written
+        :param market: the base used as market returns (the first returns column)
+        :param resolution: the price resolution to load (in seconds, see RESOLUTIONS_MAP)
+        :param product_type: the price product type to load
+        :param exchange: the exchange to load prices & funding from
+        :param lookback: how much history to load
+        :param keep_versions: the number of snapshot versions kept on disk
+        """
+        self.directory = directory
+        self.db_accessor = db_accessor if db_accessor is not None else DbAccessor()
+        self.market = market
+        self.resolution = resolution
+        self.product_type = product_type
+        self.exchange = exchange
+        self.lookback = lookback
+        self.keep_versions = keep_versions
+        self.series = [InputSeries('price_data', resolution), InputSeries('funding_data')]
+
+    def refresh(self, force: bool = False) -> str:
+        """
+        Rebuilds the snapshot if new data has been ingested since the current one was built.
+        :param force: rebuild regardless of the watermarks
+        :return: the current snapshot version
+        """
+        watermarks = self.__watermarks()
+        version = _current_version(self.directory) \
+            if os.path.exists(os.path.join(self.directory, CURRENT_FILE)) else None
+        if version is not None and not force:
+            with open(os.path.join(self.directory, version, 'meta.json')) as f:
+                if json.load(f)['watermarks'] == watermarks:
+                    return version
+        return self.build(watermarks)
+
+    def build(self, watermarks: typing.Dict[str, typing.Optional[str]] = None) -> str:
+        """
+        Loads the data, writes it as a new snapshot version & makes it current. Matrices without any data in the
+        lookback window (e.g. no prices for the market) are written empty.
+        :return: the new version
+        """
+        start = time.time()
+        watermarks = watermarks if watermarks is not None else self.__watermarks()
+        since = pd.Timestamp.utcnow().tz_localize(None) - self.lookback
+        prices = pd.DataFrame(self.db_accessor.get_price_data_since(since), columns=PRICE_DATA_COLUMNS)
+        prices = prices[(prices['resolution'] == self.resolution) & (prices['product_type'] == self.product_type)
+                        & (prices['exchange'] == self.exchange)]
+        if (prices['base'] == self.market).any():
+            returns = reorg_to_market_returns(convert_to_log_returns(prices.rename(
+                columns={'base': 'quote', 'quote': 'quote_unit', 'timestamp': 'time_period_start', 'open': 'px_open'})),
+                self.market)
+            close = prices.pivot_table(columns='base', index='timestamp', values='close', aggfunc='mean') \
+                .reindex(index=returns.index, columns=returns.columns)
+        else:
+            # Returns are laid out around the market's, so without its prices there's nothing to build them from
+            print(f'No {self.market} prices since {since}, writing empty returns & close matrices')
+            returns = close = _empty_frame()
+        funding = pd.DataFrame(self.db_accessor.get_funding_data_since(since), columns=FUNDING_DATA_COLUMNS)
+        funding = funding[funding['exchange'] == self.exchange]
+        funding = funding.pivot_table(columns='future', index='timestamp', values='funding_rate', aggfunc='mean') \
+            if len(funding) else _empty_frame()
+
+        version = f'{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}'
+        path = os.path.join(self.directory, version)
+        os.makedirs(path)
+        for (name, frame) in (('returns', returns), ('close', close), ('funding', funding)):
+            np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(frame.to_numpy(dtype=np.float64)))
+        np.save(os.path.join(path, 'index.npy'), returns.index.values.astype('datetime64[ns]'))
+        np.save(os.path.join(path, 'funding_index.npy'), funding.index.values.astype('datetime64[ns]'))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'columns': list(returns.columns), 'funding_columns': list(funding.columns),
+                       'market': self.market, 'resolution': self.resolution, 'product_type': self.product_type,
+                       'exchange': self.exchange, 'watermarks': watermarks, 'built_at': time.time()}, f)
+        tmp_path = os.path.join(self.directory, f'{CURRENT_FILE}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, os.path.join(self.directory, CURRENT_FILE))
+        self.__remove_old_versions()
+        print(f'Built market data snapshot {version} ({returns.shape[0]} x {returns.shape[1]} returns, '
+              f'{funding.shape[0]} x {funding.shape[1]} funding) in {time.time() - start:.2f}s')
+        return version
+
+    def __watermarks(self) -> typing.Dict[str, typing.Optional[str]]:
+        watermarks = self.db_accessor.get_series_watermarks(self.series)
+        return {f'{series.table}:{series.resolution}': (None if watermark is None else watermark.isoformat())
+                for (series, watermark) in watermarks.items()}
+
+    def __remove_old_versions(self):
+        versions = sorted([name for name in os.listdir(self.directory)
+                           if os.path.isdir(os.path.join(self.directory, name))])
+        # Processes still attached to a removed version keep their mapping
+        for version in versions[:-self.keep_versions]:
+            shutil.rmtree(os.path.join(self.directory, version), ignore_errors=True)
+
+
+def _current_version(directory: str) -> str:
+    with open(os.path.join(directory, CURRENT_FILE)) as f:
+        return f.read().strip()
+
+
+def _empty_frame() -> pd.DataFrame:
+    return pd.DataFrame(index=pd.DatetimeIndex([]), columns=pd.Index([], dtype=object), dtype=np.float64)
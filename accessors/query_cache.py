@@ -0,0 +1,114 @@
+import functools
+import threading
+import time
+import typing
+from collections import OrderedDict, defaultdict
+
+"""
+Opt-in read-through cache for DbAccessor queries.
+Every table has a write version counter, bumped by the accessor's own write methods (see #bump_table_versions).
+A cached result remembers the versions of the tables it read from and is discarded as soon as any of them moves,
+so repeated reads cost a dict lookup until the underlying data actually changes.
+The counters are per-process: writes made by other processes (e.g. a separate DbWriterExecutor) are only picked
+up once an entry is older than the cache's max_age.
+"""
+
+_TABLE_VERSIONS: typing.DefaultDict[str, int] = defaultdict(int)
+_VERSIONS_LOCK = threading.Lock()
+_MISS = object()
+
+
+def bump_table_versions(*tables: str):
+    """
+    Marks the given tables as written to, invalidating any cached reads of them.
+    """
+    with _VERSIONS_LOCK:
+        for table in tables:
+            _TABLE_VERSIONS[table] += 1
+
+
+def get_table_versions(tables: typing.Iterable[str]) -> typing.Tuple[int, ...]:
+    with _VERSIONS_LOCK:
+        return tuple(_TABLE_VERSIONS[table] for table in tables)
+
+
+class QueryCache:
+    """
+    An LRU cache of query results, bounded both by number of entries and by total number of rows held.
+    :param max_entries: the max number of distinct queries to hold
+    :param max_rows: the max total rows across all entries (a result larger than this is never cached)
+    :param max_age: seconds after which an entry is refetched regardless of version counters (None to disable)
+    """
+    def __init__(self, max_entries: int = 256, max_rows: int = 1_000_000, max_age: typing.Optional[float] = 5.0):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._entries: OrderedDict = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Hashable, tables: typing.Tuple[str, ...]) -> typing.Any:
+        versions = get_table_versions(tables)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return _MISS
+            entry_versions, inserted_at, rows, value = entry
+            if entry_versions != versions or (self.max_age is not None and time.time() - inserted_at > self.max_age):
+                self.__evict(key)
+                self.misses += 1
+                return _MISS
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: typing.Hashable, versions: typing.Tuple[int, ...], value: typing.Any):
+        rows = len(value) if hasattr(value, '__len__') else 1
+        if rows > self.max_rows:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.__evict(key)
+            self._entries[key] = (versions, time.time(), rows, value)
+            self._rows += rows
+            while len(self._entries) > self.max_entries or self._rows > self.max_rows:
+                self.__evict(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def __evict(self, key: typing.Hashable):
+        _, _, rows, _ = self._entries.pop(key)
+        self._rows -= rows
+
+
+def cached_query(*tables: str):
+    """
+    Decorator for DbAccessor read methods. When the accessor has a query_cache, results are cached by
+    (method, arguments) and invalidated whenever any of `tables` is written to.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            cache = getattr(self, 'query_cache', None)
+            if cache is None:
+                return func(self, *args, **kwargs)
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            try:
+                value = cache.get(key, tables)
+            except TypeError:
+                # Unhashable arguments can't be cached
+                return func(self, *args, **kwargs)
+            if value is _MISS:
+                # Snapshot versions before reading, so a write racing this read invalidates what we store
+                versions = get_table_versions(tables)
+                value = func(self, *args, **kwargs)
+                cache.put(key, versions, value)
+            return list(value) if isinstance(value, list) else value
+        return wrapper
+    return decorator
@@ -1,13 +1,19 @@
 from ftx import api
 import typing
+import functools
 import pandas as pd
 from collections import defaultdict
 from datetime import timedelta
 
 import multiprocess
+import queue as queue_lib
 import time
 import sys
-from utils.utils import pluck
+from utils.utils import pluck, split_time_windows
+from utils.rate_limiter import RateLimiter
+from models.column_chunk import ColumnChunk
+from accessors.async_ftx_fetcher import AsyncFtxHistoricalFetcher
+from accessors.backfill_manager import BackfillJobManager
 import sqlalchemy as db
 
 sys.path.append('..')
@@ -16,6 +22,11 @@ from config import Config
 from constants import *
 
 
+# Columns holding a single value for every row fetched for a symbol, sent once per chunk when streaming
+PRICE_DATA_CONSTANT_COLUMNS = ['exchange', 'resolution', 'fetch_time', 'base', 'quote', 'product_type', 'expiry_date']
+FUNDING_DATA_CONSTANT_COLUMNS = ['future', 'symbol', 'exchange', 'fetch_time']
+
+
 class WrappedFtxClient:
     def __init__(self, api_key: str = None, api_secret: str = None, subaccount_name: str = None):
         if api_key and not api_secret:
@@ -24,6 +35,12 @@ class WrappedFtxClient:
             raise Exception('Provided api_secret but not api_key')
         self.mode = 'private_enabled' if bool(api_key) and bool(api_secret) else 'public_only'
         self.client = api.FtxClient(api_key=api_key, api_secret=api_secret, subaccount_name=subaccount_name)
+        # Set inside update job workers so that every process shares the exchange's request budget
+        self.rate_limiter: typing.Optional[RateLimiter] = None
+
+    def __throttle(self):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
 
     def __gate_private_method(self):
         if self.mode == 'private_enabled':
@@ -205,15 +222,35 @@ class WrappedFtxClient:
         else:
             until = 1
         while True:
-            data = self.client.get_funding_rates(symbol, end_time=start)
-            if len(data) <= 1:
+            self.__throttle()
+            # end_time is inclusive, so the next page ends just before the first row of the last one
+            data = self.client.get_funding_rates(symbol, end_time=start - 1)
+            if not data:
                 break
             new_start = pd.to_datetime(pd.DataFrame(data)['time'].min())
             if start < until:
                 break
             results += data
             start = new_start.value / 1e9
-        df = pd.DataFrame(results).sort_values(by='time').set_index('time')
+        return self.__to_funding_frame(results, symbol, until_ts)
+
+    def fetch_funding_data_async(self, client, symbol: str, until_ts: pd.Timestamp = None,
+                                 concurrency: int = 16) -> pd.DataFrame:
+        """
+        Same output as #fetch_funding_data_since_beginning, but the missing time range is split into independent
+        page-sized windows which are fetched concurrently (see AsyncFtxHistoricalFetcher).
+        :param client: unused (kept so this can be passed as a read_func to #run_update_job)
+        :param symbol: a market name
+        :param until_ts: the last timestamp already recorded (None to fetch the full history)
+        :param concurrency: the max number of requests in flight at once
+        :return: a dataframe representing the new data fetched for funding
+        """
+        fetcher = AsyncFtxHistoricalFetcher(concurrency=concurrency, rate_limiter=self.rate_limiter)
+        results = fetcher.run(fetcher.fetch_funding_rates(symbol, since=self.__fetch_start(until_ts, 3600)))
+        return self.__to_funding_frame(results, symbol, until_ts)
+
+    def __to_funding_frame(self, results: typing.List[dict], symbol: str, until_ts: pd.Timestamp = None) -> pd.DataFrame:
+        df = pd.DataFrame(results).drop_duplicates(subset='time', keep='last').sort_values(by='time').set_index('time')
         df['future'] = symbol
         df['symbol'] = symbol.split('-')[0]
         df['exchange'] = 'FTX'
@@ -224,6 +261,13 @@ class WrappedFtxClient:
         df = df.rename(columns={"time": "timestamp", "rate": "funding_rate"})
         return df
 
+    @staticmethod
+    def __fetch_start(until_ts: typing.Optional[pd.Timestamp], resolution_seconds: int) -> float:
+        # The first period not yet recorded, or the start of FTX's history if nothing has been recorded yet
+        if until_ts:
+            return until_ts.value / 1e9 + resolution_seconds
+        return FTX_HISTORY_START
+
     def fetch_historical_data_since_beginning(self, client,
                                               symbol: str,
                                               resolution: str = '1h',
@@ -244,18 +288,50 @@ class WrappedFtxClient:
         else:
             until = 1
         while True:
-            data = client.get_historical_data(symbol, resolution=res, limit=10000, end_time=start)
-            if len(data) == 1:
+            self.__throttle()
+            # end_time is inclusive, so the next page ends just before the first row of the last one
+            data = client.get_historical_data(symbol, resolution=res, limit=10000, end_time=start - 1)
+            if not data:
                 break
             new_start = pd.to_datetime(data[0]['startTime'])
             if start < until:
                 break
             results += data
             start = new_start.value / 1e9
-        df = pd.DataFrame(results).sort_values(by='startTime').set_index('startTime')
+        return self.__to_price_frame(results, symbol, res, until_ts)
+
+    def fetch_historical_data_async(self, client,
+                                    symbol: str,
+                                    resolution: str = '1h',
+                                    until_ts: pd.Timestamp = None,
+                                    concurrency: int = 16,
+                                    ) -> pd.DataFrame:
+        """
+        Same output as #fetch_historical_data_since_beginning, but rather than paging backwards one request at a
+        time, the missing time range is split into independent page-sized windows (from the known resolution & page
+        limit) which are fetched concurrently and stitched back together in order.
+        :param client: unused (kept so this can be passed as a read_func to #run_update_job)
+        :param symbol: a market name
+        :param resolution: a key of RESOLUTIONS_MAP
+        :param until_ts: the last timestamp already recorded (None to fetch the full history)
+        :param concurrency: the max number of requests in flight at once
+        :return: a dataframe of the new candles
+        """
+        if not resolution in RESOLUTIONS_MAP:
+            raise Exception(
+                f"{resolution} not found in RESOLUTIONS_MAP. Available resolutions are: {list(RESOLUTIONS_MAP.keys())}")
+        res = RESOLUTIONS_MAP[resolution]
+        fetcher = AsyncFtxHistoricalFetcher(concurrency=concurrency, rate_limiter=self.rate_limiter)
+        results = fetcher.run(fetcher.fetch_candles(symbol, res, since=self.__fetch_start(until_ts, res)))
+        return self.__to_price_frame(results, symbol, res, until_ts)
+
+    def __to_price_frame(self, results: typing.List[dict], symbol: str, res: int,
+                         until_ts: pd.Timestamp = None) -> pd.DataFrame:
+        df = pd.DataFrame(results).drop_duplicates(subset='startTime', keep='last').sort_values(by='startTime') \
+            .set_index('startTime')
         df['exchange'] = 'FTX'
         df['resolution'] = res
-        df['fetch_time'] = pd.to_datetime(time.time())
+        df['fetch_time'] = pd.to_datetime(time.time(), unit='s')
         base, quote, product_type, expiry_date = self.parse_symbol(symbol)
         df['base'] = base
         df['quote'] = quote
@@ -267,64 +343,280 @@ class WrappedFtxClient:
         else:
             return df
 
-    def __fetch_1h_price_data(self, client, symbol: str, until_ts: pd.Timestamp = None, ):
-        df = self.fetch_historical_data_since_beginning(self.client, symbol, '1h', until_ts=until_ts)
+    def __fetch_price_data(self, client, symbol: str, until_ts: pd.Timestamp = None, resolution: str = '1h'):
+        df = self.fetch_historical_data_since_beginning(self.client, symbol, resolution, until_ts=until_ts)
+        return self.__to_price_data_columns(df)
+
+    def __fetch_price_data_async(self, client, symbol: str, until_ts: pd.Timestamp = None, resolution: str = '1h'):
+        df = self.fetch_historical_data_async(self.client, symbol, resolution, until_ts=until_ts)
+        return self.__to_price_data_columns(df)
+
+    @staticmethod
+    def __to_price_data_columns(df: pd.DataFrame) -> pd.DataFrame:
         df = df.reset_index()
         df.columns = ['timestamp', 'open', 'high', 'low', 'close', 'quote_volume', 'exchange', 'resolution',
                       'fetch_time', 'base', 'quote', 'product_type', 'expiry_date']
         return df
 
+    def fetch_price_window(self, symbol: str, resolution: str, start: float, end: float) -> pd.DataFrame:
+        """
+        Fetches the candles starting within [start, end) with a single request (the window must fit in one page,
+        see #split_time_windows), formatted as price_data rows.
+        :param symbol: a market name
+        :param resolution: a key of RESOLUTIONS_MAP
+        :param start: unix timestamp for the start of the window
+        :param end: unix timestamp for the end of the window
+        :return: a dataframe of price_data rows (empty if there was no data in the window)
+        """
+        res = RESOLUTIONS_MAP[resolution]
+        self.__throttle()
+        results = self.client.get_historical_data(symbol, resolution=res, limit=FTX_CANDLES_PAGE_LIMIT,
+                                                  start_time=int(start), end_time=int(end) - 1)
+        if not results:
+            return pd.DataFrame()
+        return self.__to_price_data_columns(self.__to_price_frame(results, symbol, res))
+
+    def fetch_funding_window(self, symbol: str, start: float, end: float) -> pd.DataFrame:
+        """
+        Fetches the funding payments within [start, end) with a single request, formatted as funding_data rows.
+        :param symbol: a perpetual future name
+        :param start: unix timestamp for the start of the window
+        :param end: unix timestamp for the end of the window
+        :return: a dataframe of funding_data rows (empty if there was no data in the window)
+        """
+        self.__throttle()
+        results = self.client.get_funding_rates(symbol, start_time=int(start), end_time=int(end) - 1)
+        if not results:
+            return pd.DataFrame()
+        return self.__to_funding_frame(results, symbol)
+
+    def stream_price_data(self, client, symbol: str, until_ts: pd.Timestamp = None,
+                          resolution: str = '1h') -> typing.Iterator[ColumnChunk]:
+        """
+        Streaming counterpart to #fetch_historical_data_since_beginning for #run_update_job - rather than
+        accumulating the whole history, each page is yielded (as a compact ColumnChunk of price_data rows) as soon as it
+        arrives, so memory stays constant regardless of history length (e.g. for 1m candles).
+        Pages are fetched newest first, down to FTX_HISTORY_START. When backfilling from scratch (no until_ts), a run
+        of empty pages after data has been seen is taken as the start of the market's history once it's long enough
+        not to be a gap in trading (see FTX_MAX_HISTORY_GAP).
+        :param client: unused (kept so this can be passed as a read_func to #run_update_job)
+        :param symbol: a market name
+        :param until_ts: the last timestamp already recorded (None to fetch the full history)
+        :param resolution: a key of RESOLUTIONS_MAP
+        :return: an iterator of ColumnChunks, one per page
+        """
+        res = RESOLUTIONS_MAP[resolution]
+        windows = split_time_windows(self.__fetch_start(until_ts, res), time.time(), res * FTX_CANDLES_PAGE_LIMIT)
+        seen_data = False
+        empty_windows = []
+        for (start, end) in reversed(windows):
+            df = self.fetch_price_window(symbol, resolution, start, end)
+            if not len(df):
+                empty_windows.append((start, end))
+                if seen_data and until_ts is None and self.__reached_history_start(empty_windows):
+                    break
+                continue
+            seen_data = True
+            empty_windows = []
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+            yield ColumnChunk.from_frame(symbol, df, PRICE_DATA_CONSTANT_COLUMNS)
+
+    def stream_funding_data(self, client, symbol: str, until_ts: pd.Timestamp = None) -> typing.Iterator[ColumnChunk]:
+        """
+        Streaming counterpart to #fetch_funding_data_since_beginning (see #stream_price_data).
+        :param client: unused (kept so this can be passed as a read_func to #run_update_job)
+        :param symbol: a perpetual future name
+        :param until_ts: the last timestamp already recorded (None to fetch the full history)
+        :return: an iterator of ColumnChunks, one per page
+        """
+        windows = split_time_windows(self.__fetch_start(until_ts, 3600), time.time(),
+                                     3600 * FTX_FUNDING_RATES_PAGE_LIMIT)
+        seen_data = False
+        empty_windows = []
+        for (start, end) in reversed(windows):
+            df = self.fetch_funding_window(symbol, start, end)
+            if not len(df):
+                empty_windows.append((start, end))
+                if seen_data and until_ts is None and self.__reached_history_start(empty_windows):
+                    break
+                continue
+            seen_data = True
+            empty_windows = []
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+            yield ColumnChunk.from_frame(symbol, df, FUNDING_DATA_CONSTANT_COLUMNS)
+
+    @staticmethod
+    def __reached_history_start(empty_windows: typing.List[typing.Tuple[float, float]]) -> bool:
+        """
+        :param empty_windows: the consecutive empty windows since data was last seen, newest first
+        """
+        return len(empty_windows) >= FTX_MIN_EMPTY_WINDOWS and \
+            empty_windows[0][1] - empty_windows[-1][0] >= FTX_MAX_HISTORY_GAP
+
     def __read_worker(self, argz):
-        read_func, queue, db_write_queue, last_ts = argz
+        worker_idx, read_func, queue, db_write_queue, progress_queue, last_ts, rate_limiter = argz
+        self.rate_limiter = rate_limiter
         while True:
             symbol = queue.get(block=True)  # block=True means make a blocking call to wait for items in queue
             if symbol is None:
                 print("Shutting down fetch worker...")
-                db_write_queue.put(None)
+                progress_queue.put(('fetch_worker_done', worker_idx, None))
                 break
-            base, quote, product_type, expiry_date = self.parse_symbol(symbol)
-            reconstructed_sym = f"{base}-{quote}-{product_type}"
-            print(f'Fetching historical data for {symbol} since {last_ts.get(reconstructed_sym, None)}')
-            df = read_func(self.client, symbol, until_ts=last_ts.get(reconstructed_sym, None))
-            db_write_queue.put((symbol, df))
+            start = time.time()
+            try:
+                base, quote, product_type, expiry_date = self.parse_symbol(symbol)
+                reconstructed_sym = f"{base}-{quote}-{product_type}"
+                print(f'Fetching historical data for {symbol} since {last_ts.get(reconstructed_sym, None)}')
+                result = read_func(self.client, symbol, until_ts=last_ts.get(reconstructed_sym, None))
+                # Streaming read funcs return an iterator of chunks, which are passed on as soon as they arrive
+                chunks = [result] if isinstance(result, pd.DataFrame) else result
+                rows = 0
+                num_chunks = 0
+                for chunk in chunks:
+                    # Blocks while the write queue is full, so fetchers can't run arbitrarily far ahead of the writers
+                    db_write_queue.put((symbol, chunk))
+                    rows += len(chunk)
+                    num_chunks += 1
+            except Exception as e:
+                progress_queue.put(('failed', symbol, {'stage': 'fetch', 'error': repr(e)}))
+                continue
+            progress_queue.put(('fetched', symbol, {'rows': rows, 'chunks': num_chunks, 'seconds': time.time() - start}))
 
     def __write_worker(self, argz):
-        write_table, db_write_queue, last_ts = argz
+        worker_idx, write_table, db_write_queue, progress_queue, last_ts = argz
         engine = db.create_engine(Config.get_property("SQL_URI").unwrap())
         while True:
             chunk = db_write_queue.get(block=True)
             if chunk is None:
                 print('Shutting down write worker...')
+                progress_queue.put(('write_worker_done', worker_idx, None))
                 break
             (symbol, df) = chunk
-            print(f'Writing {symbol} to {write_table}....')
-            df.to_sql(write_table, con=engine, if_exists='append', index=False, method='multi')
+            if isinstance(df, ColumnChunk):
+                df = df.to_frame()
+            print(f'Writing {len(df)} rows of {symbol} to {write_table}....')
+            start = time.time()
+            try:
+                df.to_sql(write_table, con=engine, if_exists='append', index=False, chunksize=5000,
+                          method=db_accessor.upsert_method(db_accessor.UPSERT_KEYS[write_table]))
+            except Exception as e:
+                progress_queue.put(('failed', symbol, {'stage': 'write', 'error': repr(e)}))
+                continue
+            progress_queue.put(('written', symbol, {'rows': len(df), 'seconds': time.time() - start}))
 
-    def run_update_job(self, tickers_to_fetch: list, read_func, write_table: str, until_ts: dict):
+    def run_update_job(self, tickers_to_fetch: list, read_func, write_table: str, until_ts: dict,
+                       num_fetch_workers: int = 4, num_write_workers: int = 2, queue_size: int = 16,
+                       requests_per_second: float = 25) -> typing.Dict[str, typing.Dict]:
         """
         Simple utility method for wrapping both funding and price update jobs.
-        This additionally spins up multiple processes (as many as CPUs available) in order to more rapidly
-        execute the update job.
+        Tickers are fetched by a pool of `num_fetch_workers` processes, which share a single rate limiter (so adding
+        workers scales up to, but never past, the exchange rate limit), and written by `num_write_workers` processes.
+        The queue between them is bounded by `queue_size` to apply backpressure when writes fall behind.
         :param tickers_to_fetch: A list of the tickers to fetch
         :param read_func: A function to execute on read success
         :param write_table: The output table to write data to
         :param until_ts: A dict of timestamps representing the last recorded data for a given price or funding pair
-        :return: {None}
+        :param num_fetch_workers: the number of fetch processes
+        :param num_write_workers: the number of DB write processes
+        :param queue_size: the max number of fetched (unwritten) symbols held between fetchers and writers
+        :param requests_per_second: the total REST request rate allowed across all fetch workers
+        :return: a dict of symbol -> {fetched, written, failed} stats (rows & seconds taken per stage)
         """
         read_queue = multiprocess.Queue()
-        db_write_queue = multiprocess.Queue()
+        db_write_queue = multiprocess.Queue(maxsize=queue_size)
+        progress_queue = multiprocess.Queue()
+        rate_limiter = RateLimiter(requests_per_second)
         for item in tickers_to_fetch:
             read_queue.put(item)
-        read_queue.put(None)
-
-        read_process = multiprocess.Process(target=self.__read_worker,
-                                            args=((read_func, read_queue, db_write_queue, until_ts),))
-        write_process = multiprocess.Process(target=self.__write_worker,
-                                             args=((write_table, db_write_queue, until_ts),))
-        read_process.start()
-        write_process.start()
-        read_process.join()
-        write_process.join()
+        for _ in range(num_fetch_workers):
+            read_queue.put(None)
+
+        fetch_processes = [multiprocess.Process(target=self.__read_worker,
+                                                args=((idx, read_func, read_queue, db_write_queue, progress_queue,
+                                                       until_ts, rate_limiter),))
+                           for idx in range(num_fetch_workers)]
+        write_processes = [multiprocess.Process(target=self.__write_worker,
+                                                args=((idx, write_table, db_write_queue, progress_queue, until_ts),))
+                           for idx in range(num_write_workers)]
+        for process in fetch_processes + write_processes:
+            process.start()
+
+        job_start = time.time()
+        stats = defaultdict(dict)
+        fetchers_done = set()
+        writers_done = set()
+        writers_signalled = False
+        reported = set()
+        completed = 0
+        while len(writers_done) < num_write_workers:
+            try:
+                event, key, data = progress_queue.get(timeout=1)
+            except queue_lib.Empty:
+                # A worker that died without reporting in would otherwise hang the job
+                fetchers_done |= {idx for idx, p in enumerate(fetch_processes) if p.exitcode not in (None, 0)}
+                writers_done |= {idx for idx, p in enumerate(write_processes) if p.exitcode not in (None, 0)}
+                event = None
+            if event == 'fetch_worker_done':
+                fetchers_done.add(key)
+            elif event == 'write_worker_done':
+                writers_done.add(key)
+            elif event == 'written':
+                # A symbol can be written in several chunks, possibly by different writers
+                written = stats[key].setdefault('written', {'rows': 0, 'chunks': 0, 'seconds': 0.0})
+                written['rows'] += data['rows']
+                written['chunks'] += 1
+                written['seconds'] += data['seconds']
+            elif event is not None:
+                stats[key][event] = data
+            if event in ('fetched', 'written', 'failed') and key not in reported and (
+                    'failed' in stats[key] or
+                    stats[key].get('fetched', {}).get('chunks') == stats[key].get('written', {}).get('chunks', 0)):
+                reported.add(key)
+                completed += 1
+                print(f"[{completed}/{len(tickers_to_fetch)}] {key}: {self.__format_symbol_stats(stats[key])}")
+            if not writers_signalled and len(fetchers_done) == num_fetch_workers:
+                # Once every fetcher has finished, tell the writers to drain the queue and stop
+                self.__signal_writers(db_write_queue, write_processes)
+                writers_signalled = True
+        # Fetchers can only still be running if every writer died - they'd block forever on the full write queue
+        aborted = [process for process in fetch_processes if process.is_alive()]
+        if aborted:
+            print(f'Every write worker exited, terminating {len(aborted)} fetch workers')
+            for process in aborted:
+                process.terminate()
+            db_write_queue.cancel_join_thread()
+        for process in fetch_processes + write_processes:
+            process.join()
+        for symbol in tickers_to_fetch:
+            if symbol not in reported and 'failed' not in stats[symbol]:
+                stats[symbol]['failed'] = {'stage': 'write', 'error': 'Every write worker exited before it was written'}
+        # Writes happened in the worker processes, so invalidate this process' cached reads of the table explicitly
+        db_accessor.DbAccessor.bump_table_versions(write_table)
+
+        failures = [symbol for symbol, s in stats.items() if 'failed' in s]
+        rows = sum([s.get('written', {}).get('rows', 0) for s in stats.values()])
+        print(f"Updated {write_table}: {rows} rows for {len(stats) - len(failures)} symbols in "
+              f"{time.time() - job_start:.1f}s ({len(failures)} failed: {failures})")
+        return dict(stats)
+
+    @staticmethod
+    def __signal_writers(db_write_queue, write_processes: typing.List[multiprocess.Process]):
+        for _ in write_processes:
+            # The queue may be full with no writer left to drain it
+            while any(process.is_alive() for process in write_processes):
+                try:
+                    db_write_queue.put(None, timeout=1)
+                    break
+                except queue_lib.Full:
+                    continue
+
+    @staticmethod
+    def __format_symbol_stats(symbol_stats: dict) -> str:
+        if 'failed' in symbol_stats:
+            return f"failed during {symbol_stats['failed']['stage']} - {symbol_stats['failed']['error']}"
+        fetched, written = symbol_stats.get('fetched', {}), symbol_stats.get('written', {})
+        return (f"fetched {fetched.get('rows', 0)} rows in {fetched.get('seconds', 0):.1f}s, "
+                f"wrote in {written.get('seconds', 0):.1f}s")
 
     def get_net_account_value(self) -> float:
         """
@@ -345,9 +637,14 @@ class WrappedFtxClient:
             notionals[future['future']] = future['cost']
         return notionals
 
-    def run_update_all_funding(self):
+    def run_update_all_funding(self, use_async: bool = False, checkpoint_path: str = None, streaming: bool = False):
         """
         Update job for all funding data in the DB.
+        :param use_async: if true, each symbol's missing history is fetched as concurrent windows
+        (see #fetch_funding_data_async) rather than paged sequentially
+        :param checkpoint_path: if provided, runs as a resumable backfill checkpointed to this file
+        (see BackfillJobManager) - rerun with the same path to resume an interrupted update
+        :param streaming: if true, each page is written through to the DB as it arrives (see #stream_funding_data)
         :return: {None}
         """
         until_ts = defaultdict(pd.Timestamp)
@@ -358,21 +655,60 @@ class WrappedFtxClient:
             until_ts[reconstructed_sym] = pd.to_datetime(last_fetch)
         tickers = self.get_available_tickers()
         tickers_to_fetch = tickers['perps']
-        self.run_update_job(tickers_to_fetch, self.fetch_funding_data_since_beginning, 'funding_data', until_ts)
+        if checkpoint_path:
+            self.__run_checkpointed_update(tickers_to_fetch, 'funding_data', until_ts, checkpoint_path)
+            return
+        if streaming:
+            read_func = self.stream_funding_data
+        elif use_async:
+            read_func = self.fetch_funding_data_async
+        else:
+            read_func = self.fetch_funding_data_since_beginning
+        self.run_update_job(tickers_to_fetch, read_func, 'funding_data', until_ts)
 
-    def run_update_all_prices(self):
+    def run_update_all_prices(self, use_async: bool = False, checkpoint_path: str = None, streaming: bool = False,
+                              resolution: str = '1h'):
         """
         Update job for all price data in the DB.
+        :param use_async: if true, each symbol's missing history is fetched as concurrent windows
+        (see #fetch_historical_data_async) rather than paged sequentially
+        :param checkpoint_path: if provided, runs as a resumable backfill checkpointed to this file
+        (see BackfillJobManager) - rerun with the same path to resume an interrupted update
+        :param streaming: if true, each page is written through to the DB as it arrives (see #stream_price_data) -
+        use this for 1m data, where holding a symbol's full history in memory isn't feasible
+        :param resolution: a key of RESOLUTIONS_MAP
         :return: {None}
         """
+        if resolution not in RESOLUTIONS_MAP:
+            raise Exception(
+                f"{resolution} not found in RESOLUTIONS_MAP. Available resolutions are: {list(RESOLUTIONS_MAP.keys())}")
         until_ts = defaultdict(pd.Timestamp)
-        for listing in db_accessor.DbAccessor().get_symbol_last_prices():
+        for listing in db_accessor.DbAccessor().get_symbol_last_prices(resolution=RESOLUTIONS_MAP[resolution]):
             (base, quote, product_type, exchange, last_fetch) = listing
             until_ts[f"{base}-{quote}-{product_type}"] = pd.to_datetime(last_fetch)
 
         tickers = self.get_available_tickers()
         tickers_to_fetch = tickers['spot'] + tickers['perps']
-        self.run_update_job(tickers_to_fetch, self.__fetch_1h_price_data, 'price_data', until_ts)
+        if checkpoint_path:
+            self.__run_checkpointed_update(tickers_to_fetch, 'price_data', until_ts, checkpoint_path,
+                                           resolution=resolution)
+            return
+        if streaming:
+            read_func = functools.partial(self.stream_price_data, resolution=resolution)
+        elif use_async:
+            read_func = functools.partial(self.__fetch_price_data_async, resolution=resolution)
+        else:
+            read_func = functools.partial(self.__fetch_price_data, resolution=resolution)
+        self.run_update_job(tickers_to_fetch, read_func, 'price_data', until_ts)
+
+    def __run_checkpointed_update(self, tickers_to_fetch: list, table: str, until_ts: dict, checkpoint_path: str,
+                                  requests_per_second: float = 25, resolution: str = '1h'):
+        symbol_until_ts = {}
+        for symbol in tickers_to_fetch:
+            base, quote, product_type, expiry_date = self.parse_symbol(symbol)
+            symbol_until_ts[symbol] = until_ts.get(f"{base}-{quote}-{product_type}")
+        self.rate_limiter = RateLimiter(requests_per_second)
+        BackfillJobManager(self, table, checkpoint_path, resolution=resolution).run(tickers_to_fetch, symbol_until_ts)
 
 if __name__ == '__main__':
     p = WrappedFtxClient(
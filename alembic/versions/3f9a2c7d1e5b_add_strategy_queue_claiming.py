@@ -0,0 +1,33 @@
+"""add strategy queue claiming
+
+Revision ID: 3f9a2c7d1e5b
+Revises: d4f11842cf9e
+Create Date: 2026-10-19 10:02:11.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a2c7d1e5b'
+down_revision = 'd4f11842cf9e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('strategy_queue', 'processed_timestamp', type_=sa.TIMESTAMP(),
+                    postgresql_using='processed_timestamp::timestamp')
+    op.add_column('strategy_queue', sa.Column('claimed_by', sa.String()))
+    op.add_column('strategy_queue', sa.Column('lease_expires_at', sa.TIMESTAMP()))
+    # Only unprocessed rows are ever polled, so keep the index limited to those
+    op.create_index('ix_strategy_queue_unprocessed', 'strategy_queue', ['strategy', 'id'],
+                    postgresql_where=sa.text('processed_timestamp IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_strategy_queue_unprocessed', table_name='strategy_queue')
+    op.drop_column('strategy_queue', 'lease_expires_at')
+    op.drop_column('strategy_queue', 'claimed_by')
+    op.alter_column('strategy_queue', 'processed_timestamp', type_=sa.String())
@@ -0,0 +1,29 @@
+"""add trace ids
+
+Revision ID: 5e8d2a1f7c43
+Revises: c58e0f3b92a4
+Create Date: 2026-10-19 15:42:37.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8d2a1f7c43'
+down_revision = 'c58e0f3b92a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The trace of the pipeline cycle which wrote each row (see utils/tracing.py)
+    op.add_column('strategy_queue', sa.Column('trace_id', sa.String()))
+    op.add_column('fills', sa.Column('trace_id', sa.String()))
+    op.create_index('ix_fills_trace_id', 'fills', ['trace_id'])
+
+
+def downgrade():
+    op.drop_index('ix_fills_trace_id', table_name='fills')
+    op.drop_column('fills', 'trace_id')
+    op.drop_column('strategy_queue', 'trace_id')
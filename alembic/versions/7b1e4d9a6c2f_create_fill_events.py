@@ -0,0 +1,56 @@
+"""create fill events
+
+Revision ID: 7b1e4d9a6c2f
+Revises: 3f9a2c7d1e5b
+Create Date: 2026-10-19 11:40:52.871390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b1e4d9a6c2f'
+down_revision = '3f9a2c7d1e5b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('ALTER TABLE fills ADD COLUMN id SERIAL PRIMARY KEY')
+    op.create_table(
+        "fill_events",
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_fill_events')),
+        sa.Column('fill_id', sa.Integer(), sa.ForeignKey('fills.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('order_id', sa.BigInteger()),
+        sa.Column('trade_id', sa.BigInteger()),
+        sa.Column('market', sa.String()),
+        sa.Column('side', sa.String()),
+        sa.Column('price', sa.Float()),
+        sa.Column('size', sa.Float()),
+        sa.Column('fee', sa.Float()),
+        sa.Column('fee_rate', sa.Float()),
+        sa.Column('liquidity', sa.String()),
+        sa.Column('time', sa.TIMESTAMP()),
+    )
+    op.create_index('ix_fill_events_market_time', 'fill_events', ['market', 'time'])
+    op.create_index('ix_fill_events_fill_id', 'fill_events', ['fill_id'])
+    # Move the existing fill_json blobs over, so reports cover fills recorded before this migration
+    op.execute(
+        """
+        INSERT INTO fill_events (fill_id, order_id, trade_id, market, side, price, size, fee, fee_rate, liquidity, time)
+            SELECT f.id, (e->>'orderId')::bigint, (e->>'tradeId')::bigint, e->>'market', e->>'side',
+                   (e->>'price')::float, (e->>'size')::float, (e->>'fee')::float, (e->>'feeRate')::float,
+                   e->>'liquidity', (e->>'time')::timestamptz AT TIME ZONE 'UTC'
+            FROM fills f, json_array_elements(f.fill_json::json) e
+            WHERE f.fill_json IS NOT NULL AND f.fill_json <> ''
+        """
+    )
+
+
+def downgrade():
+    op.drop_index('ix_fill_events_fill_id', table_name='fill_events')
+    op.drop_index('ix_fill_events_market_time', table_name='fill_events')
+    op.drop_table("fill_events")
+    op.drop_column('fills', 'id')
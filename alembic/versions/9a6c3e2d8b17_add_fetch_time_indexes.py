@@ -0,0 +1,27 @@
+"""add fetch time indexes
+
+Revision ID: 9a6c3e2d8b17
+Revises: 5e8d2a1f7c43
+Create Date: 2026-10-19 16:20:51.604739
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6c3e2d8b17'
+down_revision = '5e8d2a1f7c43'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Series watermarks (max(fetch_time), per resolution for prices) are polled every recalculation cycle
+    op.create_index('ix_price_data_resolution_fetch_time', 'price_data', ['resolution', 'fetch_time'])
+    op.create_index('ix_funding_data_fetch_time', 'funding_data', ['fetch_time'])
+
+
+def downgrade():
+    op.drop_index('ix_funding_data_fetch_time', table_name='funding_data')
+    op.drop_index('ix_price_data_resolution_fetch_time', table_name='price_data')
@@ -0,0 +1,46 @@
+"""add unique series constraints
+
+Revision ID: c58e0f3b92a4
+Revises: 7b1e4d9a6c2f
+Create Date: 2026-10-19 13:15:06.530928
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e0f3b92a4'
+down_revision = '7b1e4d9a6c2f'
+branch_labels = None
+depends_on = None
+
+PRICE_DATA_KEY = ['exchange', 'base', 'quote', 'product_type', 'expiry_date', 'resolution', 'timestamp']
+FUNDING_DATA_KEY = ['exchange', 'future', 'timestamp']
+
+
+def dedupe(table: str, key: list):
+    # One-off cleanup of overlapping reruns, keeping the most recently fetched copy of each row
+    partition = ", ".join([f'"{k}"' for k in key])
+    op.execute(
+        f"""
+        DELETE FROM {table} WHERE ctid IN (
+            SELECT ctid FROM (
+                SELECT ctid, row_number() OVER (PARTITION BY {partition} ORDER BY fetch_time DESC) AS rn
+                FROM {table}
+            ) ranked WHERE rn > 1
+        )
+        """
+    )
+
+
+def upgrade():
+    dedupe('price_data', PRICE_DATA_KEY)
+    dedupe('funding_data', FUNDING_DATA_KEY)
+    op.create_unique_constraint('uq_price_data_series_timestamp', 'price_data', PRICE_DATA_KEY)
+    op.create_unique_constraint('uq_funding_data_series_timestamp', 'funding_data', FUNDING_DATA_KEY)
+
+
+def downgrade():
+    op.drop_constraint('uq_funding_data_series_timestamp', 'funding_data', type_='unique')
+    op.drop_constraint('uq_price_data_series_timestamp', 'price_data', type_='unique')
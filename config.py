@@ -17,6 +17,7 @@ SPECIFIED_PROPERTIES = [
     'FTX_API_SECRET',
     'FTX_SUBACCOUNT_NAME',
     'RABBITMQ_SERVER_URI',
+    'STRATEGY_MODULES',
 ]
 
 
@@ -84,7 +85,7 @@ class _Config:
         path = property_name.split(".")
         properties_accessor = self.__properties__
         for item in path:
-            if item not in path:
+            if item not in properties_accessor:
                 logging.warning("Provided property: [" + property_name + "] not found in config.")
                 return ConfigValue(if_missing)
             properties_accessor = properties_accessor[item]
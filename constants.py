@@ -14,6 +14,18 @@ RESOLUTIONS_MAP = {
     '1d': 60 * 60 * 24,
 }
 
+# The earliest point worth requesting history from (FTX launched in May 2019), as a unix timestamp
+FTX_HISTORY_START = 1556668800
+
+# Max rows returned per request by the FTX REST API
+FTX_CANDLES_PAGE_LIMIT = 1500
+FTX_FUNDING_RATES_PAGE_LIMIT = 500
+
+# A from-scratch backfill takes a run of empty pages as the start of a market's history once it spans at least
+# FTX_MAX_HISTORY_GAP seconds over at least FTX_MIN_EMPTY_WINDOWS pages - shorter gaps (e.g. outages) are skipped over
+FTX_MAX_HISTORY_GAP = 30 * 24 * 60 * 60
+FTX_MIN_EMPTY_WINDOWS = 3
+
 LEVERAGED = [
     'BULL',
     'BEAR',
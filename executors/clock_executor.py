@@ -1,42 +1,166 @@
-import schedule
 import time
+import typing
+from dataclasses import dataclass
+
 from pika.exchange_type import ExchangeType
 
 import message_constants as msg
-import json
 from executors.simple_executor import SimpleExecutor
+from transport import Transport
+from utils.tracing import TraceContext
+
+OVERRUN_POLICIES: typing.Final = ('skip', 'coalesce')
+
+
+@dataclass
+class ScheduledCycle:
+    """
+    A cycle fired by the clock every `interval` seconds. A fired cycle is in flight until `expected_acks` executors
+    have acknowledged it (see MessageHelper#cycle_complete) or `timeout` seconds have passed.
+    """
+    name: str
+    interval: float
+    trigger: typing.Callable[[str, TraceContext], None]
+    expected_acks: int = 1
+    timeout: float = 60
+    next_deadline: float = None
+    cycle_id: typing.Optional[str] = None
+    started_at: float = None
+    acks: int = 0
+    # Whether an overrun tick is waiting to fire once the in-flight cycle completes (coalesce policy)
+    pending: bool = False
+    fired: int = 0
+    skipped: int = 0
+    coalesced: int = 0
+    timed_out: int = 0
 
 
 class ClockExecutor(SimpleExecutor):
     """
     Simple clock executor for handling orchestration of other services.
+    Cycles fire on fixed deadlines (start + n * interval), so the schedule doesn't drift with the time taken to
+    trigger a cycle, and between deadlines the clock runs its transport's I/O loop until the next one is due (for
+    sub-second resolution, rather than polling).
+    A cycle is in flight from when it fires until every executor running it has acknowledged it. A deadline reached
+    while the previous cycle is still in flight is an overrun: with overrun_policy = 'skip' the tick is dropped,
+    while with 'coalesce' every overrun tick collapses into a single cycle fired as soon as the in-flight one
+    completes. Either way a slow rebalance never has others queued up behind it.
     """
 
-    def __init__(self, rabbit_mq_host: str):
+    def __init__(self, rabbit_mq_host: str = None, recalculation_interval: float = 5,
+                 execution_interval: float = 10, overrun_policy: str = 'skip', strategy_count: int = 1,
+                 position_executor_count: int = 1, cycle_timeout: float = 60, transport: Transport = None):
+        """
+        :param recalculation_interval: seconds between strategy recalculations
+        :param execution_interval: seconds between position executions
+        :param overrun_policy: one of 'skip' or 'coalesce' (see above)
+        :param strategy_count: the number of strategy executors acknowledging each recalculation (each consumes its
+        own queue, see StrategyExecutor)
+        :param position_executor_count: the number of position executor shards acknowledging each execution (see
+        PositionExecutor)
+        :param cycle_timeout: seconds after which an unacknowledged cycle is considered lost (e.g. its executor
+        died) and no longer blocks new cycles
+        """
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise Exception(f'Unknown overrun policy {overrun_policy}, expected one of {OVERRUN_POLICIES}')
         super().__init__(rabbit_mq_host=rabbit_mq_host, exchange=msg.POSITION_EXCHANGE,
-                         exchange_type=ExchangeType.fanout, queue=msg.CLOCK_QUEUE)
+                         exchange_type=ExchangeType.fanout, queue=msg.CLOCK_QUEUE, transport=transport)
+        self.overrun_policy = overrun_policy
+        self.cycles = [
+            ScheduledCycle('recalculation', recalculation_interval, self.trigger_position_recalculation,
+                           expected_acks=strategy_count, timeout=cycle_timeout),
+            ScheduledCycle('execution', execution_interval, self.trigger_position_execution,
+                           expected_acks=position_executor_count, timeout=cycle_timeout),
+        ]
 
-    def trigger_position_execution(self):
-        self.message_helper.position_executor_change_positions()
+    def __start_cycle(self):
+        """
+        Every tick starts a new trace, rooted at a zero-length "tick" span.
+        """
+        trace = self.tracer.start_trace()
+        now = time.time()
+        self.tracer.record(trace, 'tick', now, now)
+        return trace
 
-    def trigger_position_recalculation(self):
-        self.message_helper.strategy_executor_recalculate_positions()
+    def trigger_position_execution(self, cycle_id: str = None, trace: TraceContext = None):
+        self.message_helper.position_executor_change_positions(cycle_id=cycle_id, trace=trace)
+
+    def trigger_position_recalculation(self, cycle_id: str = None, trace: TraceContext = None):
+        self.message_helper.strategy_executor_recalculate_positions(cycle_id=cycle_id, trace=trace)
 
     def run(self):
-        schedule.every(5).seconds.do(self.trigger_position_recalculation)
-        schedule.every(10).seconds.do(self.trigger_position_execution)
-        self.channel.start_consuming()
-        while not self.has_stopped:
-            schedule.run_pending()
-            time.sleep(1)
+        start = time.monotonic()
+        for cycle in self.cycles:
+            cycle.next_deadline = start + cycle.interval
+        while self.transport.is_open:
+            self.__run_due_cycles(time.monotonic())
+            if not self.transport.is_open:
+                break
+            # Deliveries (e.g. acks) are handled while waiting, and may complete cycles early
+            self.transport.process_events(time_limit=max(0.0, self.__next_wakeup() - time.monotonic()))
+
+    def __next_wakeup(self) -> float:
+        wakeups = [cycle.next_deadline for cycle in self.cycles]
+        wakeups += [cycle.started_at + cycle.timeout for cycle in self.cycles if cycle.cycle_id is not None]
+        return min(wakeups)
+
+    def __run_due_cycles(self, now: float):
+        for cycle in self.cycles:
+            if cycle.cycle_id is not None and now - cycle.started_at >= cycle.timeout:
+                cycle.timed_out += 1
+                self.message_helper.log_error_message(
+                    exception=f'{cycle.name} cycle {cycle.cycle_id} timed out after {cycle.timeout}s',
+                    other_data={'acks': cycle.acks, 'expected_acks': cycle.expected_acks})
+                self.__complete(cycle, now)
+            if now < cycle.next_deadline:
+                continue
+            # Deadlines are advanced on a fixed grid - any passed over entirely (e.g. while a handler blocked the
+            # loop) are overruns too
+            missed = int((now - cycle.next_deadline) // cycle.interval)
+            cycle.next_deadline += (missed + 1) * cycle.interval
+            overruns = missed + (cycle.cycle_id is not None)
+            if self.overrun_policy == 'coalesce':
+                cycle.coalesced += overruns
+            else:
+                cycle.skipped += overruns
+            if cycle.cycle_id is None:
+                self.__fire(cycle, now)
+            elif self.overrun_policy == 'coalesce':
+                cycle.pending = True
+            else:
+                print(f'Skipping {cycle.name} cycle, {cycle.cycle_id} is still in flight')
+
+    def __fire(self, cycle: ScheduledCycle, now: float):
+        trace = self.__start_cycle()
+        cycle.pending = False
+        cycle.fired += 1
+        cycle.trigger(trace.trace_id, trace)
+        if cycle.expected_acks > 0:
+            (cycle.cycle_id, cycle.started_at, cycle.acks) = (trace.trace_id, now, 0)
+
+    def __complete(self, cycle: ScheduledCycle, now: float):
+        cycle.cycle_id = None
+        if cycle.pending:
+            self.__fire(cycle, now)
 
     def stop(self):
-        self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.POSITION_SCHEDULING_QUEUE,
-                                   body=json.dumps({"message_type": msg.TERMINATE_ALL_POSITIONS_EXC_MSG}))
+        self.message_helper.terminate_all()
         super().stop()
 
-    def on_message_consumption(self, ch, method, properties, body):
-        self.stop()
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        if message['message_type'] == msg.CYCLE_COMPLETE_MSG:
+            cycle = next((c for c in self.cycles if c.cycle_id is not None and c.cycle_id == message['cycle_id']),
+                         None)
+            # Acks of cycles which already timed out are ignored
+            if cycle is None:
+                return
+            if not message['succeeded']:
+                print(f'{message["sender"]} failed {cycle.name} cycle {cycle.cycle_id}')
+            cycle.acks += 1
+            if cycle.acks >= cycle.expected_acks:
+                self.__complete(cycle, time.monotonic())
+        elif message['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG and self.transport.is_open:
+            super().stop()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,3 @@
-import json
-
 from models.order_data import OrderData
 from simple_executor import SimpleExecutor
 import sys
@@ -10,38 +8,150 @@ from accessors.db_accessor import DbAccessor, DbWriteException
 from accessors.wrapped_ftx_client import WrappedFtxClient
 from config import Config
 import message_constants as msg
+from transport import Transport
+from utils.tracing import TraceContext
+import time
 import typing
+from dataclasses import dataclass, field
+
+
+@dataclass
+class PendingDelivery:
+    """
+    The writes carried by one buffered delivery, so they can be retried (and acked or nacked) on their own.
+    """
+    delivery_tag: int
+    redelivered: bool
+    order_datas: typing.List[OrderData] = field(default_factory=list)
+    trace_ids: typing.List[typing.Optional[str]] = field(default_factory=list)
+    position_ids: typing.List = field(default_factory=list)
 
 
 class DbWriterExecutor(SimpleExecutor):
     """
     Executor to handle DB writes without blocking the main logic for various
     execution tasks (e.g. position fills)
+
+    Write messages are buffered and flushed as a single transaction once either `batch_size` messages are pending
+    or the oldest pending message has waited `max_batch_latency` seconds. Messages are only acknowledged to RabbitMQ
+    after the transaction commits, so anything unwritten at crash time is redelivered rather than lost.
+    When a batch fails, each delivery is retried in its own transaction, so one bad message (e.g. a fill violating a
+    constraint) can't hold back the rest: only the deliveries that still fail are nacked, and they're requeued once -
+    a delivery failing again on redelivery is dropped (or dead-lettered, if the queue is configured to).
+    Fills are written under the trace_id of the message that carried them, and the batch write is recorded as a
+    stage of every trace in the batch.
     """
 
-    def __init__(self, rabbit_mq_host: str = None, api_key: str = None, api_secret: str = None, subaccount: str = None):
+    def __init__(self, rabbit_mq_host: str = None, api_key: str = None, api_secret: str = None, subaccount: str = None,
+                 batch_size: int = 100, max_batch_latency: float = 0.5, transport: Transport = None):
         super().__init__(rabbit_mq_host=rabbit_mq_host,
                          exchange=msg.POSITION_EXCHANGE,
                          exchange_type=ExchangeType.fanout,
-                         queue=msg.WATCHER_QUEUE)
+                         queue=msg.DB_WRITER_QUEUE,
+                         auto_ack=False,
+                         transport=transport)
         self.db_accessor = DbAccessor()
         self.api_key = api_key
         self.api_secret = api_secret
         self.subaccount = subaccount
+        self.batch_size = batch_size
+        self.max_batch_latency = max_batch_latency
+        self._reset_batch()
+        self._flush_timer = None
+        self._last_ignored_delivery_tag = None
 
-    def on_message_consumption(self, ch, method, properties, body):
-        b = json.loads(body)
+    def _reset_batch(self):
+        self._pending_deliveries: typing.List[PendingDelivery] = []
+        self._pending_traces: typing.List[TraceContext] = []
+
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        b = message
+        if b['message_type'] == msg.MARK_STRATEGY_FILLED_MSG:
+            self.__pending_delivery(method).position_ids += b['position_ids']
+            self.__buffer(self.tracer.received(b.get('trace')))
+        elif b['message_type'] == msg.RECORD_FILLS_MSG:
+            trace = self.tracer.received(b.get('trace'))
+            pending = self.__pending_delivery(method)
+            pending.order_datas.append(b['order_data'])
+            pending.trace_ids.append(trace.trace_id if trace is not None else None)
+            self.__buffer(trace)
+        elif b['message_type'] == msg.UPDATE_HISTORICAL_DATA_MSG:
+            self.flush()
+            self.update_historical_data()
+            self.ack(method.delivery_tag)
+        elif b['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
+            self.flush()
+            self.ack(method.delivery_tag)
+            self.stop()
+        elif method.delivery_tag != self._last_ignored_delivery_tag:
+            # Other executors' messages (e.g. batched logs) reach this queue too through the fanout exchange - a
+            # batch shares one delivery tag, which must only be acked once
+            self._last_ignored_delivery_tag = method.delivery_tag
+            self.ack(method.delivery_tag)
+
+    def __pending_delivery(self, method) -> PendingDelivery:
+        # The messages of a batched delivery share its delivery tag
+        if not self._pending_deliveries or self._pending_deliveries[-1].delivery_tag != method.delivery_tag:
+            self._pending_deliveries.append(PendingDelivery(method.delivery_tag, method.redelivered))
+        return self._pending_deliveries[-1]
+
+    def __buffer(self, trace: typing.Optional[TraceContext]):
+        if trace is not None:
+            self._pending_traces.append(trace)
+        if len(self._pending_deliveries) >= self.batch_size:
+            self.flush()
+        elif self._flush_timer is None:
+            # The first message of a batch starts the latency clock
+            self._flush_timer = self.transport.call_later(self.max_batch_latency, self.flush)
+
+    def flush(self):
+        """
+        Writes all pending fills & strategy updates in one transaction, then acknowledges their messages.
+        If the transaction fails, each delivery is retried on its own (see #__write_individually).
+        """
+        if self._flush_timer is not None:
+            self.transport.remove_timeout(self._flush_timer)
+            self._flush_timer = None
+        if not self._pending_deliveries:
+            return
+        # Every delivery up to the last pending tag is either in this batch or has already been acked,
+        # so a single multiple=True frame acknowledges the whole batch
+        last_delivery_tag = max(pending.delivery_tag for pending in self._pending_deliveries)
+        write_start = time.time()
         try:
-            if b['message_type'] == 'mark_strategy_filled':
-                self.mark_strategy_filled(b['position_ids'])
-            elif b['message_type'] == 'update_historical_data':
-                self.update_historical_data()
-            elif b['message_type'] == 'record_fills':
-                self.on_record_fills(OrderData(**b['order_data']))
-            elif b['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
-                self.stop()
+            self.db_accessor.write_batch(
+                order_datas=[order_data for pending in self._pending_deliveries for order_data in pending.order_datas],
+                position_ids=[position_id for pending in self._pending_deliveries
+                              for position_id in pending.position_ids],
+                trace_ids=[trace_id for pending in self._pending_deliveries for trace_id in pending.trace_ids])
+            self.ack(last_delivery_tag, multiple=True)
         except DbWriteException as dbwe:
-            self.on_db_write_error(dbwe)
+            if len(self._pending_deliveries) > 1:
+                self.__write_individually(self._pending_deliveries)
+            else:
+                self.__reject(self._pending_deliveries[0], dbwe)
+        finally:
+            write_end = time.time()
+            for trace in self._pending_traces:
+                self.tracer.record(trace, 'db_write', write_start, write_end)
+            self._reset_batch()
+
+    def __write_individually(self, deliveries: typing.List[PendingDelivery]):
+        """
+        Writes each delivery in its own transaction, acking those that commit & rejecting those that fail.
+        """
+        for pending in deliveries:
+            try:
+                self.db_accessor.write_batch(order_datas=pending.order_datas, position_ids=pending.position_ids,
+                                             trace_ids=pending.trace_ids)
+                self.ack(pending.delivery_tag)
+            except DbWriteException as dbwe:
+                self.__reject(pending, dbwe)
+
+    def __reject(self, pending: PendingDelivery, error: DbWriteException):
+        # Requeued once, so a message that can never be written doesn't fail every batch it joins
+        self.nack(pending.delivery_tag, requeue=not pending.redelivered)
+        self.on_db_write_error(error)
 
     def mark_strategy_filled(self, position_ids: typing.List):
         self.db_accessor.mark_strategy_filled(position_ids)
@@ -58,7 +168,7 @@ class DbWriterExecutor(SimpleExecutor):
         self.db_accessor.write_successful_fill(order_data)
 
     def on_db_write_error(self, error: DbWriteException):
-        self.message_helper.log_error_message(exception=str(error), other_data={"context": error.__context__})
+        self.message_helper.log_error_message(exception=str(error), other_data={"context": str(error.__context__)})
 
 if __name__ == "__main__":
     DbWriterExecutor(rabbit_mq_host=Config.get_property("RABBITMQ_SERVER_URI", 'localhost').unwrap(),
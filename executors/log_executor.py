@@ -1,5 +1,3 @@
-import json
-
 import time
 from loguru import logger
 from pika.exchange_type import ExchangeType
@@ -7,30 +5,40 @@ from pika.exchange_type import ExchangeType
 from config import Config
 import message_constants as msg
 from executors.simple_executor import SimpleExecutor
+from transport import Transport
 from utils.utils import simple_pluck_dict
 
 class LogConsumer(SimpleExecutor):
-    def __init__(self):
+    def __init__(self, transport: Transport = None):
         super().__init__(rabbit_mq_host=Config.get_property("RABBITMQ_SERVER_URI", 'localhost').unwrap(),
                          exchange=msg.POSITION_EXCHANGE,
                          exchange_type=ExchangeType.fanout,
-                         queue=msg.LOG_QUEUE)
+                         queue=msg.LOG_QUEUE,
+                         transport=transport)
         logger.add(f"../logs/execution__{int(time.time())}.log", enqueue=True)
 
-    def on_message_consumption(self, ch, method, properties, body):
-        b = json.loads(body)
-        message_type, message, sender, other_data = simple_pluck_dict(b, ['message_type', 'message', 'sender', 'other_data'])
-        msg = f"[{sender}] {message} {other_data if other_data else ''}"
-        if message_type == 'INFO':
-            logger.info(msg)
-        elif message_type == 'WARN':
-            logger.warning(msg)
-        elif message_type == 'ERROR':
-            logger.error(msg)
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        trigger = simple_pluck_dict(message, ['rule_id', 'kind', 'market', 'value', 'threshold', 'action'])
+        message_type, message, sender, other_data = simple_pluck_dict(message, ['message_type', 'message', 'sender', 'other_data'])
+        log = f"[{sender}] {message} {other_data if other_data else ''}"
+        if message_type == msg.LOG_INFO_MSG:
+            logger.info(log)
+        elif message_type == msg.LOG_WARN_MSG:
+            logger.warning(log)
+        elif message_type == msg.LOG_ERROR_MSG:
+            logger.error(log)
         elif message_type == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
             self.stop()
+        elif message_type == msg.TRIGGER_FIRED_MSG:
+            (rule_id, kind, market, value, threshold, action) = trigger
+            logger.warning(f"[{sender}] Trigger {rule_id} ({kind} on {market}) fired at {value} against {threshold}, "
+                           f"action {action}")
+        elif message_type == msg.CYCLE_COMPLETE_MSG:
+            # Cycle acks reach every queue through the fanout exchange, they're handled by
+            # executors/clock_executor.py
+            pass
         else:
-            logger.info(msg)
+            logger.info(log)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
+import typing
+
 POSITION_EXCHANGE = 'positions'
+# Direct exchange carrying trace spans to TRACE_QUEUE only, keeping them off the pipeline queues
+TRACE_EXCHANGE = 'tracing'
 POSITION_SCHEDULING_QUEUE = 'pos_scheduler'
 POSITION_EXECUTING_QUEUE = 'pos_executor'
 LOG_QUEUE = 'logs'
 CLOCK_QUEUE = 'clock'
 WATCHER_QUEUE = 'watcher'
 DB_WRITER_QUEUE = 'db_writer'
+TRACE_QUEUE = 'traces'
 
 def create_message_type(message: str, queue: str = '', exchange: str = '') -> str:
     """
@@ -20,6 +25,30 @@ def create_message_type(message: str, queue: str = '', exchange: str = '') -> st
     return cos
 
 
+def shard_queue(queue: str, *shard_keys: typing.Optional[str]) -> str:
+    """
+    Names the queue of one shard of executors (e.g. a strategy). Consumers of the same queue split its messages between
+    them, so executors which must each receive every message consume their own queue, bound to the fanout exchange.
+    """
+    return '.'.join([queue] + [key for key in shard_keys if key])
+
+
 TERMINATE_ALL_POSITIONS_EXC_MSG = create_message_type('terminate', exchange=POSITION_EXCHANGE)
 NORMAL_POSITION_SCHEDULING_MSG = create_message_type('cron', queue=POSITION_SCHEDULING_QUEUE,                                                     exchange=POSITION_EXCHANGE)
-CHANGE_POSITION_MSG = create_message_type('change_position', queue=POSITION_EXECUTING_QUEUE, exchange=POSITION_EXCHANGE)
\ No newline at end of file
+CHANGE_POSITION_MSG = create_message_type('change_position', queue=POSITION_EXECUTING_QUEUE, exchange=POSITION_EXCHANGE)
+# Strategy recalculations are the scheduled ("cron") messages of the scheduling queue
+POSITION_RECALCULATION_MSG = NORMAL_POSITION_SCHEDULING_MSG
+UPDATE_HISTORICAL_DATA_MSG = 'update_historical_data'
+RECORD_FILLS_MSG = 'record_fills'
+MARK_STRATEGY_FILLED_MSG = 'mark_strategy_filled'
+LOG_INFO_MSG = 'INFO'
+LOG_WARN_MSG = 'WARN'
+LOG_ERROR_MSG = 'ERROR'
+# Envelope for several messages published together (see MessageHelper#flush)
+BATCH_MSG = create_message_type('batch', exchange=POSITION_EXCHANGE)
+# Sent by an executor once it has finished a cycle triggered by the clock (see executors/clock_executor.py)
+CYCLE_COMPLETE_MSG = 'cycle_complete'
+# A finished span of a pipeline trace (see utils/tracing.py)
+TRACE_SPAN_MSG = 'trace_span'
+# A watch rule of executors/watcher_executor.py fired (see utils/trigger_engine.py)
+TRIGGER_FIRED_MSG = 'trigger_fired'
@@ -1,63 +1,201 @@
-import json
+import dataclasses
+import functools
 import typing
 
-import pika
 import message_constants as msg
+import message_schema
+from models.order_data import OrderData
+from models.trigger_rule import FiredTrigger
+from transport import Transport
+from utils.tracing import Span, TraceContext
 
 
 class MessageHelper:
-    def __init__(self, channel: pika.adapters.blocking_connection.BlockingChannel, sender: str):
-        self.channel = channel
+    """
+    Publishes messages between executors.
+    With batch_size > 1, messages are buffered and published together as a single batch message per queue, once
+    batch_size messages are pending or the oldest has waited max_batch_latency seconds. Critical messages (fills,
+    strategy updates, triggers) are never delayed: they flush anything buffered for the same queue, then are
+    published on their own - so consumers that ack per delivery (e.g. DbWriterExecutor) never receive them batched.
+    With confirm = True the channel uses publisher confirms, and every publish blocks until the broker has
+    accepted it.
+    Messages are validated & encoded through executors/message_schema.py. Messages published with a trace context
+    carry it (stamped with the publish time), so the consumer continues the trace - see utils/tracing.py.
+    """
+    def __init__(self, transport: Transport, sender: str, batch_size: int = 1, max_batch_latency: float = 0.25,
+                 confirm: bool = False, content_type: str = message_schema.MSGPACK_CONTENT_TYPE):
+        """
+        :param transport: the transport to publish on - publishes from threads other than its I/O thread are handed
+        to the I/O thread, as transports aren't thread safe
+        :param sender: the name of the sending executor
+        :param batch_size: the max number of buffered messages (1 publishes every message immediately)
+        :param max_batch_latency: the max seconds a message is buffered for
+        :param confirm: whether to enable publisher confirms on the channel
+        :param content_type: the message encoding, see executors/message_schema.py (JSON_CONTENT_TYPE for debugging)
+        """
+        self.transport = transport
         self.sender = sender
+        self.batch_size = batch_size
+        self.max_batch_latency = max_batch_latency
+        self.content_type = content_type
+        self._pending: typing.List[typing.Tuple[str, str, dict]] = []
+        self._flush_timer = None
+        if confirm:
+            self.transport.enable_confirms()
+
+    def _publish(self, routing_key: str, message: dict, exchange: str = msg.POSITION_EXCHANGE,
+                 critical: bool = False, trace: TraceContext = None):
+        if trace is not None:
+            message[message_schema.TRACE_FIELD] = trace.to_wire()
+        if not self.transport.is_io_thread():
+            self.transport.add_callback_threadsafe(
+                functools.partial(self._publish, routing_key, message, exchange, critical))
+            return
+        if critical or self.batch_size <= 1:
+            # Anything buffered for the same queue goes first, to keep that queue's messages in publish order
+            self.flush(exchange, routing_key)
+            self.__basic_publish(exchange, routing_key, message)
+            return
+        self._pending.append((exchange, routing_key, message))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_timer is None:
+            # The first buffered message starts the latency clock
+            self._flush_timer = self.transport.call_later(self.max_batch_latency, self.__on_flush_timer)
+
+    def flush(self, exchange: str = None, routing_key: str = None):
+        """
+        Publishes buffered messages, one batch per queue. Acts as a barrier: once this returns, everything
+        published before it has been sent (and confirmed, with publisher confirms on).
+        :param exchange: if given (with routing_key), only the messages buffered for this exchange & routing key are
+        published
+        :param routing_key: see exchange
+        """
+        if exchange is not None:
+            pending = [p for p in self._pending if p[:2] == (exchange, routing_key)]
+            self._pending = [p for p in self._pending if p[:2] != (exchange, routing_key)]
+        else:
+            pending, self._pending = self._pending, []
+        if not self._pending and self._flush_timer is not None:
+            self.transport.remove_timeout(self._flush_timer)
+            self._flush_timer = None
+        batches: typing.Dict[typing.Tuple[str, str], typing.List[dict]] = {}
+        for (exchange, routing_key, message) in pending:
+            batches.setdefault((exchange, routing_key), []).append(message)
+        for ((exchange, routing_key), messages) in batches.items():
+            self.__basic_publish(exchange, routing_key, messages[0] if len(messages) == 1 else {
+                "message_type": msg.BATCH_MSG,
+                "messages": messages,
+            })
+
+    def __on_flush_timer(self):
+        self._flush_timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            print(f'Failed publishing buffered messages: {repr(e)}')
+
+    def __basic_publish(self, exchange: str, routing_key: str, message: dict):
+        self.transport.publish(exchange, routing_key, message, self.content_type)
+
+    """
+    Messages to send to every executor
+    """
+    def terminate_all(self):
+        self._publish(msg.POSITION_SCHEDULING_QUEUE, {"message_type": msg.TERMINATE_ALL_POSITIONS_EXC_MSG},
+                      critical=True)
+        # executors/trace_collector.py only consumes from the trace exchange
+        self._publish(msg.TRACE_QUEUE, {"message_type": msg.TERMINATE_ALL_POSITIONS_EXC_MSG},
+                      exchange=msg.TRACE_EXCHANGE, critical=True)
 
     """
     Messages to send to executors/position_executor.py
     """
-    def position_executor_change_positions(self):
-        self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.POSITION_EXECUTING_QUEUE, body=json.dumps({"message_type": msg.CHANGE_POSITION_MSG}))
+    def position_executor_change_positions(self, cycle_id: str = None, trace: TraceContext = None):
+        self._publish(msg.POSITION_EXECUTING_QUEUE, {"message_type": msg.CHANGE_POSITION_MSG, "cycle_id": cycle_id},
+                      critical=True, trace=trace)
 
     """
     Messages to send to executors/strategy_executor.py
     """
-    def strategy_executor_recalculate_positions(self):
-        self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.POSITION_SCHEDULING_QUEUE, body=json.dumps({"message_type": msg.POSITION_RECALCULATION_MSG}))
+    def strategy_executor_recalculate_positions(self, cycle_id: str = None, trace: TraceContext = None):
+        self._publish(msg.POSITION_SCHEDULING_QUEUE, {"message_type": msg.POSITION_RECALCULATION_MSG,
+                                                      "cycle_id": cycle_id}, critical=True, trace=trace)
+
+    """
+    Messages to send to executors/clock_executor.py
+    """
+    def cycle_complete(self, cycle_id: typing.Optional[str], succeeded: bool = True):
+        """
+        Acknowledges a cycle triggered by the clock (a no-op for triggers sent without a cycle id).
+        """
+        if cycle_id is None:
+            return
+        self._publish(msg.CLOCK_QUEUE, {
+            "message_type": msg.CYCLE_COMPLETE_MSG,
+            "cycle_id": cycle_id,
+            "sender": self.sender,
+            "succeeded": succeeded,
+        }, critical=True)
+
+    """
+    Messages sent by executors/watcher_executor.py
+    """
+    def trigger_fired(self, trigger: FiredTrigger):
+        self._publish(msg.LOG_QUEUE, {
+            "message_type": msg.TRIGGER_FIRED_MSG,
+            "sender": self.sender,
+            "rule_id": trigger.rule.rule_id,
+            "market": trigger.rule.market,
+            "kind": trigger.rule.kind,
+            "action": trigger.rule.action,
+            "threshold": float(trigger.rule.threshold),
+            "value": float(trigger.value),
+            "time": float(trigger.time),
+        }, critical=True)
 
     """
     Messages to send to executors/log_executor.py
     """
 
     def log_info_message(self, message: str, other_data: dict):
-        self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.LOG_QUEUE, body=json.dumps(
-            {
-                "message_type": "INFO",
-                "sender": self.sender,
-                "message": message,
-                "other_data": other_data,
-            }
-        ))
+        self._publish(msg.LOG_QUEUE, {
+            "message_type": msg.LOG_INFO_MSG,
+            "sender": self.sender,
+            "message": message,
+            "other_data": other_data,
+        })
 
     def log_error_message(self, exception: str, other_data: dict):
-        self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.LOG_QUEUE, body=json.dumps(
-            {
-                "message_type": "ERROR",
-                "sender": self.sender,
-                "message": exception,
-                "other_data": other_data,
-            }
-        ))
+        self._publish(msg.LOG_QUEUE, {
+            "message_type": msg.LOG_ERROR_MSG,
+            "sender": self.sender,
+            "message": exception,
+            "other_data": other_data,
+        })
 
     """
     Messages to send to executors/db_writer_executor.py
     """
 
-    def db_write_strategy_filled(self, position_ids: typing.List[float]):
-        self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.DB_WRITER_QUEUE, body=json.dumps({
-                                       'message_type': 'mark_strategy_filled',
-                                       'position_ids': position_ids,
-                                   }))
+    def db_write_strategy_filled(self, position_ids: typing.List[float], trace: TraceContext = None):
+        self._publish(msg.DB_WRITER_QUEUE, {
+            'message_type': msg.MARK_STRATEGY_FILLED_MSG,
+            'position_ids': position_ids,
+        }, critical=True, trace=trace)
+
+    def db_write_fill_order_data(self, order_data: OrderData, trace: TraceContext = None):
+        self._publish(msg.DB_WRITER_QUEUE, {
+            'message_type': msg.RECORD_FILLS_MSG,
+            'order_data': order_data,
+        }, critical=True, trace=trace)
+
+    """
+    Messages to send to executors/trace_collector.py
+    """
 
-    def db_write_fill_order_data(self, order_data: dict):
-        self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.DB_WRITER_QUEUE, body=json.dumps({
-                                       'message_type': 'record_fills',
-                                       'order_data': order_data,
-                                   }))
+    def trace_span(self, span: Span):
+        self._publish(msg.TRACE_QUEUE, {
+            'message_type': msg.TRACE_SPAN_MSG,
+            **dataclasses.asdict(span),
+        }, exchange=msg.TRACE_EXCHANGE)
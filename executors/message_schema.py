@@ -0,0 +1,233 @@
+import dataclasses
+import json
+import typing
+from dataclasses import dataclass
+
+import msgpack
+
+import message_constants as msg
+from models.order_data import OrderData
+
+"""
+Registry of every message type exchanged between executors, and their wire encoding.
+Messages are handled as dicts of {"message_type": ..., <fields>}. On the wire they're encoded as compact msgpack
+arrays of [tag, version, *field values] - the field names are implied by the schema - or, as a debug fallback, as
+JSON objects of {"message_type", "version", <fields>}. The encoding is carried in the AMQP content_type.
+Values msgpack/JSON can't represent inside free-form fields (e.g. timestamps in a log's other_data) are sent as
+strings.
+Messages are validated against their schema both when encoded and when decoded; a schema change that alters its
+fields must bump its version.
+Any message may also carry an optional `trace` field, the trace context of the cycle it belongs to (see
+utils/tracing.py). It's an envelope field rather than part of a schema: appended after the field values on msgpack
+arrays, and a plain key on JSON objects.
+"""
+
+MSGPACK_CONTENT_TYPE: typing.Final = 'application/x-msgpack'
+JSON_CONTENT_TYPE: typing.Final = 'application/json'
+TRACE_FIELD: typing.Final = 'trace'
+
+
+class MessageSchemaException(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class MessageField:
+    name: str
+    types: typing.Tuple[type, ...]
+    # (value, compact) -> wire value & (wire value, compact) -> value, for fields that aren't plain msgpack/JSON types
+    to_wire: typing.Callable[[typing.Any, bool], typing.Any] = None
+    from_wire: typing.Callable[[typing.Any, bool], typing.Any] = None
+
+
+@dataclass(frozen=True)
+class MessageSchema:
+    message_type: str
+    tag: int
+    version: int
+    fields: typing.Tuple[MessageField, ...] = ()
+
+
+def _order_data_to_wire(order_data: OrderData, compact: bool):
+    return list(dataclasses.astuple(order_data)) if compact else dataclasses.asdict(order_data)
+
+
+def _order_data_from_wire(value, compact: bool) -> OrderData:
+    return OrderData(*value) if compact else OrderData(**value)
+
+
+def _messages_to_wire(messages: typing.List[dict], compact: bool) -> list:
+    return [_to_wire(message, compact) for message in messages]
+
+
+def _messages_from_wire(values: list, compact: bool) -> typing.List[dict]:
+    return [_from_wire(value, compact) for value in values]
+
+
+_LOG_FIELDS = (
+    MessageField('sender', (str,)),
+    MessageField('message', (str,)),
+    MessageField('other_data', (dict, str, type(None))),
+)
+
+# Cycles triggered by the clock carry an id, acknowledged by CYCLE_COMPLETE_MSG
+_CYCLE_FIELDS = (
+    MessageField('cycle_id', (str, type(None))),
+)
+
+SCHEMAS: typing.Final = (
+    MessageSchema(msg.TERMINATE_ALL_POSITIONS_EXC_MSG, tag=1, version=1),
+    MessageSchema(msg.POSITION_RECALCULATION_MSG, tag=2, version=2, fields=_CYCLE_FIELDS),
+    MessageSchema(msg.CHANGE_POSITION_MSG, tag=3, version=2, fields=_CYCLE_FIELDS),
+    MessageSchema(msg.UPDATE_HISTORICAL_DATA_MSG, tag=4, version=1),
+    MessageSchema(msg.RECORD_FILLS_MSG, tag=5, version=1, fields=(
+        MessageField('order_data', (OrderData,), _order_data_to_wire, _order_data_from_wire),
+    )),
+    MessageSchema(msg.MARK_STRATEGY_FILLED_MSG, tag=6, version=1, fields=(
+        MessageField('position_ids', (list,)),
+    )),
+    MessageSchema(msg.LOG_INFO_MSG, tag=7, version=1, fields=_LOG_FIELDS),
+    MessageSchema(msg.LOG_WARN_MSG, tag=8, version=1, fields=_LOG_FIELDS),
+    MessageSchema(msg.LOG_ERROR_MSG, tag=9, version=1, fields=_LOG_FIELDS),
+    MessageSchema(msg.BATCH_MSG, tag=10, version=1, fields=(
+        MessageField('messages', (list,), _messages_to_wire, _messages_from_wire),
+    )),
+    MessageSchema(msg.TRACE_SPAN_MSG, tag=11, version=1, fields=(
+        MessageField('trace_id', (str,)),
+        MessageField('span_id', (str,)),
+        MessageField('parent_id', (str, type(None))),
+        MessageField('stage', (str,)),
+        MessageField('sender', (str,)),
+        MessageField('start', (float,)),
+        MessageField('end', (float,)),
+        MessageField('links', (list,)),
+    )),
+    MessageSchema(msg.CYCLE_COMPLETE_MSG, tag=12, version=1, fields=(
+        MessageField('cycle_id', (str,)),
+        MessageField('sender', (str,)),
+        MessageField('succeeded', (bool,)),
+    )),
+    MessageSchema(msg.TRIGGER_FIRED_MSG, tag=13, version=1, fields=(
+        MessageField('sender', (str,)),
+        MessageField('rule_id', (str,)),
+        MessageField('market', (str,)),
+        MessageField('kind', (str,)),
+        MessageField('action', (str,)),
+        MessageField('threshold', (float,)),
+        MessageField('value', (float,)),
+        MessageField('time', (float,)),
+    )),
+)
+
+_SCHEMAS_BY_TYPE: typing.Final = {schema.message_type: schema for schema in SCHEMAS}
+_SCHEMAS_BY_TAG: typing.Final = {schema.tag: schema for schema in SCHEMAS}
+
+
+def register_schema(schema: MessageSchema):
+    """
+    Registers a new message type (e.g. for messages defined outside of executors/message_helper.py).
+    """
+    existing = _SCHEMAS_BY_TYPE.get(schema.message_type) or _SCHEMAS_BY_TAG.get(schema.tag)
+    if existing is not None and existing != schema:
+        raise MessageSchemaException(f'Conflicting schemas for {schema.message_type} (tag {schema.tag})')
+    _SCHEMAS_BY_TYPE[schema.message_type] = schema
+    _SCHEMAS_BY_TAG[schema.tag] = schema
+
+
+def get_schema(message_type: str) -> MessageSchema:
+    if message_type not in _SCHEMAS_BY_TYPE:
+        raise MessageSchemaException(f'Unknown message type {message_type}')
+    return _SCHEMAS_BY_TYPE[message_type]
+
+
+def encode(message: dict, content_type: str = MSGPACK_CONTENT_TYPE) -> bytes:
+    """
+    Validates a message against its schema & encodes it.
+    :param message: a dict of {"message_type": ..., <fields>}
+    :param content_type: either MSGPACK_CONTENT_TYPE or JSON_CONTENT_TYPE
+    :return: the encoded body
+    """
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.packb(_to_wire(message, compact=True), default=str)
+    if content_type == JSON_CONTENT_TYPE:
+        return json.dumps(_to_wire(message, compact=False), default=str).encode()
+    raise MessageSchemaException(f'Unsupported content type {content_type}')
+
+
+def decode(body: bytes, content_type: str = None) -> dict:
+    """
+    Decodes a message body & validates it against its schema.
+    :param body: the encoded body
+    :param content_type: the body's content type - bodies without one are assumed to be JSON
+    :return: a dict of {"message_type": ..., <fields>}
+    """
+    if content_type not in (MSGPACK_CONTENT_TYPE, JSON_CONTENT_TYPE, None):
+        raise MessageSchemaException(f'Unsupported content type {content_type}')
+    try:
+        if content_type == MSGPACK_CONTENT_TYPE:
+            return _from_wire(msgpack.unpackb(body), compact=True)
+        return _from_wire(json.loads(body), compact=False)
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        # Bodies which aren't valid msgpack/JSON, or not shaped like a message
+        raise MessageSchemaException(f'Malformed {content_type or JSON_CONTENT_TYPE} body: {repr(e)}') from e
+
+
+def validate(message: dict):
+    """
+    Validates a message against its schema, without encoding it (e.g. for in-process transports).
+    """
+    _validate(get_schema(message.get('message_type')), message)
+
+
+def _to_wire(message: dict, compact: bool):
+    schema = get_schema(message.get('message_type'))
+    _validate(schema, message)
+    values = [field.to_wire(message[field.name], compact) if field.to_wire else message[field.name]
+              for field in schema.fields]
+    trace = message.get(TRACE_FIELD)
+    if compact:
+        return [schema.tag, schema.version, *values, *([trace] if trace is not None else [])]
+    return {'message_type': schema.message_type, 'version': schema.version,
+            **{field.name: value for (field, value) in zip(schema.fields, values)},
+            **({TRACE_FIELD: trace} if trace is not None else {})}
+
+
+def _from_wire(value, compact: bool) -> dict:
+    try:
+        if compact:
+            (tag, version, *values) = value
+            schema = _SCHEMAS_BY_TAG[tag]
+            trace = values.pop() if len(values) == len(schema.fields) + 1 else None
+        else:
+            schema, version = get_schema(value['message_type']), value['version']
+            values = [value[field.name] for field in schema.fields]
+            trace = value.get(TRACE_FIELD)
+    except (KeyError, TypeError, ValueError) as e:
+        raise MessageSchemaException(f'Malformed message {value}') from e
+    if version != schema.version:
+        raise MessageSchemaException(
+            f'Unsupported {schema.message_type} version {version}, expected {schema.version}')
+    if len(values) != len(schema.fields):
+        raise MessageSchemaException(
+            f'Expected {len(schema.fields)} fields for {schema.message_type}, received {len(values)}')
+    message = {'message_type': schema.message_type}
+    for (field, field_value) in zip(schema.fields, values):
+        message[field.name] = field.from_wire(field_value, compact) if field.from_wire else field_value
+    if trace is not None:
+        message[TRACE_FIELD] = trace
+    _validate(schema, message)
+    return message
+
+
+def _validate(schema: MessageSchema, message: dict):
+    expected = {field.name for field in schema.fields} | {'message_type'}
+    if set(message.keys()) - {TRACE_FIELD} != expected:
+        raise MessageSchemaException(
+            f'Fields {sorted(message.keys())} do not match the {schema.message_type} schema {sorted(expected)}')
+    for field in schema.fields:
+        if not isinstance(message[field.name], field.types):
+            raise MessageSchemaException(f'{schema.message_type}.{field.name} must be one of {field.types}, '
+                                         f'received {type(message[field.name])}')
+    trace = message.get(TRACE_FIELD)
+    if trace is not None and not (isinstance(trace, dict) and isinstance(trace.get('trace_id'), str)):
+        raise MessageSchemaException(f'Malformed trace context {trace} on {schema.message_type}')
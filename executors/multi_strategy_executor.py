@@ -0,0 +1,188 @@
+import dataclasses
+import importlib
+import time
+import typing
+
+import multiprocess
+from pika.exchange_type import ExchangeType
+
+from accessors.db_accessor import DbAccessor
+from accessors.market_data_snapshot import MarketDataSnapshotService
+from config import Config
+import message_constants as msg
+from executors.simple_executor import SimpleExecutor
+from executors.strategy_executor import RecalculationGate, StrategyExecutor
+from models.position import Position
+from transport import Transport
+from utils.tracing import TraceContext
+
+"""
+Runs many strategies per recalculation cycle from a single executor.
+"""
+
+
+def discover_strategies(modules: typing.Sequence[str]) -> typing.List[typing.Type[StrategyExecutor]]:
+    """
+    Imports each module & collects the StrategyExecutor subclasses defined in it which implement run_strategy.
+    :param modules: importable module names (e.g. strategies.momentum)
+    :return: the strategy classes, in module then definition order
+    """
+    strategies = []
+    for module_name in modules:
+        module = importlib.import_module(module_name)
+        for value in vars(module).values():
+            if isinstance(value, type) and issubclass(value, StrategyExecutor) and value.__module__ == module.__name__ \
+                    and value.run_strategy is not StrategyExecutor.run_strategy:
+                strategies.append(value)
+    return strategies
+
+
+def configured_strategy_modules() -> typing.List[str]:
+    """
+    :return: the STRATEGY_MODULES config property - a list, or a comma separated string when set from the env
+    """
+    modules = Config.get_property("STRATEGY_MODULES", []).value or []
+    if isinstance(modules, str):
+        modules = modules.split(',')
+    return [module.strip() for module in modules if module.strip()]
+
+
+def _compute_positions(strategy: typing.Type[StrategyExecutor]) -> typing.Tuple[typing.List[Position], float]:
+    start = time.time()
+    positions = strategy.compute_positions()
+    return positions, time.time() - start
+
+
+class MultiStrategyExecutor(SimpleExecutor):
+    """
+    Runs every strategy on each recalculation cycle in a process pool, in place of one StrategyExecutor process per
+    strategy. Strategies run concurrently, each under its own timeout, and the positions of every strategy that
+    finished are written to strategy_queue together in one bulk insert - so a cycle takes as long as the slowest
+    strategy (or the timeout), rather than the sum of all of them.
+    A strategy that fails or times out is logged & skipped for the cycle, without holding back the others. As a
+    timed out strategy may still be occupying its worker, the pool is replaced after any timeout.
+    As with StrategyExecutor, only strategies with new input data are run, and only changed positions are written.
+    With a snapshot_service, the market data snapshot is refreshed before strategies run, so they can read it through
+    MarketDataSnapshot#attach rather than each querying the DB.
+    """
+    def __init__(self, rabbit_mq_host: str = None, strategies: typing.Sequence[typing.Type[StrategyExecutor]] = None,
+                 processes: int = None, strategy_timeout: float = 30,
+                 snapshot_service: MarketDataSnapshotService = None, transport: Transport = None):
+        """
+        :param strategies: the StrategyExecutor subclasses to run (defaults to those discovered in STRATEGY_MODULES)
+        :param processes: the pool size (defaults to one process per strategy, up to the number of CPUs)
+        :param strategy_timeout: seconds each strategy may run for, from the start of the cycle
+        :param snapshot_service: an optional service refreshing the market data snapshot each cycle
+        """
+        self.strategies = list(strategies) if strategies is not None \
+            else discover_strategies(configured_strategy_modules())
+        if not self.strategies:
+            raise Exception('No strategies to run, set STRATEGY_MODULES or pass strategies')
+        self.processes = processes or max(1, min(len(self.strategies), multiprocess.cpu_count()))
+        self.strategy_timeout = strategy_timeout
+        # The pool is started before the broker connection, so workers don't inherit its socket
+        self._strategy_pool = multiprocess.Pool(self.processes)
+        super().__init__(rabbit_mq_host=rabbit_mq_host,
+                         exchange=msg.POSITION_EXCHANGE,
+                         exchange_type=ExchangeType.fanout,
+                         queue=msg.POSITION_SCHEDULING_QUEUE,
+                         transport=transport)
+        self.db_accessor = DbAccessor()
+        self.gate = RecalculationGate()
+        self.snapshot_service = snapshot_service
+
+    def run_strategies(self, strategies: typing.Sequence[typing.Type[StrategyExecutor]] = None) \
+            -> typing.Tuple[typing.Dict[str, typing.List[Position]], typing.Dict[str, str]]:
+        """
+        Runs strategies concurrently.
+        :param strategies: the strategies to run (defaults to all of them)
+        :return: a tuple of (strategy name -> positions for the successful strategies, strategy name -> error for the
+        others)
+        """
+        strategies = self.strategies if strategies is None else strategies
+        deadline = time.monotonic() + self.strategy_timeout
+        results = [(strategy, self._strategy_pool.apply_async(_compute_positions, (strategy,)))
+                   for strategy in strategies]
+        positions = {}
+        errors = {}
+        for (strategy, result) in results:
+            try:
+                (strategy_positions, seconds) = result.get(timeout=max(0.0, deadline - time.monotonic()))
+                positions[strategy.strategy_name()] = strategy_positions
+                print(f'{strategy.strategy_name()} computed {len(strategy_positions)} positions in {seconds:.3f}s')
+            except multiprocess.TimeoutError:
+                errors[strategy.strategy_name()] = f'Timed out after {self.strategy_timeout}s'
+            except Exception as e:
+                errors[strategy.strategy_name()] = repr(e)
+        if any(error.startswith('Timed out') for error in errors.values()):
+            self._strategy_pool.terminate()
+            self._strategy_pool = multiprocess.Pool(self.processes)
+        return positions, errors
+
+    def recalculate_positions(self, trace: TraceContext = None) -> bool:
+        """
+        :return: whether every strategy's positions are up to date
+        """
+        try:
+            series = [s for strategy in self.strategies for s in (strategy.input_series or [])]
+            watermarks = self.db_accessor.get_series_watermarks(series)
+            strategy_watermarks = {strategy.strategy_name(): strategy.input_watermarks(watermarks)
+                                   for strategy in self.strategies}
+            due = [strategy for strategy in self.strategies
+                   if self.gate.needs_recalculation(strategy.strategy_name(),
+                                                    strategy_watermarks[strategy.strategy_name()])]
+            if not due:
+                print('No new input data for any strategy, skipping recalculation')
+                return True
+            if self.snapshot_service is not None:
+                try:
+                    with self.tracer.span(trace, 'snapshot'):
+                        self.snapshot_service.refresh()
+                except Exception as e:
+                    # Strategies still run, against the previous snapshot
+                    self.message_helper.log_error_message(exception="Unable to refresh the market data snapshot",
+                                                          other_data={"error": repr(e)})
+            with self.tracer.span(trace, 'compute'):
+                (results, errors) = self.run_strategies(due)
+            for (strategy_name, error) in errors.items():
+                self.message_helper.log_error_message(
+                    exception=f"Unable to recompute positions for strategy {strategy_name}",
+                    other_data={"error": error})
+            changed = {strategy_name: positions for (strategy_name, positions) in results.items()
+                       if self.gate.needs_write(strategy_name, positions)}
+            positions = [position for strategy_positions in changed.values() for position in strategy_positions]
+            if changed:
+                with self.tracer.span(trace, 'db_write'):
+                    insert_ts = self.db_accessor.write_new_strategy_positions(
+                        positions, trace_id=trace.trace_id if trace is not None else None)
+                self.message_helper.log_info_message(
+                    message=f"Successfully calculated positions for {len(changed)} changed of {len(due)} "
+                            f"recalculated strategies at {insert_ts}",
+                    other_data={"positions": [dataclasses.asdict(position) for position in positions]})
+            for (strategy_name, strategy_positions) in changed.items():
+                self.gate.written(strategy_name, strategy_positions)
+            for strategy_name in results:
+                self.gate.recalculated(strategy_name, strategy_watermarks[strategy_name])
+            return not errors
+        except Exception as e:
+            self.message_helper.log_error_message(exception="Unable to write recomputed positions",
+                                                  other_data={"error": repr(e)})
+            return False
+
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        b = message
+        if b['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
+            print('Terminating multi strategy executor...')
+            self.stop()
+        elif b['message_type'] == msg.POSITION_RECALCULATION_MSG:
+            print('Recalculating positions...')
+            succeeded = self.recalculate_positions(trace=self.tracer.received(b.get('trace')))
+            self.message_helper.cycle_complete(b['cycle_id'], succeeded)
+
+    def stop(self):
+        self._strategy_pool.terminate()
+        super().stop()
+
+
+if __name__ == '__main__':
+    MultiStrategyExecutor(rabbit_mq_host=Config.get_property("RABBITMQ_SERVER_URI", "localhost").unwrap()).run()
@@ -0,0 +1,87 @@
+import threading
+import time
+import typing
+
+from config import Config
+from executors.clock_executor import ClockExecutor
+from executors.db_writer_executor import DbWriterExecutor
+from executors.log_executor import LogConsumer
+from executors.position_executor import PositionExecutor
+from executors.simple_executor import SimpleExecutor
+from executors.trace_collector import TraceCollector
+from transport import Transport, InProcessBroker, InProcessTransport
+
+"""
+Runs the execution pipeline (clock, strategies, position executor, DB writer, log consumer & trace collector) in a
+single process.
+"""
+
+
+class Pipeline:
+    """
+    Runs executors in one process over a shared InProcessBroker, each consuming on its own thread - no RabbitMQ
+    and no message serialization, for low latency single host deployments & broker-free integration tests.
+    """
+    def __init__(self, broker: InProcessBroker = None):
+        self.broker = broker if broker is not None else InProcessBroker()
+        self.executors: typing.List[SimpleExecutor] = []
+        self._threads: typing.List[threading.Thread] = []
+
+    def add(self, create_executor: typing.Callable[[Transport], SimpleExecutor]) -> SimpleExecutor:
+        """
+        :param create_executor: a function creating an executor on the transport it's given
+        :return: the executor
+        """
+        executor = create_executor(InProcessTransport(self.broker))
+        self.executors.append(executor)
+        return executor
+
+    def start(self):
+        for executor in self.executors:
+            thread = threading.Thread(target=executor.run, name=executor.__class__.__name__, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10):
+        for executor in self.executors:
+            if executor.transport.is_open:
+                executor.stop()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def is_alive(self) -> bool:
+        return all(thread.is_alive() for thread in self._threads)
+
+
+def build_pipeline(strategy_executors: typing.Sequence[typing.Type[SimpleExecutor]] = (), api_key: str = None,
+                   api_secret: str = None, subaccount: str = None, broker: InProcessBroker = None) -> Pipeline:
+    """
+    :param strategy_executors: StrategyExecutor subclasses to run (each is created with only a transport)
+    :return: a pipeline of the log consumer, trace collector, DB writer, position executor, strategies & clock
+    """
+    pipeline = Pipeline(broker)
+    pipeline.add(lambda transport: LogConsumer(transport=transport))
+    pipeline.add(lambda transport: TraceCollector(transport=transport))
+    pipeline.add(lambda transport: DbWriterExecutor(api_key=api_key, api_secret=api_secret, subaccount=subaccount,
+                                                    transport=transport))
+    pipeline.add(lambda transport: PositionExecutor(api_key=api_key, api_secret=api_secret, subaccount=subaccount,
+                                                    transport=transport))
+    for strategy_executor in strategy_executors:
+        pipeline.add(lambda transport, executor=strategy_executor: executor(transport=transport))
+    # The clock goes last, so every queue is bound before its first tick
+    pipeline.add(lambda transport: ClockExecutor(strategy_count=len(strategy_executors), transport=transport))
+    return pipeline
+
+
+if __name__ == '__main__':
+    pipeline = build_pipeline(api_key=Config.get_property("FTX_API_KEY").unwrap(),
+                              api_secret=Config.get_property("FTX_API_SECRET").unwrap(),
+                              subaccount=Config.get_property("FTX_SUBACCOUNT_NAME").unwrap())
+    pipeline.start()
+    try:
+        while pipeline.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
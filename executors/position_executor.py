@@ -1,4 +1,6 @@
-import json
+import os
+import socket
+import time
 from collections import Counter
 
 from pika.exchange_type import ExchangeType
@@ -9,18 +11,34 @@ from config import Config
 from accessors.db_accessor import DbAccessor
 from accessors.ftx_order_handler import FtxOrderHandler
 from executors.simple_executor import SimpleExecutor
+from transport import Transport
 from models.position import Position
-import dataclasses
+from utils.tracing import TraceContext
 
 class PositionExecutor(SimpleExecutor):
-    def __init__(self, rabbit_mq_host: str = None, api_key: str = None, api_secret: str = None, subaccount: str = None):
+    """
+    Executes unprocessed strategy positions against an exchange account.
+    Positions are claimed from strategy_queue (see DbAccessor#claim_batch), so several executors can run in
+    parallel as long as each is sharded to its own strategy - netting is computed over every position claimed
+    in a cycle, so a single strategy's positions should never be split between executors.
+    Each shard (subaccount & strategy) consumes its own queue, so every shard receives every execution trigger.
+    Executors of the same shard share its queue, and so take turns handling its cycles.
+    """
+    def __init__(self, rabbit_mq_host: str = None, api_key: str = None, api_secret: str = None, subaccount: str = None,
+                 strategy: str = None, lease_seconds: int = 300, transport: Transport = None):
+        # Per-fill logs are batched, fills & strategy updates are published (and confirmed) immediately
         super().__init__(rabbit_mq_host=rabbit_mq_host,
-                         queue=msg.POSITION_EXECUTING_QUEUE, exchange=msg.POSITION_EXCHANGE, exchange_type=ExchangeType.fanout)
+                         queue=msg.shard_queue(msg.POSITION_EXECUTING_QUEUE, subaccount, strategy),
+                         exchange=msg.POSITION_EXCHANGE, exchange_type=ExchangeType.fanout,
+                         publish_batch_size=50, publisher_confirms=True, transport=transport)
         self.rest_client = WrappedFtxClient(api_key=api_key, api_secret=api_secret, subaccount_name=subaccount)
         self.db_accessor = DbAccessor()
         self._api_key = api_key
         self._api_secret = api_secret
         self._subacount = subaccount
+        self.strategy = strategy
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{subaccount or ''}:{strategy or '*'}"
 
     def on_error(self, error):
         pass
@@ -75,14 +93,26 @@ class PositionExecutor(SimpleExecutor):
         counter.subtract(Counter(existing_notional_exposures))
         return counter
 
-    def execute_position_changes(self):
-        new_positions = self.db_accessor.fetch_unfilled_strategies()
+    def execute_position_changes(self, trace: TraceContext = None):
+        """
+        :param trace: the trace of the cycle that triggered the execution - each order is a stage of it, and its
+        fills are written under its trace_id
+        """
+        claim_start = time.time()
+        new_positions = self.db_accessor.claim_batch(strategy=self.strategy, worker_id=self.worker_id,
+                                                     lease_seconds=self.lease_seconds)
+        # The claim links the execution to the strategy runs which wrote the positions
+        self.tracer.record(trace, 'claim', claim_start, time.time(),
+                           links=[pos.trace_id for pos in new_positions if pos.trace_id])
         if not new_positions:
-            raise Exception('No positions found')
+            # Strategies only write positions that changed, so most cycles have nothing new to execute
+            print('No new positions to execute')
+            return
         # For netting purposes, let's consider everything that isn't a PERP to be denominated in USDT
         # In the future, it may make sense
-        counter = self.__get_notional_netted_weightings(new_positions)
-        orders = self.__create_optimal_position_execution_ordering(counter)
+        with self.tracer.span(trace, 'netting'):
+            counter = self.__get_notional_netted_weightings(new_positions)
+            orders = self.__create_optimal_position_execution_ordering(counter)
         for idx, (market, _) in enumerate(orders):
             # Ignore this malformed type
             if market == 'USD/USD':
@@ -90,32 +120,40 @@ class PositionExecutor(SimpleExecutor):
             value = counter.get(market)
             side = 'buy' if value >= 0 else 'sell'
             try:
-                order_handler = FtxOrderHandler(api_key=self._api_key,
-                                                api_secret=self._api_secret,
-                                                subaccount=self._subacount)
+                with self.tracer.span(trace, 'exchange'):
+                    order_handler = FtxOrderHandler(api_key=self._api_key,
+                                                    api_secret=self._api_secret,
+                                                    subaccount=self._subacount)
 
-                order_data = order_handler.fill_limit_order_in_quote_units(
-                    market=market, side=side, size_in_quote=abs(value), aggression=0.5
-                )
-                order_handler.close()
-                self.message_helper.db_write_fill_order_data(order_data=dataclasses.asdict(order_data))
+                    order_data = order_handler.fill_limit_order_in_quote_units(
+                        market=market, side=side, size_in_quote=abs(value), aggression=0.5
+                    )
+                    order_handler.close()
+                self.message_helper.db_write_fill_order_data(order_data=order_data, trace=trace)
             except Exception as e:
                 print(f'Exception occurred {e}')
                 self.message_helper.log_error_message(exception=str(e), other_data={"market": market, "exchange": "FTX"})
                 continue
             self.message_helper.log_info_message(message=f"Successful fill - {market} @ {abs(value)} [{side}]", other_data={"market": market, "exchange": "FTX"})
-            counter = self.__get_notional_netted_weightings(new_positions)
-        self.message_helper.db_write_strategy_filled(position_ids=[pos.id for pos in new_positions])
+            with self.tracer.span(trace, 'netting'):
+                counter = self.__get_notional_netted_weightings(new_positions)
+        self.message_helper.db_write_strategy_filled(position_ids=[pos.id for pos in new_positions], trace=trace)
 
-    def on_message_consumption(self, ch, method, properties, body):
-        b = json.loads(body)
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        b = message
         if b['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
             print('Terminating position executor...')
             self.stop()
-        elif b['message_type'] == 'POSITION_RECALCULATE':
+        elif b['message_type'] == msg.CHANGE_POSITION_MSG:
             print("Executing position changes...")
-            self.execute_position_changes()
-        elif b['message_type'] == 'ERROR':
+            try:
+                self.execute_position_changes(trace=self.tracer.received(b.get('trace')))
+                self.message_helper.cycle_complete(b['cycle_id'])
+            except Exception as e:
+                # The clock waits on the ack before starting the next execution, so failed cycles are acked too
+                self.message_helper.cycle_complete(b['cycle_id'], succeeded=False)
+                self.message_helper.log_error_message(exception=str(e), other_data={"cycle_id": b['cycle_id']})
+        elif b['message_type'] == msg.LOG_ERROR_MSG:
             print("Error occurred in scheduler/executor")
             self.on_error(b)
 
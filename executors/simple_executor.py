@@ -1,34 +1,231 @@
-import abc
-import pika
+import functools
+import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import multiprocess
+from pika.exchange_type import ExchangeType
 
 from executors.message_helper import MessageHelper
+import message_constants as msg
+import message_schema
+from transport import Transport, RabbitMqTransport
+from utils.tracing import Tracer
+
+DISPATCH_MODES: typing.Final = ('inline', 'thread', 'process')
 
 
 class SimpleExecutor:
     """
     Simple implementation of a RabbitMQ pubsub process which can be ran independently, listening and receiving messages.
+    The broker is reached through a Transport (see executors/transport.py) - RabbitMQ by default, or an in-process
+    broker to run several executors in one process (see executors/pipeline.py).
+
+    By default messages are handled inline on the connection's I/O thread. With dispatch = 'thread' or 'process',
+    deliveries are instead handed to a pool of workers and acknowledged only once they've been handled, with at most
+    `prefetch_count` unacknowledged deliveries in flight - the I/O thread stays free for heartbeats & new deliveries,
+    and a crash mid-handling leaves the message to be redelivered.
+
+    Deliveries are decoded & validated (see executors/message_schema.py) before they're handled, and batches
+    published by MessageHelper are unpacked - handlers receive each message as a dict, in publish order.
+
+    `tracer` records the executor's stages of traced cycles, publishing its spans to executors/trace_collector.py
+    (see utils/tracing.py).
     """
-    def __init__(self, rabbit_mq_host: str, exchange: str, exchange_type: str, queue: str):
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=rabbit_mq_host)
-        )
-        self.channel = self.connection.channel()
-        self.channel.exchange_declare(exchange, exchange_type=exchange_type)
-        r = self.channel.queue_declare(queue=queue)
-        self.channel.queue_bind(r.method.queue, exchange=exchange)
-        self.channel.basic_consume(queue=queue,
-                                   on_message_callback=self.on_message_consumption,
-                                   auto_ack=True)
+    def __init__(self, rabbit_mq_host: str, exchange: str, exchange_type: str, queue: str, auto_ack: bool = True,
+                 prefetch_count: int = None, dispatch: str = 'inline', num_workers: int = 4,
+                 ordering_key: typing.Callable[[dict], typing.Hashable] = None, publish_batch_size: int = 1,
+                 publish_batch_latency: float = 0.25, publisher_confirms: bool = False,
+                 message_content_type: str = message_schema.MSGPACK_CONTENT_TYPE, transport: Transport = None):
+        """
+        :param auto_ack: whether deliveries are acknowledged on receipt (inline dispatch only, pooled dispatch always
+        acknowledges after handling)
+        :param prefetch_count: the max number of unacknowledged deliveries (defaults to 2 * num_workers when pooled)
+        :param dispatch: one of 'inline' (#on_message_consumption on the I/O thread), 'thread'
+        (#on_message_consumption on a thread pool) or 'process' (#process_message on a process pool, its result
+        passed to #on_processed on the I/O thread)
+        :param num_workers: the pool size for pooled dispatch
+        :param ordering_key: an optional function of a message - pooled deliveries with the same key are handled one
+        at a time, in delivery order (a batched delivery is handled as a unit, keyed by its first message)
+        :param publish_batch_size: see MessageHelper
+        :param publish_batch_latency: see MessageHelper
+        :param publisher_confirms: see MessageHelper
+        :param message_content_type: the encoding of published messages (see executors/message_schema.py)
+        :param transport: the transport to the broker (defaults to a RabbitMqTransport to rabbit_mq_host)
+        """
+        if dispatch not in DISPATCH_MODES:
+            raise Exception(f'Unknown dispatch mode {dispatch}, expected one of {DISPATCH_MODES}')
+        if dispatch == 'process' and type(self).process_message is SimpleExecutor.process_message:
+            raise Exception(f'{self.__class__.__name__} must override process_message to use process dispatch')
+        # The pool is started first, so worker processes don't inherit the connection's socket
+        self._pool = None
+        if dispatch == 'thread':
+            self._pool = ThreadPoolExecutor(max_workers=num_workers)
+        elif dispatch == 'process':
+            self._pool = multiprocess.Pool(num_workers)
+        self.transport = transport if transport is not None else RabbitMqTransport(rabbit_mq_host)
+        self.transport.declare_queue(exchange, exchange_type, queue)
+        # Every executor may publish spans (see #tracer)
+        self.transport.declare_exchange(msg.TRACE_EXCHANGE, ExchangeType.direct)
+        self.dispatch = dispatch
+        self.ordering_key = ordering_key
+        # ordering key -> deliveries waiting on the one currently being handled
+        self._lanes: typing.Dict[typing.Hashable, deque] = {}
+        if prefetch_count is not None or self._pool is not None:
+            self.transport.set_prefetch(prefetch_count or 2 * num_workers)
+        self._auto_ack = auto_ack and self._pool is None
+        self.transport.consume(queue, self.__on_inline_delivery if self._pool is None else self.__on_delivery,
+                               auto_ack=self._auto_ack)
         # This looks like magic, but it should properly reflect the name of the superclass extending this
-        self.message_helper = MessageHelper(self.channel, self.__class__.__name__)
+        self.message_helper = MessageHelper(self.transport, self.__class__.__name__,
+                                            batch_size=publish_batch_size, max_batch_latency=publish_batch_latency,
+                                            confirm=publisher_confirms, content_type=message_content_type)
+        self.tracer = Tracer(self.__class__.__name__, self.message_helper.trace_span)
         print(' [*] Waiting for messages. To exit press CTRL+C')
 
-    @abc.abstractmethod
-    def on_message_consumption(self, ch, method, properties, body):
+    def on_message_consumption(self, ch: Transport, method, properties, message: dict):
+        """
+        The handler for inline & thread dispatch, every executor using them must override it.
+        """
         pass
 
+    @staticmethod
+    def decode_messages(body: typing.Union[bytes, dict], properties) -> typing.List[dict]:
+        """
+        Decodes a delivery's body into its messages (a single message, or the contents of a batch).
+        In-process transports deliver the message itself, which is used as is.
+        """
+        if isinstance(body, dict):
+            message = body
+        else:
+            message = message_schema.decode(body, properties.content_type if properties is not None else None)
+        if message['message_type'] == msg.BATCH_MSG:
+            return message['messages']
+        return [message]
+
+    @staticmethod
+    def process_message(message: dict):
+        """
+        The handler for dispatch = 'process', ran in a worker process - so it must be picklable (a staticmethod of an
+        importable class) and can't touch the executor's connection. Its result is passed to #on_processed.
+        Executors using process dispatch must override it.
+        """
+        pass
+
+    def on_processed(self, ch, method, properties, message: dict, result):
+        """
+        Called on the I/O thread with the result of #process_message, before the delivery is acknowledged.
+        """
+        pass
+
+    def ack(self, delivery_tag: int, multiple: bool = False):
+        """
+        Acknowledges a delivery (only meaningful when the executor was created with auto_ack=False).
+        :param delivery_tag: the delivery tag from the consumed message's method frame
+        :param multiple: if true, acknowledges every outstanding delivery up to and including delivery_tag
+        """
+        self.transport.ack(delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        """
+        Negatively acknowledges a delivery, by default returning it to the queue for redelivery.
+        """
+        self.transport.nack(delivery_tag, multiple=multiple, requeue=requeue)
+
+    def __decode_delivery(self, method, properties, body) -> typing.Optional[typing.List[dict]]:
+        """
+        Decodes a delivery, rejecting it if it's malformed (or of an unknown type or version) - redelivering it would
+        only fail again, so it's dropped (or dead-lettered, if the queue is configured to) rather than requeued.
+        """
+        try:
+            return self.decode_messages(body, properties)
+        except message_schema.MessageSchemaException as e:
+            if not self._auto_ack:
+                self.nack(method.delivery_tag, requeue=False)
+            self.message_helper.log_error_message(exception=f"Rejected undecodable delivery {method.delivery_tag}",
+                                                  other_data={"error": repr(e)})
+            return None
+
+    def __on_inline_delivery(self, method, properties, body):
+        messages = self.__decode_delivery(method, properties, body)
+        for message in messages or []:
+            self.on_message_consumption(self.transport, method, properties, message)
+
+    def __on_delivery(self, method, properties, body):
+        messages = self.__decode_delivery(method, properties, body)
+        if messages is None:
+            return
+        delivery = (self.transport, method, properties, messages)
+        key = self.ordering_key(messages[0]) if self.ordering_key is not None else None
+        if key is None:
+            self.__submit(delivery, None)
+        elif key in self._lanes:
+            self._lanes[key].append(delivery)
+        else:
+            self._lanes[key] = deque()
+            self.__submit(delivery, key)
+
+    def __submit(self, delivery: tuple, key: typing.Optional[typing.Hashable]):
+        if self.dispatch == 'thread':
+            future = self._pool.submit(self.__handle_messages, *delivery)
+            future.add_done_callback(
+                lambda f: self.__call_threadsafe(self.__on_handled, delivery, key, None, f.exception()))
+        else:
+            self._pool.apply_async(
+                _process_messages, (self.__class__.process_message, delivery[3]),
+                callback=lambda result: self.__call_threadsafe(self.__on_handled, delivery, key, result, None),
+                error_callback=lambda e: self.__call_threadsafe(self.__on_handled, delivery, key, None, e))
+
+    def __on_handled(self, delivery: tuple, key: typing.Optional[typing.Hashable], result, error: Exception):
+        (ch, method, properties, messages) = delivery
+        if error is None and self.dispatch == 'process':
+            try:
+                for (message, message_result) in zip(messages, result):
+                    self.on_processed(ch, method, properties, message, message_result)
+            except Exception as e:
+                error = e
+        if error is None:
+            self.ack(method.delivery_tag)
+        else:
+            # A delivery is retried once - if it fails again it's dropped (or dead-lettered), so a poison message
+            # can't cycle through the queue forever
+            print(f'Failed handling delivery {method.delivery_tag}: {repr(error)}')
+            self.nack(method.delivery_tag, requeue=not method.redelivered)
+        if key is not None:
+            lane = self._lanes[key]
+            if lane:
+                self.__submit(lane.popleft(), key)
+            else:
+                del self._lanes[key]
+
+    def __handle_messages(self, ch, method, properties, messages: typing.List[dict]):
+        for message in messages:
+            self.on_message_consumption(ch, method, properties, message)
+
+    def __call_threadsafe(self, func: typing.Callable, *args):
+        if self.transport.is_open:
+            self.transport.add_callback_threadsafe(functools.partial(func, *args))
+
     def run(self):
-        self.channel.start_consuming()
+        self.transport.start_consuming()
 
     def stop(self):
-        self.connection.close()
\ No newline at end of file
+        if not self.transport.is_io_thread():
+            # Transports aren't thread safe, so stopping the executor from another thread (e.g. a handler on a pool
+            # thread) defers to the I/O thread
+            self.__call_threadsafe(self.stop)
+            return
+        if isinstance(self._pool, ThreadPoolExecutor):
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        elif self._pool is not None:
+            self._pool.terminate()
+        try:
+            self.message_helper.flush()
+        except Exception as e:
+            print(f'Failed flushing buffered messages on stop: {repr(e)}')
+        # Anything still unacknowledged is redelivered to the next consumer
+        self.transport.close()
+
+
+def _process_messages(process_message: typing.Callable[[dict], typing.Any], messages: typing.List[dict]) -> list:
+    return [process_message(message) for message in messages]
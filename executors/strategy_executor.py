@@ -1,64 +1,154 @@
 #!/usr/bin/env python
 import abc
+import dataclasses
 import typing
 
+import pandas as pd
+
 import message_constants as msg
-import json
 from config import Config
 from accessors.db_accessor import DbAccessor
 from pika.exchange_type import ExchangeType
 
 from executors.simple_executor import SimpleExecutor
+from transport import Transport
+from models.input_series import InputSeries
 from models.position import Position
+from utils.tracing import TraceContext
 
 """
 Handles position calculation.
 """
 
+Watermarks = typing.Dict[InputSeries, typing.Optional[pd.Timestamp]]
 
-class StrategyExecutor(SimpleExecutor):
+
+class RecalculationGate:
+    """
+    Tracks, per strategy, the input watermarks of its last run & the content hash of its last written positions -
+    so a strategy is only rerun once one of its input series has new data, and its positions are only written to
+    strategy_queue when they differ from the last ones written.
+    The state is per process: a restarted executor recalculates & writes every strategy once.
+    """
     def __init__(self):
+        self._watermarks: typing.Dict[str, Watermarks] = {}
+        self._hashes: typing.Dict[str, str] = {}
+
+    def needs_recalculation(self, strategy_name: str, watermarks: typing.Optional[Watermarks]) -> bool:
+        """
+        :param watermarks: the strategy's current input watermarks (None if it doesn't declare its inputs)
+        """
+        return watermarks is None or self._watermarks.get(strategy_name) != watermarks
+
+    def recalculated(self, strategy_name: str, watermarks: typing.Optional[Watermarks]):
+        if watermarks is not None:
+            self._watermarks[strategy_name] = watermarks
+
+    def needs_write(self, strategy_name: str, positions: typing.List[Position]) -> bool:
+        return self._hashes.get(strategy_name) != Position.content_hash(positions)
+
+    def written(self, strategy_name: str, positions: typing.List[Position]):
+        self._hashes[strategy_name] = Position.content_hash(positions)
+
+
+class StrategyExecutor(SimpleExecutor):
+    """
+    Runs a strategy on every recalculation cycle & writes its positions to strategy_queue.
+    Strategies declare the series they read in `input_series`: a cycle in which none of them has new data since the
+    last run skips recalculating, and positions identical to the last ones written aren't written again (see
+    RecalculationGate). Strategies that don't declare their inputs (or whose output depends on more than their
+    input data, e.g. the time of day) are recalculated on every cycle.
+    """
+    input_series: typing.Optional[typing.Sequence[InputSeries]] = None
+
+    def __init__(self, transport: Transport = None):
         super().__init__(rabbit_mq_host=Config.get_property("RABBITMQ_SERVER_URI", "localhost").unwrap(),
                          exchange=msg.POSITION_EXCHANGE,
-                         exchange_type=ExchangeType.direct,
-                         queue=msg.POSITION_SCHEDULING_QUEUE)
+                         exchange_type=ExchangeType.fanout,
+                         # Each strategy has its own queue, so every strategy receives every recalculation
+                         queue=msg.shard_queue(msg.POSITION_SCHEDULING_QUEUE, self.strategy_name()),
+                         transport=transport)
+        self.gate = RecalculationGate()
 
     @abc.abstractmethod
     def run_strategy(self) -> typing.List[Position]:
         return []
 
-    def recalculate_positions(self):
+    @classmethod
+    def strategy_name(cls) -> str:
+        return cls.__name__
+
+    @classmethod
+    def input_watermarks(cls, watermarks: Watermarks) -> typing.Optional[Watermarks]:
+        """
+        :param watermarks: the watermarks of (at least) this strategy's input series
+        :return: the strategy's input watermarks, or None if it doesn't declare its inputs
+        """
+        if cls.input_series is None:
+            return None
+        return {series: watermarks[series] for series in cls.input_series}
+
+    @classmethod
+    def compute_positions(cls) -> typing.List[Position]:
+        """
+        Runs the strategy without an executor (and so without a broker connection), e.g. in a worker process of
+        executors/multi_strategy_executor.py.
+        Strategies whose run_strategy depends on state set up in __init__ should override this.
+        """
+        return cls.attribute_positions(cls.run_strategy(cls.__new__(cls)))
+
+    @classmethod
+    def attribute_positions(cls, positions: typing.List[Position]) -> typing.List[Position]:
+        """
+        Positions without a strategy are attributed to this one.
+        """
+        for position in positions:
+            if not position.strategy:
+                position.strategy = cls.strategy_name()
+        return positions
+
+    def recalculate_positions(self, trace: TraceContext = None) -> bool:
+        """
+        :param trace: the trace of the cycle that triggered the recalculation - it's recorded on the written
+        positions, so their execution can be linked back to it
+        :return: whether the positions are up to date (recalculated, or skipped as their inputs haven't changed)
+        """
+        strategy_name = self.strategy_name()
         try:
-            positions = self.run_strategy()
-            insert_ts = DbAccessor().write_new_strategy_positions(positions)
-            self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.LOG_QUEUE, body=
-            json.dumps(
-                {
-                    "message_type": "INFO",
-                    "sender": "PositionCalculator",
-                    "message": f"Successfully calculated positions for strategy {strategy.name} at {insert_ts}",
-                    "other_data": json.dumps(positions),
-                }
-            ))
+            db_accessor = DbAccessor()
+            watermarks = self.input_watermarks(db_accessor.get_series_watermarks(list(self.input_series or [])))
+            if not self.gate.needs_recalculation(strategy_name, watermarks):
+                print(f'No new input data for strategy {strategy_name}, skipping recalculation')
+                return True
+            with self.tracer.span(trace, 'compute'):
+                positions = self.attribute_positions(self.run_strategy())
+            if self.gate.needs_write(strategy_name, positions):
+                with self.tracer.span(trace, 'db_write'):
+                    insert_ts = db_accessor.write_new_strategy_positions(
+                        positions, trace_id=trace.trace_id if trace is not None else None)
+                self.gate.written(strategy_name, positions)
+                self.message_helper.log_info_message(
+                    message=f"Successfully calculated positions for strategy {strategy_name} at {insert_ts}",
+                    other_data={"positions": [dataclasses.asdict(position) for position in positions]})
+            else:
+                print(f'Positions for strategy {strategy_name} are unchanged, skipping write')
+            self.gate.recalculated(strategy_name, watermarks)
+            return True
         except Exception as e:
-            self.channel.basic_publish(exchange=msg.POSITION_EXCHANGE, routing_key=msg.CLOCK_QUEUE, body=
-            json.dumps(
-                {
-                    "message_type": "ERROR",
-                    "sender": "PositionCalculator",
-                    "message": f"Unable to recompute positions for strategy {strategy.name}",
-                    "other_data": json.dumps(e),
-                }
-            ))
-
-    def on_message_consumption(self, ch, method, properties, body):
-        b = json.loads(body)
+            self.message_helper.log_error_message(
+                exception=f"Unable to recompute positions for strategy {strategy_name}",
+                other_data={"error": repr(e)})
+            return False
+
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        b = message
         if b['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
             print('Terminating position scheduling process...')
             self.stop()
         elif b['message_type'] == msg.NORMAL_POSITION_SCHEDULING_MSG:
             print('Recalculating positions...')
-            self.recalculate_positions()
+            succeeded = self.recalculate_positions(trace=self.tracer.received(b.get('trace')))
+            self.message_helper.cycle_complete(b['cycle_id'], succeeded)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+import collections
+import time
+import typing
+
+import numpy as np
+from pika.exchange_type import ExchangeType
+
+from config import Config
+import message_constants as msg
+from executors.simple_executor import SimpleExecutor
+from transport import Transport
+from utils.tracing import Span, critical_path, stage_latencies
+
+# The time positions spent in strategy_queue between their strategy run & the execution claiming them
+STRATEGY_QUEUE_WAIT_STAGE: typing.Final = 'strategy_queue.wait'
+
+
+class TraceCollector(SimpleExecutor):
+    """
+    Collects the spans published by traced executors (see utils/tracing.py). Once a trace has received no spans for
+    `idle_timeout` seconds it's considered complete: its critical path is rebuilt and the latency of every stage
+    along it is reported - strategy compute, queueing, DB & exchange time - along with, for executions, how long
+    their positions waited in strategy_queue after the linked strategy runs.
+    Every `summary_every` traces, the p50/p95/max of each stage over the last `history` traces is reported too.
+    """
+    def __init__(self, rabbit_mq_host: str = None, idle_timeout: float = 10, history: int = 500,
+                 summary_every: int = 50, transport: Transport = None):
+        super().__init__(rabbit_mq_host=rabbit_mq_host,
+                         exchange=msg.TRACE_EXCHANGE,
+                         exchange_type=ExchangeType.direct,
+                         queue=msg.TRACE_QUEUE,
+                         transport=transport)
+        self.idle_timeout = idle_timeout
+        self.history = history
+        self.summary_every = summary_every
+        self._spans: typing.Dict[str, typing.List[Span]] = {}
+        self._last_seen: typing.Dict[str, float] = {}
+        # trace_id -> end time of completed traces, to resolve links
+        self._trace_ends: typing.OrderedDict[str, float] = collections.OrderedDict()
+        self.stage_history: typing.Dict[str, typing.Deque[float]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.history))
+        self.completed = 0
+        self.transport.call_later(self.idle_timeout, self.__on_sweep)
+
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        if message['message_type'] == msg.TRACE_SPAN_MSG:
+            span = Span(**{k: v for (k, v) in message.items() if k in Span.__dataclass_fields__})
+            self._spans.setdefault(span.trace_id, []).append(span)
+            self._last_seen[span.trace_id] = time.monotonic()
+        elif message['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
+            self.complete_traces(idle_timeout=0)
+            self.stop()
+
+    def __on_sweep(self):
+        try:
+            self.complete_traces(self.idle_timeout)
+        finally:
+            if self.transport.is_open:
+                self.transport.call_later(self.idle_timeout, self.__on_sweep)
+
+    def complete_traces(self, idle_timeout: float) -> typing.List[typing.List[typing.Tuple[str, float]]]:
+        """
+        Completes every trace which has been idle for at least idle_timeout seconds, oldest first.
+        :return: the stage latencies of each completed trace
+        """
+        now = time.monotonic()
+        idle = sorted([trace_id for (trace_id, last_seen) in self._last_seen.items() if now - last_seen >= idle_timeout],
+                      key=lambda trace_id: min(span.start for span in self._spans[trace_id]))
+        return [self.__complete(trace_id) for trace_id in idle]
+
+    def __complete(self, trace_id: str) -> typing.List[typing.Tuple[str, float]]:
+        spans = self._spans.pop(trace_id)
+        del self._last_seen[trace_id]
+        path = critical_path(spans)
+        latencies = stage_latencies(path)
+        linked_ends = [self.__trace_end(link) for span in path for link in span.links]
+        linked_ends = [end for end in linked_ends if end is not None]
+        if linked_ends:
+            claim = next(span for span in path if span.links)
+            latencies.insert(0, (STRATEGY_QUEUE_WAIT_STAGE, max(0.0, claim.start - max(linked_ends))))
+        self._trace_ends[trace_id] = max(span.end for span in spans)
+        while len(self._trace_ends) > self.history:
+            self._trace_ends.popitem(last=False)
+        for (stage, seconds) in latencies:
+            self.stage_history[stage].append(seconds)
+        self.completed += 1
+        total = path[-1].end - path[0].start
+        stages = ', '.join([f'{stage} {seconds * 1000:.1f}ms' for (stage, seconds) in latencies])
+        print(f'[trace {trace_id}] {total * 1000:.1f}ms across {len(spans)} spans - critical path: {stages}')
+        if self.summary_every and self.completed % self.summary_every == 0:
+            self.print_summary()
+        return latencies
+
+    def __trace_end(self, trace_id: str) -> typing.Optional[float]:
+        if trace_id in self._trace_ends:
+            return self._trace_ends[trace_id]
+        if trace_id in self._spans:
+            return max(span.end for span in self._spans[trace_id])
+        return None
+
+    def summary(self) -> typing.Dict[str, typing.Tuple[float, float, float]]:
+        """
+        :return: stage -> (p50, p95, max) latency in seconds, over the last `history` traces it appeared in
+        """
+        return {stage: (float(np.percentile(seconds, 50)), float(np.percentile(seconds, 95)), float(np.max(seconds)))
+                for (stage, seconds) in self.stage_history.items() if seconds}
+
+    def print_summary(self):
+        print(f'Stage latencies over the last {self.history} traces (p50 / p95 / max):')
+        for (stage, (p50, p95, worst)) in sorted(self.summary().items(), key=lambda x: -x[1][1]):
+            print(f'    {stage}: {p50 * 1000:.1f}ms / {p95 * 1000:.1f}ms / {worst * 1000:.1f}ms')
+
+
+if __name__ == "__main__":
+    TraceCollector(rabbit_mq_host=Config.get_property("RABBITMQ_SERVER_URI", 'localhost').unwrap()).run()
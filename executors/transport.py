@@ -0,0 +1,381 @@
+import abc
+import collections
+import heapq
+import itertools
+import queue
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+import pika
+from pika.exchange_type import ExchangeType
+
+import message_schema
+
+"""
+Message transports for SimpleExecutor & MessageHelper.
+A transport owns a connection to a broker: it declares & consumes queues, publishes messages, acks deliveries and
+runs an I/O loop (with timers & cross-thread callbacks, as pika's BlockingConnection does). Every callback runs on
+the transport's I/O thread - the thread that created it, or for InProcessTransport the one consuming.
+Deliveries are passed to consumers as (method, properties, body): method carries the delivery_tag & redelivered
+flag, and body is either the encoded bytes (RabbitMqTransport) or the message dict itself (InProcessTransport).
+"""
+
+DeliveryCallback = typing.Callable[[typing.Any, typing.Any, typing.Any], None]
+
+
+class Transport(abc.ABC):
+    @abc.abstractmethod
+    def declare_exchange(self, exchange: str, exchange_type: str):
+        pass
+
+    @abc.abstractmethod
+    def declare_queue(self, exchange: str, exchange_type: str, queue: str):
+        pass
+
+    @abc.abstractmethod
+    def consume(self, queue: str, on_delivery: DeliveryCallback, auto_ack: bool):
+        pass
+
+    @abc.abstractmethod
+    def set_prefetch(self, prefetch_count: int):
+        pass
+
+    @abc.abstractmethod
+    def enable_confirms(self):
+        pass
+
+    @abc.abstractmethod
+    def publish(self, exchange: str, routing_key: str, message: dict, content_type: str):
+        pass
+
+    @abc.abstractmethod
+    def ack(self, delivery_tag: int, multiple: bool = False):
+        pass
+
+    @abc.abstractmethod
+    def nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        pass
+
+    @abc.abstractmethod
+    def call_later(self, delay: float, callback: typing.Callable):
+        pass
+
+    @abc.abstractmethod
+    def remove_timeout(self, timeout_id):
+        pass
+
+    @abc.abstractmethod
+    def add_callback_threadsafe(self, callback: typing.Callable):
+        pass
+
+    @abc.abstractmethod
+    def process_events(self, time_limit: float = 0):
+        """
+        Runs the I/O loop (deliveries, timers & cross-thread callbacks) for up to time_limit seconds.
+        """
+        pass
+
+    @abc.abstractmethod
+    def start_consuming(self):
+        """
+        Runs the I/O loop until the transport is closed.
+        """
+        pass
+
+    @abc.abstractmethod
+    def is_io_thread(self) -> bool:
+        pass
+
+    @property
+    @abc.abstractmethod
+    def is_open(self) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class RabbitMqTransport(Transport):
+    """
+    A transport over a pika BlockingConnection, messages are encoded through executors/message_schema.py.
+    """
+    def __init__(self, rabbit_mq_host: str):
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=rabbit_mq_host)
+        )
+        self.channel = self.connection.channel()
+        self._io_thread = threading.get_ident()
+
+    def declare_exchange(self, exchange: str, exchange_type: str):
+        self.channel.exchange_declare(exchange, exchange_type=exchange_type)
+
+    def declare_queue(self, exchange: str, exchange_type: str, queue: str):
+        self.declare_exchange(exchange, exchange_type)
+        r = self.channel.queue_declare(queue=queue)
+        self.channel.queue_bind(r.method.queue, exchange=exchange)
+
+    def consume(self, queue: str, on_delivery: DeliveryCallback, auto_ack: bool):
+        self.channel.basic_consume(queue=queue,
+                                   on_message_callback=lambda ch, method, properties, body: on_delivery(
+                                       method, properties, body),
+                                   auto_ack=auto_ack)
+
+    def set_prefetch(self, prefetch_count: int):
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    def enable_confirms(self):
+        self.channel.confirm_delivery()
+
+    def publish(self, exchange: str, routing_key: str, message: dict, content_type: str):
+        self.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                   properties=pika.BasicProperties(content_type=content_type),
+                                   body=message_schema.encode(message, content_type))
+
+    def ack(self, delivery_tag: int, multiple: bool = False):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        self.channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+
+    def call_later(self, delay: float, callback: typing.Callable):
+        return self.connection.call_later(delay, callback)
+
+    def remove_timeout(self, timeout_id):
+        self.connection.remove_timeout(timeout_id)
+
+    def add_callback_threadsafe(self, callback: typing.Callable):
+        self.connection.add_callback_threadsafe(callback)
+
+    def process_events(self, time_limit: float = 0):
+        self.connection.process_data_events(time_limit=time_limit)
+
+    def start_consuming(self):
+        self.channel.start_consuming()
+
+    def is_io_thread(self) -> bool:
+        return threading.get_ident() == self._io_thread
+
+    @property
+    def is_open(self) -> bool:
+        return self.connection.is_open
+
+    def close(self):
+        self.connection.close()
+
+
+@dataclass
+class InProcessDelivery:
+    delivery_tag: int
+    redelivered: bool
+    exchange: str
+    routing_key: str
+
+
+class InProcessBroker:
+    """
+    An in-memory broker with RabbitMQ's exchange semantics (fanout & direct, queues bound with their own name as
+    the binding key), shared by the InProcessTransports of executors running in the same process.
+    Each queue delivers every message to one of its consumers, unacked messages return to their queue when
+    nacked with requeue or when their consumer closes.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._exchanges: typing.Dict[str, str] = {}
+        # exchange -> [(queue, binding key)]
+        self._bindings: typing.Dict[str, typing.List[typing.Tuple[str, str]]] = collections.defaultdict(list)
+        self._queues: typing.Dict[str, '_InProcessQueue'] = {}
+
+    def declare_exchange(self, exchange: str, exchange_type: str):
+        with self._lock:
+            exchange_type = getattr(exchange_type, 'value', exchange_type)
+            if self._exchanges.setdefault(exchange, exchange_type) != exchange_type:
+                raise Exception(f'Exchange {exchange} already declared as {self._exchanges[exchange]}, '
+                                f'not {exchange_type}')
+
+    def declare_queue(self, queue_name: str) -> '_InProcessQueue':
+        with self._lock:
+            return self._queues.setdefault(queue_name, _InProcessQueue(self._lock))
+
+    def bind(self, queue_name: str, exchange: str, binding_key: str):
+        with self._lock:
+            if (queue_name, binding_key) not in self._bindings[exchange]:
+                self._bindings[exchange].append((queue_name, binding_key))
+
+    def add_consumer(self, queue_name: str, consumer: 'InProcessTransport') -> '_InProcessQueue':
+        with self._lock:
+            in_process_queue = self.declare_queue(queue_name)
+            in_process_queue.consumers.append(consumer)
+            return in_process_queue
+
+    def remove_consumer(self, in_process_queue: '_InProcessQueue', consumer: 'InProcessTransport'):
+        with self._lock:
+            in_process_queue.consumers.remove(consumer)
+
+    def publish(self, exchange: str, routing_key: str, message: dict):
+        with self._lock:
+            if exchange not in self._exchanges:
+                raise Exception(f'Exchange {exchange} has not been declared')
+            fanout = self._exchanges[exchange] == ExchangeType.fanout.value
+            for (queue_name, binding_key) in self._bindings[exchange]:
+                if fanout or binding_key == routing_key:
+                    # Every queue gets its own (shallow) copy, handlers should treat messages as immutable
+                    self._queues[queue_name].put((exchange, routing_key, dict(message)), redelivered=False)
+
+
+class _InProcessQueue:
+    def __init__(self, lock: threading.RLock):
+        self._lock = lock
+        self.messages: typing.Deque[typing.Tuple[tuple, bool]] = collections.deque()
+        self.consumers: typing.List['InProcessTransport'] = []
+
+    def put(self, item: tuple, redelivered: bool, front: bool = False):
+        with self._lock:
+            (self.messages.appendleft if front else self.messages.append)((item, redelivered))
+            consumers = list(self.consumers)
+        for consumer in consumers:
+            consumer.wake()
+
+    def get(self) -> typing.Optional[typing.Tuple[tuple, bool]]:
+        with self._lock:
+            return self.messages.popleft() if self.messages else None
+
+
+class InProcessTransport(Transport):
+    """
+    A transport over an InProcessBroker: messages are passed as objects, without serialization (they're still
+    validated against executors/message_schema.py when published).
+    """
+    def __init__(self, broker: InProcessBroker):
+        self.broker = broker
+        self._events: queue.Queue = queue.Queue()
+        self._timers: typing.List[list] = []
+        self._timer_sequence = itertools.count()
+        # (queue, on_delivery, auto_ack)
+        self._consumers: typing.List[typing.Tuple[_InProcessQueue, DeliveryCallback, bool]] = []
+        self._unacked: typing.Dict[int, typing.Tuple[_InProcessQueue, tuple]] = collections.OrderedDict()
+        self._delivery_tags = itertools.count(1)
+        self._prefetch_count = 0
+        self._io_thread = threading.get_ident()
+        self._open = True
+
+    def declare_exchange(self, exchange: str, exchange_type: str):
+        self.broker.declare_exchange(exchange, exchange_type)
+
+    def declare_queue(self, exchange: str, exchange_type: str, queue: str):
+        self.declare_exchange(exchange, exchange_type)
+        self.broker.declare_queue(queue)
+        self.broker.bind(queue, exchange, queue)
+
+    def consume(self, queue: str, on_delivery: DeliveryCallback, auto_ack: bool):
+        in_process_queue = self.broker.add_consumer(queue, self)
+        self._consumers.append((in_process_queue, on_delivery, auto_ack))
+
+    def set_prefetch(self, prefetch_count: int):
+        self._prefetch_count = prefetch_count
+
+    def enable_confirms(self):
+        # Publishes are synchronous hand-offs to the broker, so every publish is already "confirmed"
+        pass
+
+    def publish(self, exchange: str, routing_key: str, message: dict, content_type: str):
+        message_schema.validate(message)
+        self.broker.publish(exchange, routing_key, message)
+
+    def ack(self, delivery_tag: int, multiple: bool = False):
+        for tag in self.__settled_tags(delivery_tag, multiple):
+            self._unacked.pop(tag)
+        self.wake()
+
+    def nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        for tag in reversed(self.__settled_tags(delivery_tag, multiple)):
+            (in_process_queue, item) = self._unacked.pop(tag)
+            if requeue:
+                in_process_queue.put(item, redelivered=True, front=True)
+        self.wake()
+
+    def call_later(self, delay: float, callback: typing.Callable):
+        timer = [time.monotonic() + delay, next(self._timer_sequence), callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def remove_timeout(self, timeout_id):
+        # Cancelled timers stay in the heap, and are skipped once due
+        timeout_id[2] = None
+
+    def add_callback_threadsafe(self, callback: typing.Callable):
+        self._events.put(callback)
+
+    def wake(self):
+        self._events.put(None)
+
+    def process_events(self, time_limit: float = 0):
+        # Whichever thread runs the loop is the I/O thread (executors may be created on one thread & run on another)
+        self._io_thread = threading.get_ident()
+        deadline = time.monotonic() + time_limit
+        while True:
+            self.__run_due_timers()
+            self.__dispatch_deliveries()
+            now = time.monotonic()
+            next_timer = self._timers[0][0] if self._timers else deadline
+            try:
+                callback = self._events.get(timeout=max(0.0, min(deadline, next_timer) - now))
+                while True:
+                    if callback is not None:
+                        callback()
+                    callback = self._events.get_nowait()
+            except queue.Empty:
+                pass
+            if not self._open or time.monotonic() >= deadline:
+                return
+
+    def start_consuming(self):
+        while self._open:
+            self.process_events(time_limit=1.0)
+
+    def is_io_thread(self) -> bool:
+        return threading.get_ident() == self._io_thread
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    def close(self):
+        self._open = False
+        for (in_process_queue, _, _) in self._consumers:
+            self.broker.remove_consumer(in_process_queue, self)
+        # As with a closed AMQP channel, unacked messages go back to their queues
+        for (in_process_queue, item) in reversed(list(self._unacked.values())):
+            in_process_queue.put(item, redelivered=True, front=True)
+        self._unacked.clear()
+
+    def __settled_tags(self, delivery_tag: int, multiple: bool) -> typing.List[int]:
+        if delivery_tag not in self._unacked:
+            raise Exception(f'Unknown delivery tag {delivery_tag}')
+        return [tag for tag in self._unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+
+    def __run_due_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            (_, _, callback) = heapq.heappop(self._timers)
+            if callback is not None:
+                callback()
+
+    def __dispatch_deliveries(self):
+        delivered = True
+        while delivered and self._open:
+            delivered = False
+            for (in_process_queue, on_delivery, auto_ack) in list(self._consumers):
+                if not auto_ack and self._prefetch_count and len(self._unacked) >= self._prefetch_count:
+                    return
+                entry = in_process_queue.get()
+                if entry is None:
+                    continue
+                ((exchange, routing_key, message), redelivered) = entry
+                delivery = InProcessDelivery(next(self._delivery_tags), redelivered, exchange, routing_key)
+                if not auto_ack:
+                    self._unacked[delivery.delivery_tag] = (in_process_queue, (exchange, routing_key, message))
+                on_delivery(delivery, None, message)
+                delivered = True
@@ -3,6 +3,7 @@
 Simple class implementation of a 'watcher' that observes current market conditions, and triggers
 certain actions if certain conditions are met.
 """
+import threading
 import typing
 
 from pika.exchange_type import ExchangeType
@@ -12,17 +13,31 @@ from accessors.wrapped_ftx_client import WrappedFtxClient
 from config import Config
 from executors.simple_executor import SimpleExecutor
 import message_constants as msg
+from models.trigger_rule import FiredTrigger, TriggerRule
+from transport import Transport
+from utils.trigger_engine import TriggerEngine
 
 def as_ticker_subscription(market: str):
     return {'channel': 'ticker', 'market': market}
 
 
 class WatcherExecutor(SimpleExecutor):
-    def __init__(self, rabbit_mq_host: str = None, api_key: str = None, api_secret: str = None, subaccount: str = None):
+    """
+    Evaluates watch rules (see models/trigger_rule.py) against the ticker stream of the markets we hold positions in.
+    Rules are indexed by utils/trigger_engine.py, so a ticker update only touches the rules it crossed. Every fired
+    rule is published as a TRIGGER_FIRED_MSG, and its action (if any) is sent to the other executors - see
+    #on_trigger.
+    """
+    def __init__(self, rabbit_mq_host: str = None, api_key: str = None, api_secret: str = None, subaccount: str = None,
+                 rules: typing.Sequence[TriggerRule] = (), transport: Transport = None):
+        """
+        :param rules: the initial watch rules, more can be added with #add_rule
+        """
         super().__init__(rabbit_mq_host=rabbit_mq_host,
                          exchange=msg.POSITION_EXCHANGE,
                          exchange_type=ExchangeType.fanout,
-                         queue=msg.WATCHER_QUEUE)
+                         queue=msg.WATCHER_QUEUE,
+                         transport=transport)
         self.rest_client = WrappedFtxClient(api_key=api_key,
             api_secret=api_secret,
             subaccount_name=subaccount)
@@ -31,12 +46,52 @@ class WatcherExecutor(SimpleExecutor):
                                                    subaccount=subaccount,
                                                    ticker_handler=self.on_ticker,
                                                    fill_handler=self.on_active_fill)
-        self.active_markets = []
-        self.cached_ticker_info =
+        self.active_markets: typing.Set[str] = set()
+        self.cached_ticker_info: typing.Dict[str, dict] = {}
+        self.trigger_engine = TriggerEngine()
+        # Tickers are handled on the websocket thread, rules may be changed from any other
+        self._trigger_lock = threading.Lock()
+        for rule in rules:
+            self.add_rule(rule)
 
+    def add_rule(self, rule: TriggerRule):
+        """
+        Adds (or replaces) a watch rule - it fires straight away if its condition already holds.
+        """
+        with self._trigger_lock:
+            fired = self.trigger_engine.add_rule(rule)
+        if fired is not None:
+            self.on_trigger(fired)
+
+    def remove_rule(self, rule_id: str) -> typing.Optional[TriggerRule]:
+        with self._trigger_lock:
+            return self.trigger_engine.remove_rule(rule_id)
 
     def on_ticker(self, message):
-        pass
+        self.cached_ticker_info[message['market']] = message['data']
+        with self._trigger_lock:
+            fired = self.trigger_engine.on_ticker(message['market'], message['data'])
+        for trigger in fired:
+            self.on_trigger(trigger)
+
+    def on_trigger(self, trigger: FiredTrigger):
+        """
+        Publishes a fired rule, then carries out its action: 'recalculate' triggers a strategy recalculation,
+        'execute' a position execution, 'terminate' terminates every executor & 'notify' does nothing more.
+        """
+        self.message_helper.trigger_fired(trigger)
+        if trigger.rule.action == 'recalculate':
+            self.message_helper.strategy_executor_recalculate_positions()
+        elif trigger.rule.action == 'execute':
+            self.message_helper.position_executor_change_positions()
+        elif trigger.rule.action == 'terminate':
+            self.message_helper.terminate_all()
+
+    def on_message_consumption(self, ch, method, properties, message: dict):
+        if message['message_type'] == msg.TERMINATE_ALL_POSITIONS_EXC_MSG:
+            print('Terminating watcher...')
+            self.websocket_client.close()
+            self.stop()
 
     def on_active_fill(self, _):
         prior_active_markets = self.active_markets.copy()
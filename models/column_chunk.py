@@ -0,0 +1,39 @@
+from dataclasses import dataclass, field
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class ColumnChunk:
+    """
+    A compact, columnar chunk of rows for a single symbol, for passing between the processes of an update job.
+    Varying columns are held as plain NumPy arrays (which pickle as raw buffers) and columns that are constant
+    across the chunk (exchange, base, quote, etc.) are held once as scalars, rather than pickling a whole DataFrame.
+    """
+    symbol: str
+    columns: typing.Dict[str, np.ndarray]
+    constants: typing.Dict[str, typing.Any] = field(default_factory=dict)
+    column_order: typing.List[str] = field(default_factory=list)
+
+    @staticmethod
+    def from_frame(symbol: str, df: pd.DataFrame, constant_columns: typing.List[str] = ()) -> "ColumnChunk":
+        """
+        :param symbol: the symbol the rows belong to
+        :param df: a dataframe of rows
+        :param constant_columns: columns known to hold a single value across the frame
+        :return: a ColumnChunk holding the same rows
+        """
+        constants = {c: df[c].iloc[0] for c in constant_columns if c in df.columns and len(df)}
+        columns = {c: df[c].to_numpy() for c in df.columns if c not in constants}
+        return ColumnChunk(symbol=symbol, columns=columns, constants=constants, column_order=list(df.columns))
+
+    def to_frame(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.columns)
+        for c, value in self.constants.items():
+            df[c] = value
+        return df[self.column_order]
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
@@ -0,0 +1,55 @@
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+import typing
+
+
+@dataclass
+class FillEvent:
+    """
+    A single (child) exchange fill belonging to an order, as stored in the `fill_events` table.
+    An order recorded in `fills` will usually be made up of several of these.
+    """
+    order_id: int
+    trade_id: int
+    market: str
+    side: str
+    price: float
+    size: float
+    fee: float
+    fee_rate: float
+    liquidity: str
+    time: datetime
+
+    @staticmethod
+    def from_ftx_fill(fill: dict) -> "FillEvent":
+        """
+        Builds a FillEvent from a fill message as received from the FTX websocket/REST API.
+        :param fill: the raw FTX fill dict
+        :return: a FillEvent, with time converted to naive UTC
+        """
+        return FillEvent(
+            order_id=fill.get('orderId'),
+            trade_id=fill.get('tradeId'),
+            market=fill.get('market'),
+            side=fill.get('side'),
+            price=fill.get('price'),
+            size=fill.get('size'),
+            fee=fill.get('fee'),
+            fee_rate=fill.get('feeRate'),
+            liquidity=fill.get('liquidity'),
+            time=datetime.fromisoformat(fill['time']).astimezone(timezone.utc).replace(tzinfo=None)
+            if fill.get('time') else None,
+        )
+
+    @staticmethod
+    def columns() -> typing.List[str]:
+        return [f.name for f in fields(FillEvent)]
+
+    @staticmethod
+    def to_insert_params(event: "FillEvent", fill_id: int) -> typing.Dict[str, typing.Any]:
+        """
+        Returns the bind parameters for inserting this event into `fill_events` under its parent `fills` row.
+        """
+        params = {column: getattr(event, column) for column in FillEvent.columns()}
+        params['fill_id'] = fill_id
+        return params
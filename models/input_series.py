@@ -0,0 +1,23 @@
+from dataclasses import dataclass
+import typing
+
+# The series tables a strategy can read, see DbAccessor#get_series_watermarks
+SERIES_TABLES = ('price_data', 'funding_data')
+
+
+@dataclass(frozen=True)
+class InputSeries:
+    """
+    A series a strategy reads its inputs from - a series table, optionally restricted to a single resolution (in
+    seconds, see RESOLUTIONS_MAP - price_data only).
+    A strategy's recalculation is only needed once one of its input series has new rows, as tracked by the series'
+    watermark: the latest fetch_time ingested.
+    """
+    table: str
+    resolution: typing.Optional[int] = None
+
+    def __post_init__(self):
+        if self.table not in SERIES_TABLES:
+            raise ValueError(f'Unknown series table {self.table}, expected one of {SERIES_TABLES}')
+        if self.resolution is not None and self.table != 'price_data':
+            raise ValueError(f'{self.table} has no resolution')
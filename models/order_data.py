@@ -1,6 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+import json
 import typing
 
+from models.fill_event import FillEvent
+
 @dataclass
 class OrderData:
     quote: str
@@ -19,9 +22,25 @@ class OrderData:
     end_timestamp: float
 
     @staticmethod
-    def to_insert(order: "OrderData", table: str = 'fills') -> str:
-        # this takes advantage of the fact that the order is preserved in the internal
-        # dict representation
-        columns = ", ".join(list(order.__dict__.keys()))
-        items = ", ".join([str(i) if not isinstance(i, str) else f"'{i}'" for i in list(order.__dict__.values())])
-        return f"INSERT INTO {table} ({columns}) VALUES ({items})"
\ No newline at end of file
+    def columns() -> typing.List[str]:
+        """
+        The column names for the `fills` table, in dataclass field order.
+        fill_json is excluded - the individual fills are stored in `fill_events` instead (see #to_fill_events).
+        """
+        return [f.name for f in fields(OrderData) if f.name != 'fill_json']
+
+    @staticmethod
+    def to_fill_events(order: "OrderData") -> typing.List[FillEvent]:
+        """
+        Parses the raw exchange fills carried in fill_json into FillEvents.
+        """
+        if not order.fill_json:
+            return []
+        return [FillEvent.from_ftx_fill(fill) for fill in json.loads(order.fill_json)]
+
+    @staticmethod
+    def to_insert_params(order: "OrderData") -> typing.Dict[str, typing.Any]:
+        """
+        Returns the bind parameters for inserting this order into `fills` (values are never interpolated into SQL).
+        """
+        return {column: getattr(order, column) for column in OrderData.columns()}
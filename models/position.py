@@ -1,3 +1,7 @@
+import hashlib
+import json
+import typing
+
 import pandas as pd
 from dataclasses import dataclass
 
@@ -12,6 +16,7 @@ class Position:
     - A position can also belong to a group, which can be used for performance attribution later on (maybe)
     - A position represents a relative size (e.g. some fraction of -1 to 1 * total exposure allowed)
     - A position represents a {base, quote, exchange, product type}
+    - A position records the trace_id of the strategy run which created it (see utils/tracing.py)
     """
     id: int
     strategy: str
@@ -22,4 +27,15 @@ class Position:
     product_type: str
     relative_size: float
     processed_timestamp: pd.Timestamp = None
-    timestamp: pd.Timestamp = None
\ No newline at end of file
+    timestamp: pd.Timestamp = None
+    trace_id: str = None
+
+    @staticmethod
+    def content_hash(positions: typing.List["Position"]) -> str:
+        """
+        A hash of what a list of positions targets (strategy, group, market & relative size), ignoring row metadata
+        (id, timestamps, trace_id) and ordering - equal hashes mean the same target portfolio.
+        """
+        targets = sorted([json.dumps([p.strategy, p.group, p.quote, p.base, p.exchange, p.product_type,
+                                      float(p.relative_size)]) for p in positions])
+        return hashlib.sha256('\n'.join(targets).encode()).hexdigest()
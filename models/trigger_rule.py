@@ -0,0 +1,75 @@
+from dataclasses import dataclass
+import typing
+
+# The ticker metrics rules can watch
+PRICE_METRIC: typing.Final = 'price'
+SPREAD_BPS_METRIC: typing.Final = 'spread_bps'
+# A rule fires when its metric rises through its threshold ('above') or falls through it ('below')
+DIRECTIONS: typing.Final = ('above', 'below')
+# What the watcher does when a rule fires, besides publishing the trigger (see WatcherExecutor#on_trigger)
+ACTIONS: typing.Final = ('notify', 'recalculate', 'execute', 'terminate')
+
+
+@dataclass(frozen=True)
+class TriggerRule:
+    """
+    A watch rule for utils.trigger_engine#TriggerEngine: fires once a market's metric crosses the threshold in the
+    given direction. One-shot rules are removed once they fire, rearming rules fire again on every new crossing.
+    Use the constructors below rather than building rules directly.
+    """
+    rule_id: str
+    market: str
+    kind: str
+    metric: str
+    direction: str
+    threshold: float
+    action: str = 'notify'
+    rearm: bool = False
+
+    def __post_init__(self):
+        if self.metric not in (PRICE_METRIC, SPREAD_BPS_METRIC):
+            raise ValueError(f'Unknown metric {self.metric}')
+        if self.direction not in DIRECTIONS:
+            raise ValueError(f'Unknown direction {self.direction}, expected one of {DIRECTIONS}')
+        if self.action not in ACTIONS:
+            raise ValueError(f'Unknown action {self.action}, expected one of {ACTIONS}')
+
+    @staticmethod
+    def price_cross(rule_id: str, market: str, price: float, direction: str, action: str = 'notify',
+                    rearm: bool = False) -> "TriggerRule":
+        """
+        Fires when the market's price rises above (or falls below) `price`.
+        """
+        return TriggerRule(rule_id, market, 'price_cross', PRICE_METRIC, direction, price, action, rearm)
+
+    @staticmethod
+    def spread_widen(rule_id: str, market: str, max_spread_bps: float, action: str = 'notify',
+                     rearm: bool = False) -> "TriggerRule":
+        """
+        Fires when the market's bid/ask spread widens past max_spread_bps (relative to the mid, in basis points).
+        """
+        return TriggerRule(rule_id, market, 'spread_widen', SPREAD_BPS_METRIC, 'above', max_spread_bps, action,
+                           rearm)
+
+    @staticmethod
+    def drawdown(rule_id: str, market: str, entry_price: float, max_drawdown: float, side: str = 'long',
+                 action: str = 'notify', rearm: bool = False) -> "TriggerRule":
+        """
+        Fires when a position entered at entry_price has drawn down by max_drawdown (a fraction, e.g. 0.1 for 10%) -
+        i.e. the price falls below entry * (1 - max_drawdown) for a long, or rises above entry * (1 + max_drawdown)
+        for a short.
+        """
+        if side == 'long':
+            return TriggerRule(rule_id, market, 'drawdown', PRICE_METRIC, 'below', entry_price * (1 - max_drawdown),
+                               action, rearm)
+        if side == 'short':
+            return TriggerRule(rule_id, market, 'drawdown', PRICE_METRIC, 'above', entry_price * (1 + max_drawdown),
+                               action, rearm)
+        raise ValueError(f'Unknown side {side}, expected long or short')
+
+
+@dataclass(frozen=True)
+class FiredTrigger:
+    rule: TriggerRule
+    value: float
+    time: float
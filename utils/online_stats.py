@@ -0,0 +1,190 @@
+import json
+import os
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+class OnlineRollingEstimator:
+    """
+    Rolling betas (of every column against a market column) and pairwise correlations over the last `window` rows,
+    maintained incrementally as rows arrive - so a new bar costs O(K) (betas only) or O(K²) (with correlations)
+    rather than a recompute over the full history.
+    The raw rows of the current window are kept in a ring buffer alongside running sums: each update adds the
+    entering row's terms and subtracts the leaving row's. Sums are taken relative to a per-column shift, and every
+    `recompute_every` updates they're rebuilt exactly from the buffer (re-centering the shift), which bounds the
+    floating point drift of the add/subtract updates.
+    Matches utils.rolling_stats#rolling_beta & #rolling_corr_matrices over the same window: beta windows drop NaN
+    rows per asset, while a correlation is NaN if either column has a NaN in the window.
+    The state can be saved to disk & loaded back, so a restarted process resumes without replaying history.
+    """
+    def __init__(self, columns: typing.List[str], window: int, market_column: str = None, pairwise: bool = True,
+                 min_periods: int = None, recompute_every: int = None):
+        """
+        :param columns: the return series tracked, rows passed to #update must follow this order
+        :param window: the window length (in rows)
+        :param market_column: the column betas are computed against (defaults to the first column)
+        :param pairwise: whether to maintain pairwise correlations (O(K²) state & updates) as well as betas
+        :param min_periods: the min number of usable rows for a beta to be reported (defaults to the full window)
+        :param recompute_every: the number of updates between exact recomputes of the sums (defaults to window)
+        """
+        self.columns = list(columns)
+        self.window = window
+        self.market_column = market_column if market_column is not None else self.columns[0]
+        self.market_idx = self.columns.index(self.market_column)
+        self.pairwise = pairwise
+        self.min_periods = window if min_periods is None else min_periods
+        self.recompute_every = window if recompute_every is None else recompute_every
+        k = len(self.columns)
+        self.buffer = np.full((window, k), np.nan)
+        self.position = 0
+        self.count = 0
+        self.updates_since_recompute = 0
+        self.last_index = None
+        self.shift = np.zeros(k)
+        # beta sums, over the rows where both the market & the column are present
+        self.beta_n = np.zeros(k)
+        self.beta_sx = np.zeros(k)
+        self.beta_sy = np.zeros(k)
+        self.beta_sxx = np.zeros(k)
+        self.beta_sxy = np.zeros(k)
+        # correlation sums, NaNs are zero-filled & counted
+        self.missing = np.zeros(k)
+        self.s = np.zeros(k)
+        self.cross = np.zeros((k, k)) if pairwise else None
+
+    def update(self, row: typing.Sequence[float], index=None):
+        """
+        Adds a row of returns, dropping the oldest row once the window is full.
+        :param row: the returns for each column, in self.columns order
+        :param index: the row's label (e.g. its timestamp), used by #update_frame to skip rows already seen
+        """
+        row = np.asarray(row, dtype=np.float64)
+        leaving = self.buffer[self.position].copy() if self.count >= self.window else None
+        self.buffer[self.position] = row
+        self.position = (self.position + 1) % self.window
+        self.count += 1
+        self.last_index = index if index is not None else self.last_index
+        self.updates_since_recompute += 1
+        if self.updates_since_recompute >= self.recompute_every:
+            self.recompute()
+            return
+        self.__accumulate(row, 1.0)
+        if leaving is not None:
+            self.__accumulate(leaving, -1.0)
+
+    def update_frame(self, df: pd.DataFrame) -> int:
+        """
+        Adds every row of a returns dataframe that's newer than the last row seen, e.g. the latest few bars of a
+        frame that also contains history the estimator already holds.
+        :param df: a dataframe of returns indexed by (sortable) time, containing every column in self.columns
+        :return: the number of rows added
+        """
+        if self.last_index is not None:
+            df = df[df.index > self.last_index]
+        for (index, row) in zip(df.index, df[self.columns].values):
+            self.update(row, index)
+        return len(df)
+
+    def recompute(self):
+        """
+        Rebuilds every running sum exactly from the buffered window.
+        """
+        rows = self.__window_rows()
+        with np.errstate(invalid='ignore'):
+            shift = np.nanmean(rows, axis=0) if len(rows) else np.zeros(len(self.columns))
+        self.shift = np.nan_to_num(shift)
+        for name in ('beta_n', 'beta_sx', 'beta_sy', 'beta_sxx', 'beta_sxy', 'missing', 's'):
+            getattr(self, name)[:] = 0.0
+        if self.pairwise:
+            self.cross[:] = 0.0
+        for row in rows:
+            self.__accumulate(row, 1.0)
+        self.updates_since_recompute = 0
+
+    def beta(self) -> pd.Series:
+        """
+        :return: the current beta of every non-market column against the market column (NaN if undefined)
+        """
+        n, sx, sy, sxx, sxy = self.beta_n, self.beta_sx, self.beta_sy, self.beta_sxx, self.beta_sxy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = sxx - sx * sx / n
+            beta = (sxy - sx * sy / n) / var
+        beta[(n < max(self.min_periods, 2)) | ~(var > 1e-12 * np.maximum(sxx, 1e-300))] = np.nan
+        assets = [i for i in range(len(self.columns)) if i != self.market_idx]
+        return pd.Series(beta[assets], index=[self.columns[i] for i in assets], name='beta')
+
+    def corr(self) -> pd.DataFrame:
+        """
+        :return: the current K x K correlation matrix (NaN until the window is full)
+        """
+        if not self.pairwise:
+            raise Exception('Correlations are only tracked when pairwise = True')
+        k = len(self.columns)
+        if self.count < self.window:
+            return pd.DataFrame(np.full((k, k), np.nan), index=self.columns, columns=self.columns)
+        n = self.window
+        cov = self.cross - np.outer(self.s, self.s) / n
+        var = np.diag(cov).copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.clip(cov / np.sqrt(np.outer(var, var)), -1.0, 1.0)
+        undefined = (self.missing > 0) | ~(var > 1e-12 * n)
+        corr[undefined[:, None] | undefined[None, :]] = np.nan
+        return pd.DataFrame(corr, index=self.columns, columns=self.columns)
+
+    def save(self, path: str):
+        """
+        Writes the estimator's state to an .npz file (atomically, so a crash mid-save leaves the previous state).
+        """
+        meta = {'columns': self.columns, 'window': self.window, 'market_column': self.market_column,
+                'pairwise': self.pairwise, 'min_periods': self.min_periods, 'recompute_every': self.recompute_every,
+                'position': self.position, 'count': self.count,
+                'updates_since_recompute': self.updates_since_recompute,
+                'last_index': None if self.last_index is None else pd.Timestamp(self.last_index).isoformat()}
+        arrays = {name: getattr(self, name) for name in self.__state_arrays()}
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'OnlineRollingEstimator':
+        """
+        Restores an estimator written by #save.
+        """
+        with np.load(path) as state:
+            meta = json.loads(str(state['meta']))
+            estimator = cls(meta['columns'], meta['window'], market_column=meta['market_column'],
+                            pairwise=meta['pairwise'], min_periods=meta['min_periods'],
+                            recompute_every=meta['recompute_every'])
+            for name in estimator.__state_arrays():
+                setattr(estimator, name, state[name].copy())
+        estimator.position = meta['position']
+        estimator.count = meta['count']
+        estimator.updates_since_recompute = meta['updates_since_recompute']
+        estimator.last_index = None if meta['last_index'] is None else pd.Timestamp(meta['last_index'])
+        return estimator
+
+    def __state_arrays(self) -> typing.List[str]:
+        names = ['buffer', 'shift', 'beta_n', 'beta_sx', 'beta_sy', 'beta_sxx', 'beta_sxy', 'missing', 's']
+        return names + ['cross'] if self.pairwise else names
+
+    def __window_rows(self) -> np.ndarray:
+        if self.count < self.window:
+            return self.buffer[:self.count]
+        return np.roll(self.buffer, -self.position, axis=0)
+
+    def __accumulate(self, row: np.ndarray, sign: float):
+        missing = np.isnan(row)
+        values = np.where(missing, 0.0, row - self.shift)
+        x = values[self.market_idx]
+        both = ~missing & ~missing[self.market_idx]
+        self.beta_n += sign * both
+        self.beta_sx += sign * np.where(both, x, 0.0)
+        self.beta_sy += sign * np.where(both, values, 0.0)
+        self.beta_sxx += sign * np.where(both, x * x, 0.0)
+        self.beta_sxy += sign * np.where(both, x * values, 0.0)
+        self.missing += sign * missing
+        self.s += sign * values
+        if self.pairwise:
+            self.cross += sign * np.outer(values, values)
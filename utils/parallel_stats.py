@@ -0,0 +1,187 @@
+import math
+import typing
+import uuid
+
+import multiprocess
+import numpy as np
+from multiprocess.shared_memory import SharedMemory
+
+from utils.rolling_stats import rolling_conditional_betas, rolling_corr_matrices
+
+"""
+Process-parallel versions of the utils.rolling_stats analytics.
+The returns matrix and the outputs are placed once in shared memory (or in memory-mapped .npy files), and workers
+are only sent small specs to attach to them - so nothing proportional to the data is pickled per task. Betas are
+split into blocks of asset columns, correlations into blocks of column pairs, and each worker writes its block
+straight into the shared output.
+"""
+
+ArraySpec = typing.Tuple
+
+
+class SharedArray:
+    """
+    A numpy array backed by a named shared memory block (or by an .npy file when `path` is given), which other
+    processes attach to through #spec / #attach_array. Unlinked on #close unless it's file backed.
+    """
+    def __init__(self, shape: typing.Tuple[int, ...], dtype: np.dtype = np.float64, path: str = None):
+        dtype = np.dtype(dtype)
+        if path is not None:
+            self.shm = None
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+            self.spec = ('npy', path)
+        else:
+            self.shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1),
+                                    name=f'ftx-{uuid.uuid4().hex[:16]}')
+            self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+            self.spec = ('shm', self.shm.name, shape, dtype.str)
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, path: str = None) -> 'SharedArray':
+        shared = cls(array.shape, array.dtype, path=path)
+        shared.array[:] = array
+        return shared
+
+    def close(self):
+        if self.shm is not None:
+            del self.array
+            self.shm.close()
+            self.shm.unlink()
+        else:
+            self.array.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def attach_array(spec: ArraySpec) -> typing.Tuple[np.ndarray, typing.Optional[SharedMemory]]:
+    """
+    Attaches to an array created by SharedArray, in another process.
+    :return: the array & the shared memory handle (None for files), which must be closed once the array is dropped
+    """
+    if spec[0] == 'npy':
+        return np.load(spec[1], mmap_mode='r+'), None
+    shm = SharedMemory(name=spec[1])
+    return np.ndarray(spec[2], dtype=np.dtype(spec[3]), buffer=shm.buf), shm
+
+
+def parallel_conditional_betas(values: np.ndarray, window: int, processes: int, min_periods: int = None,
+                               conditional_min_periods: int = 2, block_columns: int = None,
+                               input_path: str = None) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    #rolling_conditional_betas of every column of `values` against its first (market) column, over blocks of
+    asset columns in a process pool.
+    :param values: an array of shape (N, K), the market returns in the first column
+    :param window: the window length (in rows)
+    :param processes: the number of worker processes
+    :param min_periods: see utils.rolling_stats#rolling_conditional_betas
+    :param conditional_min_periods: see utils.rolling_stats#rolling_conditional_betas
+    :param block_columns: the number of asset columns per task (defaults to ~4 tasks per process)
+    :param input_path: if given, the returns are shared through a memory-mapped .npy file at this path rather
+    than shared memory
+    :return: a tuple of (all, down, up) beta arrays, each of shape (N - window + 1, K - 1)
+    """
+    n_assets = values.shape[1] - 1
+    shape = (max(values.shape[0] - window + 1, 0), n_assets)
+    block_columns = block_columns or max(1, math.ceil(n_assets / (4 * processes)))
+    with SharedArray.from_array(np.asarray(values, dtype=np.float64), path=input_path) as shared_values, \
+            SharedArray(shape) as all_beta, SharedArray(shape) as down_beta, SharedArray(shape) as up_beta:
+        output_specs = (all_beta.spec, down_beta.spec, up_beta.spec)
+        tasks = [(shared_values.spec, output_specs, start, min(start + block_columns, n_assets), window,
+                  min_periods, conditional_min_periods) for start in range(0, n_assets, block_columns)]
+        _run_tasks(_beta_block, tasks, processes)
+        return all_beta.array.copy(), down_beta.array.copy(), up_beta.array.copy()
+
+
+def parallel_rolling_corr_matrices(values: np.ndarray, window: int, processes: int, dtype: np.dtype = np.float64,
+                                   path: str = None, block_columns: int = None,
+                                   input_path: str = None) -> np.ndarray:
+    """
+    #rolling_corr_matrices over blocks of column pairs in a process pool. Only the upper triangle of blocks is
+    computed, each worker mirroring its block into the lower triangle.
+    :param values: an array of shape (N, K)
+    :param window: the window length (in rows)
+    :param processes: the number of worker processes
+    :param dtype: the storage dtype of the correlations
+    :param path: if given, the correlations are written to (and returned as) a memory-mapped .npy file at this path
+    :param block_columns: the number of columns per block (defaults to ~4 block pairs per process)
+    :param input_path: if given, the returns are shared through a memory-mapped .npy file at this path rather
+    than shared memory
+    :return: an array of shape (N - window + 1, K, K)
+    """
+    n_columns = values.shape[1]
+    shape = (max(values.shape[0] - window + 1, 0), n_columns, n_columns)
+    # n blocks give n(n + 1) / 2 block pairs
+    n_blocks = max(1, min(n_columns, math.ceil(math.sqrt(8 * processes))))
+    block_columns = block_columns or math.ceil(n_columns / n_blocks)
+    starts = range(0, n_columns, block_columns)
+    blocks = [(start, min(start + block_columns, n_columns)) for start in starts]
+    with SharedArray.from_array(np.asarray(values, dtype=np.float64), path=input_path) as shared_values:
+        output = SharedArray(shape, dtype, path=path)
+        try:
+            tasks = [(shared_values.spec, output.spec, left, right, window)
+                     for (i, left) in enumerate(blocks) for right in blocks[i:]]
+            _run_tasks(_corr_block, tasks, processes)
+            if path is not None:
+                output.close()
+                return np.load(path, mmap_mode='r+')
+            return output.array.copy()
+        finally:
+            if path is None:
+                output.close()
+
+
+def _run_tasks(func: typing.Callable, tasks: typing.List[tuple], processes: int):
+    with multiprocess.Pool(processes) as pool:
+        for _ in pool.imap_unordered(func, tasks):
+            pass
+
+
+def _attach(spec: ArraySpec, handles: typing.List[SharedMemory]) -> np.ndarray:
+    array, shm = attach_array(spec)
+    if shm is not None:
+        handles.append(shm)
+    return array
+
+
+def _release(handles: typing.List[SharedMemory]):
+    for shm in handles:
+        shm.close()
+
+
+def _beta_block(task: tuple):
+    (values_spec, output_specs, start, stop, window, min_periods, conditional_min_periods) = task
+    handles = []
+    try:
+        values = _attach(values_spec, handles)
+        outputs = [_attach(spec, handles) for spec in output_specs]
+        betas = rolling_conditional_betas(values[:, 0], values[:, 1 + start:1 + stop], window,
+                                          min_periods=min_periods, conditional_min_periods=conditional_min_periods)
+        for (output, beta) in zip(outputs, betas):
+            output[:, start:stop] = beta
+    finally:
+        # shared memory can only be closed once no array views into it are left
+        values = outputs = None
+        _release(handles)
+
+
+def _corr_block(task: tuple):
+    (values_spec, output_spec, (left_start, left_stop), (right_start, right_stop), window) = task
+    handles = []
+    try:
+        values = _attach(values_spec, handles)
+        output = _attach(output_spec, handles)
+        block = output[:, left_start:left_stop, right_start:right_stop]
+        rolling_corr_matrices(values, window, left_columns=range(left_start, left_stop),
+                              right_columns=range(right_start, right_stop), out=block)
+        if left_start != right_start:
+            output[:, right_start:right_stop, left_start:left_stop] = block.transpose(0, 2, 1)
+        if isinstance(output, np.memmap):
+            output.flush()
+    finally:
+        # shared memory can only be closed once no array views into it are left
+        values = output = block = None
+        _release(handles)
@@ -0,0 +1,28 @@
+import time
+
+import multiprocess
+
+
+class RateLimiter:
+    """
+    A simple rate limiter that can be shared between processes (pass it to multiprocess.Process args).
+    Calls to #acquire are spaced evenly so that, across every process holding the limiter, no more than `rate`
+    calls are let through per second.
+    """
+    def __init__(self, rate: float):
+        if rate <= 0:
+            raise Exception(f'Rate must be positive, provided {rate}')
+        self.interval = 1.0 / rate
+        self._next_slot = multiprocess.Value('d', 0.0, lock=False)
+        self._lock = multiprocess.Lock()
+
+    def acquire(self):
+        """
+        Blocks until the caller is allowed to make its next call.
+        """
+        with self._lock:
+            slot = max(time.time(), self._next_slot.value)
+            self._next_slot.value = slot + self.interval
+        delay = slot - time.time()
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,194 @@
+import typing
+import warnings
+
+import numpy as np
+
+"""
+Vectorized rolling statistics built on cumulative sums.
+Any windowed sum can be read off a cumulative sum as S[t] - S[t - window], so rolling regressions over every column
+at once cost O(N·K) time and memory, rather than materializing each (window x K) slice.
+"""
+
+
+def rolling_window_sums(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Sums `values` over every trailing window along the first axis.
+    :param values: an array of shape (N, ...)
+    :param window: the window length
+    :return: an array of shape (N - window + 1, ...), where row i is the sum of values[i:i + window]
+    """
+    sums = np.cumsum(values, axis=0, dtype=np.float64)
+    out = sums[window - 1:].copy()
+    out[1:] -= sums[:-window]
+    return out
+
+
+def rolling_beta(market: np.ndarray, assets: np.ndarray, window: int, min_periods: int = None,
+                 mask: np.ndarray = None) -> np.ndarray:
+    """
+    Exact rolling OLS betas (with intercept) of every asset column against the market, i.e. for each window
+    cov(market, asset) / var(market), from rolling sums of x, y, x², xy.
+    Windows are NaN-aware: each (window, asset) pair only uses the rows where both the market and that asset
+    have data.
+    :param market: market returns of shape (N,)
+    :param assets: asset returns of shape (N, K)
+    :param window: the window length (in rows)
+    :param min_periods: the min number of usable rows for a beta to be reported (defaults to the full window)
+    :param mask: an optional boolean array of shape (N,) - rows where this is false are excluded from every window
+    (e.g. to compute betas over up or down market periods only)
+    :return: an array of betas of shape (N - window + 1, K), where row i covers rows [i, i + window)
+    """
+    min_periods = window if min_periods is None else min_periods
+    x, y, valid = _centered_observations(market, assets)
+    if mask is not None:
+        valid &= np.asarray(mask, dtype=bool)[:, None]
+        x = np.where(valid, x, 0.0)
+        y = np.where(valid, y, 0.0)
+    sums = [rolling_window_sums(v, window) for v in (valid, x, y, x * x, x * y)]
+    return _beta_from_sums(*sums, min_periods=min_periods)
+
+
+def rolling_conditional_betas(market: np.ndarray, assets: np.ndarray, window: int, min_periods: int = None,
+                              conditional_min_periods: int = 2) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Rolling betas over all periods, down market periods (market < 0) and up market periods (market >= 0), from a
+    single pass over the returns matrix.
+    The sufficient statistics are only accumulated over all rows and over down rows - every usable row is either a
+    down or an up row, so the up sums are just their difference.
+    :param market: market returns of shape (N,)
+    :param assets: asset returns of shape (N, K)
+    :param window: the window length (in rows)
+    :param min_periods: the min number of usable rows for an unconditional beta (defaults to the full window)
+    :param conditional_min_periods: the min number of usable down/up rows in a window for a down/up beta
+    :return: a tuple of (all, down, up) beta arrays, each of shape (N - window + 1, K)
+    """
+    min_periods = window if min_periods is None else min_periods
+    x, y, valid = _centered_observations(market, assets)
+    xx = x * x
+    xy = x * y
+    down = (np.asarray(market, dtype=np.float64) < 0)[:, None] & valid
+    down_sums = [rolling_window_sums(np.where(down, v, 0.0), window) for v in (valid, x, y, xx, xy)]
+    all_sums = [rolling_window_sums(v, window) for v in (valid, x, y, xx, xy)]
+    up_sums = [a - d for (a, d) in zip(all_sums, down_sums)]
+    return (_beta_from_sums(*all_sums, min_periods=min_periods),
+            _beta_from_sums(*down_sums, min_periods=conditional_min_periods),
+            _beta_from_sums(*up_sums, min_periods=conditional_min_periods))
+
+
+def _centered_observations(market: np.ndarray, assets: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (x, y, valid): market & asset returns broadcast to (N, K), centered, and zeroed wherever either is NaN,
+    along with the (N, K) mask of usable rows per asset.
+    """
+    x = np.asarray(market, dtype=np.float64)[:, None]
+    y = np.asarray(assets, dtype=np.float64)
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    # Centering first keeps the sum-of-squares differences below from cancelling catastrophically
+    x = np.where(valid, x - np.nanmean(x), 0.0)
+    y = np.where(valid, y - np.nanmean(y, axis=0), 0.0)
+    return x, y, valid
+
+
+def _beta_from_sums(n: np.ndarray, sx: np.ndarray, sy: np.ndarray, sxx: np.ndarray, sxy: np.ndarray,
+                    min_periods: int) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sy / n
+        var = sxx - sx * sx / n
+        beta = cov / var
+    beta[(n < max(min_periods, 2)) | ~(var > 1e-12 * np.maximum(sxx, 1e-300))] = np.nan
+    return beta
+
+
+def rolling_corr_matrices(values: np.ndarray, window: int, left_columns: typing.Sequence[int] = None,
+                          right_columns: typing.Sequence[int] = None, out: np.ndarray = None,
+                          dtype: np.dtype = np.float64, max_block_bytes: int = 64 * 2 ** 20) -> np.ndarray:
+    """
+    Rolling pairwise (Pearson) correlation matrices of the columns of `values`, written into a preallocated
+    (N - window + 1, L, R) array - which may be a np.memmap for universes too large to hold in memory.
+    Time is processed in blocks: each block starts from the exact cross-product sums of its first window and rolls
+    forward by adding the entering row's outer product & subtracting the leaving one's, so the float64 temporaries are
+    bounded by max_block_bytes and accumulated rounding error is reset at every block.
+    A window with any NaN in a column yields NaN for all of that column's pairs (as with pandas' rolling corr), as do
+    constant windows.
+    :param values: an array of shape (N, K)
+    :param window: the window length (in rows)
+    :param left_columns: the column indices for the first matrix axis (defaults to all K columns)
+    :param right_columns: the column indices for the second matrix axis (defaults to all K columns)
+    :param out: an optional array of shape (N - window + 1, L, R) to write into (e.g. a np.memmap)
+    :param dtype: the dtype of the output when `out` isn't given (e.g. np.float32 to halve memory)
+    :param max_block_bytes: the memory budget for the per-block float64 temporaries
+    :return: the correlation array, where out[i, a, b] covers rows [i, i + window) of left column a & right column b
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_windows = values.shape[0] - window + 1
+    left = np.arange(values.shape[1]) if left_columns is None else np.asarray(left_columns)
+    right = np.arange(values.shape[1]) if right_columns is None else np.asarray(right_columns)
+    if out is None:
+        out = np.empty((max(n_windows, 0), len(left), len(right)), dtype=dtype)
+    if n_windows <= 0:
+        return out
+    missing = np.isnan(values)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        centers = np.nan_to_num(np.nanmean(values, axis=0))
+    x = np.where(missing, 0.0, values - centers)
+    has_missing = rolling_window_sums(missing, window) > 0
+    x_left, x_right = x[:, left], x[:, right]
+    # ~3 (rows, L, R) float64 temporaries are alive at once
+    block_size = max(1, int(max_block_bytes // (3 * 8 * max(len(left) * len(right), 1))))
+    for start in range(0, n_windows, block_size):
+        stop = min(start + block_size, n_windows)
+        rows = slice(start, stop + window - 1)
+        cross = np.empty((stop - start, len(left), len(right)))
+        cross[0] = x_left[start:start + window].T @ x_right[start:start + window]
+        entering, leaving = slice(start + window, stop + window - 1), slice(start, stop - 1)
+        np.subtract(x_left[entering, :, None] * x_right[entering, None, :],
+                    x_left[leaving, :, None] * x_right[leaving, None, :], out=cross[1:])
+        np.cumsum(cross, axis=0, out=cross)
+        sum_left, sum_right = rolling_window_sums(x_left[rows], window), rolling_window_sums(x_right[rows], window)
+        var_left = rolling_window_sums(x_left[rows] ** 2, window) - sum_left ** 2 / window
+        var_right = rolling_window_sums(x_right[rows] ** 2, window) - sum_right ** 2 / window
+        cross -= sum_left[:, :, None] * sum_right[:, None, :] / window
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cross /= np.sqrt(var_left[:, :, None] * var_right[:, None, :])
+        np.clip(cross, -1.0, 1.0, out=cross)
+        undefined_left = has_missing[start:stop][:, left] | ~(var_left > 1e-12 * window)
+        undefined_right = has_missing[start:stop][:, right] | ~(var_right > 1e-12 * window)
+        cross[undefined_left[:, :, None] | undefined_right[:, None, :]] = np.nan
+        out[start:stop] = cross
+    return out
+
+
+def reduce_pairs(stacked: np.ndarray, how: str = 'median', q: typing.Union[float, typing.Sequence[float]] = None,
+                 max_block_bytes: int = 64 * 2 ** 20) -> np.ndarray:
+    """
+    NaN-skipping reduction of a stack of (L, R) matrices along the time axis, e.g. the per-pair median correlation
+    over every window of #rolling_corr_matrices.
+    The stack is reduced in slabs of its first matrix axis, so memory-mapped inputs are streamed through rather than
+    loaded whole.
+    :param stacked: an array of shape (T, L, R)
+    :param how: one of 'median', 'mean' or 'quantile'
+    :param q: the quantile(s) in [0, 1] to compute when how = 'quantile'
+    :param max_block_bytes: the memory budget for each float64 slab
+    :return: an (L, R) array, or (len(q), L, R) for a sequence of quantiles
+    """
+    reducers = {
+        'median': lambda block: np.nanmedian(block, axis=0),
+        'mean': lambda block: np.nanmean(block, axis=0),
+        'quantile': lambda block: np.nanquantile(block, q, axis=0),
+    }
+    if how not in reducers:
+        raise Exception(f'Unknown reduction {how}, expected one of {list(reducers)}')
+    if how == 'quantile' and q is None:
+        raise Exception('q is required for quantile reductions')
+    n_steps, n_left, n_right = stacked.shape
+    quantile_shape = np.shape(q) if how == 'quantile' else ()
+    out = np.empty(quantile_shape + (n_left, n_right))
+    slab = max(1, int(max_block_bytes // (8 * max(n_steps * n_right, 1))))
+    with warnings.catch_warnings():
+        # all-NaN pairs (e.g. undefined correlations) reduce to NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for start in range(0, n_left, slab):
+            stop = min(start + slab, n_left)
+            out[..., start:stop, :] = reducers[how](np.asarray(stacked[:, start:stop], dtype=np.float64))
+    return out
@@ -3,12 +3,12 @@ import typing
 import pandas
 import pandas as pd
 import numpy as np
-from numpy.lib.stride_tricks import as_strided as stride
 from tqdm import tqdm
 import sys, os
 sys.path.insert(0, os.path.abspath('..'))
 
-import data.accessor.big_query as bq
+from utils.parallel_stats import parallel_conditional_betas, parallel_rolling_corr_matrices
+from utils.rolling_stats import rolling_beta, rolling_conditional_betas, rolling_corr_matrices, reduce_pairs
 tqdm.pandas()
 
 
@@ -22,62 +22,130 @@ def compute_beta(df: pd.DataFrame, name: str = 'Beta', market_idx: int = 0) -> p
 
 
 class TimeseriesCorrelationAnalysis:
-    def __init__(self, df: pd.DataFrame, null_fill_method: str = 'ffill'):
+    def __init__(self, df: pd.DataFrame, null_fill_method: str = 'ffill', processes: int = 1):
+        """
+        :param df: a dataframe of returns, the market returns in the first column
+        :param null_fill_method: the fillna method applied to df
+        :param processes: if > 1, #beta and #rolling_corr_matrices fan column blocks out to this many processes,
+        sharing the returns through shared memory (see utils.parallel_stats)
+        """
         self.df = df
+        self.processes = processes
         self.df = self.df.fillna(method=null_fill_method)
 
-    def __roll(self, window, **kwargs):
-        v = self.df.values
-        d0, d1 = v.shape
-        s0, s1 = v.strides
-
-        a = stride(v, (d0 - (window - 1), window, d1), (s0, s0, s1))
-
-        rolled_df = pd.concat({
-            row: pd.DataFrame(values, columns=self.df.columns)
-            for row, values in zip(self.df.index, a)
-        })
-
-        return rolled_df.groupby(level=0, **kwargs)
-
-    def beta(self, window: int = 120):
-        dfs = self.__roll(window=window)
-        up_dfs = []
-        down_dfs = []
-        for name, df in dfs:
-            mkt_returns = df[df.columns[0]]
-            up_dfs.append(df[mkt_returns >= 0])
-            down_dfs.append(df[mkt_returns < 0])
-        print('computing betas')
-        all_beta = dfs.progress_apply(compute_beta)
-        down_beta = pd.Series(down_dfs).apply(lambda x: compute_beta(x, name='Down Beta'))
-        up_beta = pd.Series(up_dfs).apply(lambda x: compute_beta(x, name='Up Beta'))
-        return all_beta, down_beta, up_beta
+    def rolling_beta(self, window: int = 120, min_periods: int = None) -> pd.DataFrame:
+        """
+        Rolling betas of every column against the first (market) column, computed for all columns at once from
+        rolling sums (see utils.rolling_stats#rolling_beta) in O(N·K) time and memory.
+        Matches #compute_beta over each window, except that NaNs are dropped per column rather than poisoning the
+        whole window.
+        :param window: the window length (in rows)
+        :param min_periods: the min number of non-NaN rows for a beta to be reported (defaults to the full window)
+        :return: a dataframe of betas, indexed by the last row of each window
+        """
+        values = self.df.values
+        betas = rolling_beta(values[:, 0], values[:, 1:], window, min_periods=min_periods)
+        return pd.DataFrame(betas, index=self.df.index[window - 1:], columns=self.df.columns[1:])
+
+    def beta(self, window: int = 120, min_periods: int = None, conditional_min_periods: int = 2) -> typing.Tuple[
+            pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """
+        Rolling betas of every column against the first (market) column - over all periods, down market periods
+        (market return < 0) and up market periods (market return >= 0) - computed together in one vectorized pass
+        (see utils.rolling_stats#rolling_conditional_betas), in parallel over asset blocks when processes > 1.
+        :param window: the window length (in rows)
+        :param min_periods: the min number of non-NaN rows for a beta to be reported (defaults to the full window)
+        :param conditional_min_periods: the min number of down/up rows in a window for a down/up beta to be reported
+        :return: a tuple of (beta, down beta, up beta) dataframes, indexed by the last row of each window
+        """
+        values = self.df.values
+        if self.processes > 1:
+            all_beta, down_beta, up_beta = parallel_conditional_betas(values, window, self.processes,
+                                                                      min_periods=min_periods,
+                                                                      conditional_min_periods=conditional_min_periods)
+        else:
+            all_beta, down_beta, up_beta = rolling_conditional_betas(values[:, 0], values[:, 1:], window,
+                                                                     min_periods=min_periods,
+                                                                     conditional_min_periods=conditional_min_periods)
+        to_frame = lambda betas: pd.DataFrame(betas, index=self.df.index[window - 1:], columns=self.df.columns[1:])
+        return to_frame(all_beta), to_frame(down_beta), to_frame(up_beta)
 
     def rolling_corr(self, window: int = 120):
         return self.df.rolling(window=window).corr(pairwise=True)[(len(self.df.columns) * (window - 1)):]
 
-    def pairwise_median_corr_by_window(self, period_start: int, rolling_window: int = 120):
-        multindex = self.rolling_corr(window=rolling_window)
-        datetimes = multindex.index.get_level_values(0).unique()
-        medianed_values = multindex.iloc[multindex.index.get_level_values(0).isin(datetimes[period_start:])]
-        listings = []
-        for column in tqdm(medianed_values.columns):
-            zf = medianed_values[column].unstack().reset_index()
-            zf = zf.set_index('datetime')
-            for col in zf.columns:
-                if col == column:
-                    continue
-                listings.append({"col1": column, "col2": col, "median_corr": zf[col].median()})
-        return pd.DataFrame(listings)
+    def rolling_corr_matrices(self, window: int = 120, dtype: np.dtype = np.float64, path: str = None) -> np.ndarray:
+        """
+        Rolling K x K correlation matrices of all columns (see utils.rolling_stats#rolling_corr_matrices) - the
+        array counterpart of #rolling_corr, without building an (N·K) x K MultiIndex frame. Computed in parallel
+        over blocks of column pairs when processes > 1.
+        :param window: the window length (in rows)
+        :param dtype: the storage dtype (e.g. np.float32 to halve memory for large universes)
+        :param path: if given, the matrices are written to a memory-mapped .npy file at this path rather than held
+        in memory
+        :return: an array of shape (N - window + 1, K, K), where entry i covers the window ending at
+        self.df.index[window - 1 + i]
+        """
+        if self.processes > 1:
+            return parallel_rolling_corr_matrices(self.df.values, window, self.processes, dtype=dtype, path=path)
+        n_columns = len(self.df.columns)
+        shape = (max(len(self.df) - window + 1, 0), n_columns, n_columns)
+        out = None if path is None else np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        return rolling_corr_matrices(self.df.values, window, out=out, dtype=dtype)
+
+    def pairwise_corr_stat(self, period_start: int = 0, rolling_window: int = 120, how: str = 'median',
+                           q: float = None, dtype: np.dtype = np.float64, path: str = None) -> pd.DataFrame:
+        """
+        Reduces each pair's rolling correlation over time (see utils.rolling_stats#reduce_pairs).
+        :param period_start: the number of leading windows to skip
+        :param rolling_window: the window length (in rows)
+        :param how: one of 'median', 'mean' or 'quantile'
+        :param q: the quantile to compute when how = 'quantile'
+        :param dtype: the storage dtype of the rolling correlations
+        :param path: an optional path to memory-map the rolling correlations to
+        :return: a K x K dataframe of the reduced correlation for each pair of columns
+        """
+        matrices = self.rolling_corr_matrices(window=rolling_window, dtype=dtype, path=path)
+        reduced = reduce_pairs(matrices[period_start:], how=how, q=q)
+        return pd.DataFrame(reduced, index=self.df.columns, columns=self.df.columns)
+
+    def pairwise_median_corr_by_window(self, period_start: int, rolling_window: int = 120, dtype: np.dtype = np.float64,
+                                       path: str = None) -> pd.DataFrame:
+        medians = self.pairwise_corr_stat(period_start, rolling_window, how='median', dtype=dtype, path=path)
+        # every ordered pair of distinct columns, in column order
+        col1, col2 = np.meshgrid(medians.index, medians.columns, indexing='ij')
+        off_diagonal = ~np.eye(len(medians), dtype=bool)
+        return pd.DataFrame({"col1": col1[off_diagonal], "col2": col2[off_diagonal],
+                             "median_corr": medians.values[off_diagonal]})
 
     def compute_beta_for_indices_on_coins(self, coin_log_returns: pd.DataFrame):
         pass
 
+def max_deviation_from_compute_beta(df: pd.DataFrame, window: int = 120) -> float:
+    """
+    Validates TimeseriesCorrelationAnalysis#rolling_beta & #beta against the per-window #compute_beta loop they
+    replaced.
+    :param df: a dataframe of returns without NaNs (which #compute_beta doesn't handle), the market in the first column
+    :return: the max absolute difference between the vectorized betas & #compute_beta over every window
+    """
+    analysis = TimeseriesCorrelationAnalysis(df)
+    expected = np.stack([compute_beta(df.iloc[end - window:end]).values for end in range(window, len(df) + 1)])
+    return max(float(np.nanmax(np.abs(analysis.rolling_beta(window).values - expected))),
+               float(np.nanmax(np.abs(analysis.beta(window)[0].values - expected))))
+
+
 if __name__ == '__main__':
-    dates = pd.date_range('1995-12-31', periods=480, freq='M', name='Date')
-    stoks = pd.Index(['s{:04d}'.format(i) for i in range(4000)])
-    df = pd.read_csv('combined_index_returns.csv')
-    df = df.set_index('Unnamed: 0')
-    df = df.fillna(method='ffill')
-    TimeseriesCorrelationAnalysis(df).beta().to_csv('beta.csv')
\ No newline at end of file
+    # python -m utils.timeseries_correlation_analysis [returns.csv] - validates the vectorized betas against
+    # compute_beta, on the given returns (whose betas are then written to beta.csv) or on random returns
+    if len(sys.argv) > 1:
+        df = pd.read_csv(sys.argv[1]).set_index('Unnamed: 0').fillna(method='ffill').dropna()
+    else:
+        rng = np.random.default_rng(0)
+        market = rng.normal(0, 0.02, 1000)
+        df = pd.DataFrame(np.column_stack([market] + [rng.uniform(0.5, 1.5) * market + rng.normal(0, 0.01, 1000)
+                                                       for _ in range(20)]),
+                          columns=['market'] + [f'asset{i}' for i in range(20)])
+    deviation = max_deviation_from_compute_beta(df)
+    print(f'Max deviation from compute_beta: {deviation:.3g}')
+    assert deviation < 1e-8
+    if len(sys.argv) > 1:
+        TimeseriesCorrelationAnalysis(df).beta()[0].to_csv('beta.csv')
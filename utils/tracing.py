@@ -0,0 +1,148 @@
+import contextlib
+import time
+import typing
+import uuid
+from dataclasses import dataclass, field
+
+"""
+Tracing of pipeline cycles across executors.
+A trace follows one clock tick through the pipeline (e.g. ClockExecutor -> PositionExecutor -> FtxOrderHandler ->
+DbWriterExecutor) as a chain of spans, each timing one stage in one executor. A span's parent is the span that
+ended before it on the same path - the previous stage in the executor, or for the first stage after a delivery the
+"queue" span covering the time the message spent between publish & receipt - so the chain from any span back to
+the root is the path that led to it.
+Trace contexts travel inside messages (see executors/message_schema.py) and as trace_id columns of DB rows, and
+finished spans are published to executors/trace_collector.py, which rebuilds each trace's critical path.
+Timestamps are wall clock (time.time()) seconds, as spans are compared across processes.
+"""
+
+QUEUE_STAGE: typing.Final = 'queue'
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex
+
+
+@dataclass
+class TraceContext:
+    """
+    The position of the current executor in a trace. parent_id is advanced to each span as it ends, so the next
+    span (or message published) follows it.
+    """
+    trace_id: str
+    parent_id: typing.Optional[str] = None
+    sent_at: typing.Optional[float] = None
+
+    def to_wire(self) -> dict:
+        """
+        :return: the context to attach to an outgoing message, stamped with its publish time
+        """
+        return {'trace_id': self.trace_id, 'parent_id': self.parent_id, 'sent_at': time.time()}
+
+    @staticmethod
+    def from_wire(value: dict) -> 'TraceContext':
+        return TraceContext(trace_id=value['trace_id'], parent_id=value.get('parent_id'),
+                            sent_at=value.get('sent_at'))
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: typing.Optional[str]
+    stage: str
+    sender: str
+    start: float
+    end: float
+    # Other traces this span depends on (e.g. the strategy runs whose positions an execution claimed)
+    links: typing.List[str] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Tracer:
+    """
+    Records an executor's spans, handing each finished span to `report` (e.g. MessageHelper#trace_span).
+    """
+    def __init__(self, sender: str, report: typing.Callable[[Span], None]):
+        self.sender = sender
+        self.report = report
+
+    def start_trace(self) -> TraceContext:
+        return TraceContext(trace_id=new_id())
+
+    def received(self, trace: typing.Optional[dict]) -> typing.Optional[TraceContext]:
+        """
+        Resumes the trace carried by a consumed message, recording the time it spent queued.
+        :param trace: the message's trace field (messages without one aren't traced)
+        :return: the context for the stages handling the message
+        """
+        if trace is None:
+            return None
+        context = TraceContext.from_wire(trace)
+        if context.sent_at is not None:
+            self.record(context, QUEUE_STAGE, context.sent_at, time.time())
+        return context
+
+    def record(self, context: typing.Optional[TraceContext], stage: str, start: float, end: float,
+               links: typing.Sequence[str] = ()) -> typing.Optional[Span]:
+        """
+        Records a span that has already ended, and advances the context past it.
+        """
+        if context is None:
+            return None
+        span = Span(trace_id=context.trace_id, span_id=new_id(), parent_id=context.parent_id, stage=stage,
+                    sender=self.sender, start=start, end=end, links=sorted(set(links)))
+        context.parent_id = span.span_id
+        try:
+            self.report(span)
+        except Exception as e:
+            # Tracing must never fail the stage it's timing
+            print(f'Failed reporting span {stage}: {repr(e)}')
+        return span
+
+    @contextlib.contextmanager
+    def span(self, context: typing.Optional[TraceContext], stage: str, links: typing.Sequence[str] = ()):
+        """
+        Times the enclosed block as a stage of the trace (a no-op without a context). The span is recorded even if
+        the block raises, so failed stages still show up in the trace.
+        """
+        start = time.time()
+        try:
+            yield context
+        finally:
+            self.record(context, stage, start, time.time(), links)
+
+
+def critical_path(spans: typing.Sequence[Span]) -> typing.List[Span]:
+    """
+    :param spans: the spans of a single trace
+    :return: the chain of spans leading to the last one to end, from the root - the path that set the trace's
+    end-to-end latency
+    """
+    if not spans:
+        return []
+    by_id = {span.span_id: span for span in spans}
+    path = [max(spans, key=lambda span: span.end)]
+    while path[-1].parent_id in by_id and len(path) <= len(by_id):
+        path.append(by_id[path[-1].parent_id])
+    return path[::-1]
+
+
+def stage_name(span: Span) -> str:
+    return f'{span.sender}.{span.stage}'
+
+
+def stage_latencies(path: typing.Sequence[Span]) -> typing.List[typing.Tuple[str, float]]:
+    """
+    Breaks a critical path down into (stage, seconds). Gaps between consecutive spans (time spent in an executor
+    between timed stages, or before publishing to the next one) are reported as "<sender>.untraced".
+    """
+    latencies = []
+    for (previous, span) in zip([None, *path[:-1]], path):
+        if previous is not None and span.start > previous.end:
+            latencies.append((f'{previous.sender}.untraced', span.start - previous.end))
+        latencies.append((stage_name(span), span.duration))
+    return latencies
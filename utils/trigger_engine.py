@@ -0,0 +1,125 @@
+import bisect
+import itertools
+import math
+import time
+import typing
+
+from models.trigger_rule import FiredTrigger, PRICE_METRIC, SPREAD_BPS_METRIC, TriggerRule
+
+"""
+Evaluates watch rules against a stream of ticker updates without checking every rule on every tick.
+Rules are compiled into sorted threshold indexes, one per (market, metric, direction). A metric moving from its
+previous value to the new one can only have crossed the thresholds lying between the two, which are a contiguous
+slice of the index found by bisection - so an update costs O(log n + hits), however many rules are watching.
+"""
+
+# (threshold, insertion sequence, rule_id) - the sequence breaks ties in insertion order
+_IndexEntry = typing.Tuple[float, int, str]
+
+
+class TriggerEngine:
+    """
+    Not thread safe - callers sharing an engine between threads (e.g. a websocket thread & an executor's I/O thread)
+    must serialize access.
+    """
+    def __init__(self):
+        self.rules: typing.Dict[str, TriggerRule] = {}
+        self._indexes: typing.Dict[typing.Tuple[str, str, str], typing.List[_IndexEntry]] = {}
+        self._entries: typing.Dict[str, _IndexEntry] = {}
+        self._sequence = itertools.count()
+        # (market, metric) -> last value seen
+        self.last_values: typing.Dict[typing.Tuple[str, str], float] = {}
+
+    def add_rule(self, rule: TriggerRule) -> typing.Optional[FiredTrigger]:
+        """
+        Adds (or replaces) a rule. A rule whose condition already holds against the market's last value fires
+        immediately - and a one-shot rule that does isn't added.
+        :return: the trigger, if the rule fired on being added
+        """
+        self.remove_rule(rule.rule_id)
+        last_value = self.last_values.get((rule.market, rule.metric))
+        if last_value is not None and _holds(rule, last_value):
+            fired = FiredTrigger(rule, last_value, time.time())
+            if not rule.rearm:
+                return fired
+        else:
+            fired = None
+        entry = (float(rule.threshold), next(self._sequence), rule.rule_id)
+        bisect.insort(self._indexes.setdefault((rule.market, rule.metric, rule.direction), []), entry)
+        self.rules[rule.rule_id] = rule
+        self._entries[rule.rule_id] = entry
+        return fired
+
+    def remove_rule(self, rule_id: str) -> typing.Optional[TriggerRule]:
+        rule = self.rules.pop(rule_id, None)
+        if rule is None:
+            return None
+        entry = self._entries.pop(rule_id)
+        index = self._indexes[(rule.market, rule.metric, rule.direction)]
+        del index[bisect.bisect_left(index, entry)]
+        return rule
+
+    def on_ticker(self, market: str, ticker: dict, now: float = None) -> typing.List[FiredTrigger]:
+        """
+        Updates a market's metrics from an FTX ticker ({bid, ask, last, time}) & fires the rules they crossed.
+        :return: the fired triggers, in threshold order along each metric's move
+        """
+        now = now if now is not None else ticker.get('time') or time.time()
+        (bid, ask, last) = (ticker.get('bid'), ticker.get('ask'), ticker.get('last'))
+        fired = []
+        if bid and ask:
+            mid = (bid + ask) / 2
+            fired += self.update(market, SPREAD_BPS_METRIC, (ask - bid) / mid * 1e4, now)
+            if last is None:
+                last = mid
+        if last is not None:
+            fired += self.update(market, PRICE_METRIC, last, now)
+        return fired
+
+    def update(self, market: str, metric: str, value: float, now: float = None) -> typing.List[FiredTrigger]:
+        """
+        Sets a market's metric & fires the rules whose thresholds it crossed since the last value. The first value
+        seen for a metric fires every rule whose condition it satisfies.
+        """
+        now = now if now is not None else time.time()
+        previous = self.last_values.get((market, metric))
+        self.last_values[(market, metric)] = value
+        if previous is not None and value == previous:
+            return []
+        fired = []
+        if previous is None or value > previous:
+            # Rising through t: previous < t <= value
+            fired += self.__fire(market, metric, 'above', previous if previous is not None else -math.inf, value,
+                                 rising=True, now=now)
+        if previous is None or value < previous:
+            # Falling through t: value <= t < previous
+            fired += self.__fire(market, metric, 'below', value, previous if previous is not None else math.inf,
+                                 rising=False, now=now)
+        return fired
+
+    def __fire(self, market: str, metric: str, direction: str, low: float, high: float, rising: bool,
+               now: float) -> typing.List[FiredTrigger]:
+        index = self._indexes.get((market, metric, direction))
+        if not index:
+            return []
+        if rising:
+            (start, end) = (bisect.bisect_right(index, (low, math.inf)), bisect.bisect_right(index, (high, math.inf)))
+        else:
+            (start, end) = (bisect.bisect_left(index, (low, -math.inf)), bisect.bisect_left(index, (high, -math.inf)))
+        if start == end:
+            return []
+        crossed = index[start:end]
+        value = high if rising else low
+        fired = [FiredTrigger(self.rules[rule_id], value, now)
+                 for (_, _, rule_id) in (crossed if rising else reversed(crossed))]
+        # One-shot rules are dropped from the slice in one go, rearming ones stay
+        index[start:end] = [entry for entry in crossed if self.rules[entry[2]].rearm]
+        for trigger in fired:
+            if not trigger.rule.rearm:
+                del self.rules[trigger.rule.rule_id]
+                del self._entries[trigger.rule.rule_id]
+        return fired
+
+
+def _holds(rule: TriggerRule, value: float) -> bool:
+    return value >= rule.threshold if rule.direction == 'above' else value <= rule.threshold
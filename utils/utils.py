@@ -1,3 +1,4 @@
+import time
 import typing
 
 import pandas as pd
@@ -86,44 +87,200 @@ def create_dollar_volume_if_needed(df: pd.DataFrame, price_columns: dict = DEFAU
 def resample_timeframe(df: pd.DataFrame, timeframe: str = '1D', price_columns: dict = DEFAULT_PRICE_DATA_COLUMNS,
                        merge_stables: bool = True) -> pd.DataFrame:
     """
-    Resample hourly data to daily data.
+    Resample hourly data to daily data (see #resample_timeframes).
     :param df: pd.DataFrame = a dataframe of returns data with the price_columns implied columns
     :param timeframe: str = a timeframe allowed by pandas.DataFrame#resample
     :param price_columns: dict = a dict for mapping the df's columns to the function required columns
     :param merge_stables: bool = merges stablecoin price data per timestamp if true, otherwise doesn't
     :return: the resampled dataframe output
     """
+    return resample_timeframes(df, [timeframe], price_columns, merge_stables)[timeframe]
+
+
+def resample_timeframes(df: pd.DataFrame, timeframes: typing.Sequence[str] = ('4h', '1D', '1W'),
+                        price_columns: dict = DEFAULT_PRICE_DATA_COLUMNS,
+                        merge_stables: bool = True) -> typing.Dict[str, pd.DataFrame]:
+    """
+    Resamples OHLCV data to several timeframes at once, with the same output as
+    groupby([symbol, base, product]).resample(timeframe).agg(first/last/max/min/sum) - including the empty periods
+    between a series' first & last rows - followed by the stablecoin merge.
+    Rows are sorted by series & time once, then for each timeframe every row gets an integer bucket index and each
+    (series, bucket) segment is reduced with vectorized ufunc.reduceat calls, instead of a groupby per timeframe.
+    Buckets come from resampling the unique timestamps, so a timeframe's buckets are shared by every series (this
+    matches pandas for timeframes that evenly divide a day, and for anchored ones like 1W / 1M).
+    :param df: pd.DataFrame = a dataframe of price data with the price_columns implied columns
+    :param timeframes: the timeframes (allowed by pandas.DataFrame#resample) to resample to
+    :param price_columns: dict = a dict for mapping the df's columns to the function required columns
+    :param merge_stables: bool = merges stablecoin price data per timestamp if true, otherwise doesn't
+    :return: a dict of timeframe -> the resampled dataframe output
+    """
     if not all(k in price_columns.keys() for k in (
-            'SYMBOL', 'BASE', 'PRODUCT', 'PRICE_OPEN', 'PRICE_CLOSE', 'PRICE_HIGH', "PRICE_LOW", 'DOLLAR_VOLUME',
+            'SYMBOL', 'BASE_UNIT', 'PRODUCT', 'PRICE_OPEN', 'PRICE_CLOSE', 'PRICE_HIGH', "PRICE_LOW", 'DOLLAR_VOLUME',
             'TIME')):
         raise Exception("Missing required columns from price columns mapper")
     dp = price_columns
     df = create_dollar_volume_if_needed(df, price_columns)
-    df = df.set_index(pd.to_datetime(df[dp['TIME']])).groupby(
-        [dp['SYMBOL'], dp['BASE'], dp['PRODUCT']]).resample(timeframe).agg(
-        {dp['PRICE_OPEN']: 'first', dp['PRICE_CLOSE']: 'last', dp['PRICE_HIGH']: max, dp['PRICE_LOW']: min,
-         dp['DOLLAR_VOLUME']: sum})
-    if merge_stables:
-        # If we have multiple stablecoins as bases (e.g. USDC, USDT, BUSD) treat all of them as equivalent
-        # and take the mean prices between them for each time
-        return df.groupby([dp['PRODUCT'], dp['SYMBOL'], dp['TIME']]).agg(
-            {dp['PRICE_OPEN']: 'mean', dp['PRICE_CLOSE']: 'mean', dp['PRICE_HIGH']: 'mean', dp['PRICE_LOW']: 'mean',
-             dp['DOLLAR_VOLUME']: sum}).reset_index()
-    return df.reset_index()
+    keys = [dp['SYMBOL'], dp['BASE_UNIT'], dp['PRODUCT']]
+    codes = df.groupby(keys, sort=True).ngroup().values
+    # rows with a null key are dropped, as by groupby
+    present = np.flatnonzero(codes >= 0)
+    all_times = pd.DatetimeIndex(pd.to_datetime(df[dp['TIME']]))
+    order = present[np.lexsort((all_times.asi8[present], codes[present]))]
+    codes, times = codes[order], all_times[order]
+    unique_times = times.unique().sort_values()
+    time_positions = np.searchsorted(unique_times.asi8, times.asi8)
+    _, first_rows = np.unique(codes, return_index=True)
+    series_keys = df.iloc[order[first_rows]][keys].reset_index(drop=True)
+    values = {column: df[column].values[order].astype(np.float64) for column in (
+        dp['PRICE_OPEN'], dp['PRICE_CLOSE'], dp['PRICE_HIGH'], dp['PRICE_LOW'], dp['DOLLAR_VOLUME'])}
+
+    resampled = {}
+    for timeframe in timeframes:
+        labels, bucket_of_time = _timeframe_buckets(unique_times, timeframe)
+        series, buckets, ohlcv = _reduce_series_buckets(codes, bucket_of_time[time_positions], values, dp)
+        if merge_stables:
+            # If we have multiple stablecoins as bases (e.g. USDC, USDT, BUSD) treat all of them as equivalent
+            # and take the mean prices between them for each time
+            merged_keys = series_keys.groupby([dp['PRODUCT'], dp['SYMBOL']], sort=True).ngroup().values
+            merged, buckets, ohlcv = _merge_series_buckets(merged_keys[series], buckets, ohlcv, dp)
+            _, first_series = np.unique(merged_keys, return_index=True)
+            out = series_keys.iloc[first_series][[dp['PRODUCT'], dp['SYMBOL']]].iloc[merged]
+        else:
+            out = series_keys.iloc[series]
+        out = out.reset_index(drop=True)
+        out[dp['TIME']] = labels[buckets]
+        for (column, column_values) in ohlcv.items():
+            out[column] = column_values
+        resampled[timeframe] = out
+    return resampled
+
+
+def _timeframe_buckets(unique_times: pd.DatetimeIndex, timeframe: str) -> typing.Tuple[pd.DatetimeIndex, np.ndarray]:
+    """
+    :return: the bucket labels for a timeframe (including empty buckets) & the bucket index of each unique time
+    """
+    bucket_first_time = pd.Series(np.arange(len(unique_times)), index=unique_times).resample(timeframe).first()
+    non_empty = np.flatnonzero(bucket_first_time.notna().values)
+    starts = bucket_first_time.values[non_empty].astype(np.int64)
+    bucket_of_time = non_empty[np.searchsorted(starts, np.arange(len(unique_times)), side='right') - 1]
+    return bucket_first_time.index, bucket_of_time
+
+
+def _segment_starts(*keys: np.ndarray) -> np.ndarray:
+    changed = np.zeros(len(keys[0]) - 1, dtype=bool)
+    for key in keys:
+        changed |= key[1:] != key[:-1]
+    return np.concatenate([[0], np.flatnonzero(changed) + 1])
+
+
+def _reduce_series_buckets(codes: np.ndarray, buckets: np.ndarray, values: typing.Dict[str, np.ndarray],
+                           dp: dict) -> typing.Tuple[np.ndarray, np.ndarray, typing.Dict[str, np.ndarray]]:
+    """
+    Reduces rows sorted by (series code, time) to one row per series & bucket, over every bucket between each
+    series' first & last row (empty buckets are NaN, with 0 volume).
+    :return: the series code & bucket index of each output row, and the OHLCV columns
+    """
+    if len(codes) == 0:
+        return codes, buckets, {column: np.array([]) for column in values}
+    starts = _segment_starts(codes, buckets)
+    segment_series, segment_buckets = codes[starts], buckets[starts]
+    series, series_starts, segment_counts = np.unique(segment_series, return_index=True, return_counts=True)
+    first_bucket = segment_buckets[series_starts]
+    lengths = segment_buckets[series_starts + segment_counts - 1] - first_bucket + 1
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    out_series = np.repeat(series, lengths)
+    out_buckets = np.repeat(first_bucket - offsets, lengths) + np.arange(lengths.sum())
+    positions = np.repeat(offsets - first_bucket, segment_counts) + segment_buckets
+
+    reduced = {
+        dp['PRICE_OPEN']: _segment_first_last(values[dp['PRICE_OPEN']], starts)[0],
+        dp['PRICE_CLOSE']: _segment_first_last(values[dp['PRICE_CLOSE']], starts)[1],
+        dp['PRICE_HIGH']: np.fmax.reduceat(values[dp['PRICE_HIGH']], starts),
+        dp['PRICE_LOW']: np.fmin.reduceat(values[dp['PRICE_LOW']], starts),
+        dp['DOLLAR_VOLUME']: np.add.reduceat(np.nan_to_num(values[dp['DOLLAR_VOLUME']]), starts),
+    }
+    ohlcv = {}
+    for (column, column_values) in reduced.items():
+        ohlcv[column] = np.zeros(len(out_series)) if column == dp['DOLLAR_VOLUME'] else np.full(len(out_series),
+                                                                                                 np.nan)
+        ohlcv[column][positions] = column_values
+    return out_series, out_buckets, ohlcv
+
+
+def _segment_first_last(values: np.ndarray, starts: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the first & last non-NaN value of each segment (NaN for all-NaN segments)
+    """
+    positions = np.arange(len(values))
+    valid = ~np.isnan(values)
+    first = np.minimum.reduceat(np.where(valid, positions, len(values)), starts)
+    last = np.maximum.reduceat(np.where(valid, positions, -1), starts)
+    # both out of range sentinels (len(values) & -1) index the trailing NaN
+    padded = np.append(values, np.nan)
+    return padded[first], padded[last]
+
+
+def _merge_series_buckets(merged_keys: np.ndarray, buckets: np.ndarray, ohlcv: typing.Dict[str, np.ndarray],
+                          dp: dict) -> typing.Tuple[np.ndarray, np.ndarray, typing.Dict[str, np.ndarray]]:
+    """
+    Merges the rows of series sharing a merged key per bucket: the NaN-skipping mean of prices & the sum of volume.
+    :return: the merged key & bucket index of each output row, and the OHLCV columns
+    """
+    if len(merged_keys) == 0:
+        return merged_keys, buckets, ohlcv
+    order = np.lexsort((buckets, merged_keys))
+    merged_keys, buckets = merged_keys[order], buckets[order]
+    starts = _segment_starts(merged_keys, buckets)
+    merged = {}
+    for (column, column_values) in ohlcv.items():
+        column_values = column_values[order]
+        if column == dp['DOLLAR_VOLUME']:
+            merged[column] = np.add.reduceat(column_values, starts)
+            continue
+        counts = np.add.reduceat(~np.isnan(column_values), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            merged[column] = np.add.reduceat(np.nan_to_num(column_values), starts) / counts
+    return merged_keys[starts], buckets[starts], merged
+
+
+def split_time_windows(start: float, end: float, window_seconds: float) -> typing.List[typing.Tuple[float, float]]:
+    """
+    Splits the time range [start, end) into consecutive windows of at most window_seconds.
+    Window boundaries are aligned to multiples of window_seconds since the epoch, so any two ranges covering the same
+    period produce the same windows (e.g. for checkpointing).
+    :param start: unix timestamp (seconds) for the start of the range
+    :param end: unix timestamp (seconds) for the end of the range
+    :param window_seconds: the length of each window
+    :return: a list of (window_start, window_end) tuples, clipped to [start, end)
+    """
+    windows = []
+    window_start = start - (start % window_seconds)
+    while window_start < end:
+        window_end = window_start + window_seconds
+        windows.append((max(window_start, start), min(window_end, end)))
+        window_start = window_end
+    return windows
+
 
 def pluck(d: dict, *keys):
     return {k: v for k, v in d.items() if k in keys}
 
 
-def retry(func, retries: int = 3, **args):
-    num_retries = 0
-    try:
-        num_retries += 1
-        output = func(**args)
-        return output
-    except Exception:
-        if num_retries > self.max_retries:
-            raise Exception(f'Achieved max_retries = {retries}')
+def retry(func, retries: int = 3, backoff: float = 0, **args):
+    """
+    Calls func(**args), retrying on any exception.
+    :param func: the function to call
+    :param retries: the max number of retries after the first attempt
+    :param backoff: seconds to wait before the first retry, doubling on every subsequent retry
+    :return: the output of func
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(**args)
+        except Exception as e:
+            if attempt == retries:
+                raise Exception(f'Achieved max_retries = {retries}') from e
+            time.sleep(backoff * 2 ** attempt)
 
 def simple_pluck_dict(d: dict, keys: typing.List[str], replace_with_none: bool = True) -> typing.List:
     return [d.get(key, None) if replace_with_none else d[key] for key in keys]